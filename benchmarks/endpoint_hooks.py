@@ -0,0 +1,281 @@
+"""Microbenchmark of the VisualDispersy endpoint hooks.
+
+Every received packet goes through the packet handler hook installed
+by hook_endpoint (startswith check, slicing, community lookup and an
+id request sendto). This benchmark drives a StandaloneEndpoint
+compatible fake with packet batches, once plain and once hooked, and
+reports the per-packet overhead of the hooks and the batch
+throughput of both, to keep the observer effect in check.
+
+The packets are synthetic, or recorded batches from a pickle file
+([[((str/host,int/port),str/data)]], e.g. a list of the packets
+arguments of dispersythread_data_came_in).
+
+Usage:
+    python benchmarks/endpoint_hooks.py --batch-sizes 1 10 100 --packets 100000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import socket
+import argparse
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dispersy.exception import CommunityNotFoundException
+from dispersyviz import visualreporter
+from dispersyviz.visualdispersy import hook_endpoint
+
+COMMUNITY_ID = "c" * 20         # Community id of the joined community
+UNKNOWN_ID = "u" * 20           # Community id of an unknown community
+
+
+class BenchCommunity(object):
+
+    """Stand-in for a joined community, only its class name is used.
+    """
+
+
+class FakeSocket:
+
+    """Socket which only counts the sent packets.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.sent = 0   # Packets sent
+
+    def sendto(self, data, sock_addr):
+        """Count a sent packet.
+        """
+        self.sent = self.sent + 1
+
+
+class FakeEndpoint:
+
+    """StandaloneEndpoint compatible fake, which counts the packets
+        handed to Dispersy instead of handling them.
+    """
+
+    def __init__(self, port):
+        """Initialize the StandaloneEndpoint fields the hooks use.
+        """
+        self._ip = "127.0.0.1"
+        self._port = port
+        self._socket = FakeSocket()
+        self._sendqueue = []
+        self._sendqueue_lock = threading.Lock()
+        self.received = 0   # Packets handed to Dispersy
+
+    def _loop(self):
+        """Socket loop, nothing to receive.
+        """
+        pass
+
+    def _process_sendqueue(self):
+        """Nothing is ever queued.
+        """
+        pass
+
+    def dispersythread_data_came_in(self, packets, timestamp, cache=True):
+        """Count the packets which would be handled by Dispersy.
+        """
+        self.received = self.received + len(packets)
+
+
+class FakeDispersy:
+
+    """The part of VisualDispersy the hooks report for.
+    """
+
+    def __init__(self, port):
+        """Initialize fields.
+        """
+        self.myid = "127.0.0.1:%d" % port
+        self.vz_endpoint_open = False
+        self.community = BenchCommunity()
+
+    def vz_report_process(self):
+        """Not reported in benchmarks.
+        """
+        pass
+
+    def get_community(self, cid, load=False, auto_load=True):
+        """Look up our single community.
+        """
+        if cid != COMMUNITY_ID:
+            raise CommunityNotFoundException(cid)
+        return self.community
+
+
+class NullReporter:
+
+    """Reporter which only counts the events.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.events = 0     # Reported events
+
+    def report_event(self, event):
+        """Count an event.
+        """
+        self.events = self.events + 1
+
+
+def drain_server():
+    """Start a local server which reads and discards all data.
+        Returns its address.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def drain():
+        connection = listener.accept()[0]
+        while connection.recv(65536):
+            pass
+    thread = threading.Thread(target=drain)
+    thread.daemon = True
+    thread.start()
+    return listener.getsockname()
+
+
+def synthetic_packets(count, size, requests, identities, unknown):
+    """Generate packets, with some fractions of id requests,
+        dispersy-identity messages and messages of unknown
+        communities. All other packets are for our community.
+    """
+    packets = []
+    for i in range(count):
+        sock_addr = ("127.0.0.1", 10000 + i % 100)
+        kind = random.random()
+        if kind < requests:
+            data = "dpvizidrqBenchCommunity,127.0.0.1:%d" % sock_addr[1]
+        elif kind < requests + identities:
+            data = "\x00\x01" + COMMUNITY_ID + chr(248) + "i" * size
+        elif kind < requests + identities + unknown:
+            data = "\x00\x01" + UNKNOWN_ID + chr(1) + "x" * size
+        else:
+            data = "\x00\x01" + COMMUNITY_ID + chr(1) + "x" * size
+        packets.append((sock_addr, data))
+    return packets
+
+
+def batches_of(packets, size):
+    """Split packets into batches of some size.
+    """
+    return [packets[i:i + size] for i in range(0, len(packets), size)]
+
+
+def time_batches(endpoint, batches, repeat):
+    """Hand all batches to the packet handler of an endpoint.
+        Returns the best time of some repetitions (seconds).
+    """
+    best = None
+    handler = endpoint.dispersythread_data_came_in
+    for _ in range(repeat):
+        start = time.time()
+        for batch in batches:
+            handler(batch, start)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmark(batchsets, repeat):
+    """Compare the plain and the hooked endpoint for sets of batches
+        {str/label:[[packet]]}.
+        Returns the results per label.
+    """
+    results = {}
+    for label, batches in sorted(batchsets.items()):
+        count = sum([len(batch) for batch in batches])
+        plain = FakeEndpoint(10000)
+        hooked = FakeEndpoint(10000)
+        hook_endpoint(FakeDispersy(10000), hooked)
+        plain_time = time_batches(plain, batches, repeat)
+        hooked_time = time_batches(hooked, batches, repeat)
+        results[label] = {
+            'packets': count,
+            'batches': len(batches),
+            'plain_ns_per_packet': plain_time / count * 1e9,
+            'hooked_ns_per_packet': hooked_time / count * 1e9,
+            'overhead_ns_per_packet': (hooked_time - plain_time) / count * 1e9,
+            'plain_batches_per_second': len(batches) / plain_time if plain_time else None,
+            'hooked_batches_per_second': len(batches) / hooked_time if hooked_time else None,
+            'id_requests_sent': hooked._socket.sent / float(repeat),
+        }
+    return results
+
+
+def main():
+    """Parse the command line and run the benchmark.
+    """
+    parser = argparse.ArgumentParser(description="VisualDispersy endpoint hook microbenchmark")
+    parser.add_argument("--packets", type=int, default=100000,
+                        help="synthetic packets per batch size")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100],
+                        help="synthetic packets per batch")
+    parser.add_argument("--size", type=int, default=100,
+                        help="synthetic payload bytes")
+    parser.add_argument("--requests", type=float, default=0.5,
+                        help="fraction of id requests")
+    parser.add_argument("--identities", type=float, default=0.05,
+                        help="fraction of dispersy-identity messages")
+    parser.add_argument("--unknown", type=float, default=0.05,
+                        help="fraction of messages of unknown communities")
+    parser.add_argument("--recorded", default=None,
+                        help="pickle file with recorded packet batches, instead of synthetic ones")
+    parser.add_argument("--reporter", choices=["null", "socket"], default="null",
+                        help="count reported events, or send them over a local socket")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="repetitions, the best is reported")
+    parser.add_argument("--json", default=None,
+                        help="also write the results to this JSON file")
+    parser.add_argument("--max-overhead", type=float, default=None,
+                        help="exit with an error if the overhead exceeds this many ns per packet")
+    args = parser.parse_args()
+
+    if args.reporter == "null":
+        visualreporter.singleton_reporter = NullReporter()
+    else:
+        visualreporter.init_reporter(drain_server())
+
+    if args.recorded:
+        with open(args.recorded, 'rb') as f:
+            batchsets = {"recorded": pickle.load(f)}
+    else:
+        packets = synthetic_packets(args.packets, args.size, args.requests,
+                                    args.identities, args.unknown)
+        batchsets = dict([("batch %d" % size, batches_of(packets, size))
+                          for size in args.batch_sizes])
+
+    results = run_benchmark(batchsets, args.repeat)
+    print "%-12s %10s %10s %10s %14s %14s" % ("", "plain ns", "hooked ns", "overhead",
+                                            "plain b/s", "hooked b/s")
+    for label, result in sorted(results.items()):
+        print "%-12s %10.0f %10.0f %10.0f %14.0f %14.0f" % (
+            label, result['plain_ns_per_packet'], result['hooked_ns_per_packet'],
+            result['overhead_ns_per_packet'], result['plain_batches_per_second'],
+            result['hooked_batches_per_second'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.max_overhead is not None:
+        worst = max([result['overhead_ns_per_packet'] for result in results.values()])
+        if worst > args.max_overhead:
+            print "Overhead of %.0f ns per packet exceeds %.0f ns" % (worst, args.max_overhead)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
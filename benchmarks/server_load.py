@@ -0,0 +1,404 @@
+"""Synthetic load benchmark for the VisualServer.
+
+Opens a number of simulated reporter connections, which send the
+same events as real peers (built with the visualreporter event
+constructors), and replays a traffic pattern at the server:
+ - flood: every peer sends to all other peers in turn
+ - gossip: every message is sent to a random fan-out of peers
+ - skewed: the receivers follow a Zipf distribution (hot peers)
+
+Measured through the self-metrics endpoint of the server:
+ - the sustained rate at which the model applies events
+ - event-to-screen latency of probe events (applied, and redrawn)
+ - the peak RSS of the server
+ - the release time of the end barrier
+
+The results are stored in benchmarks/results, and compared to the
+last stored result with the same parameters, so regressions between
+versions are visible.
+
+Usage:
+    python benchmarks/server_load.py --peers 200 --pattern gossip --duration 20
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import bisect
+import random
+import socket
+import argparse
+import threading
+import subprocess
+import urllib2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "benchmarks", "results")
+sys.path.insert(0, ROOT)
+
+from dispersyviz.visualreporter import (VD_EVT_CONNECT, VD_EVT_COMMUNICATION,
+                                        VD_CUSTOM_TARGET, VD_EVT_END)
+
+COMMUNITY = "LoadCommunity"
+
+
+def flood_pattern(peers, fanout):
+    """Every peer sends to all other peers in turn.
+        Returns a function (sender index, message number) -> [receiver index]
+    """
+    def receivers(sender, message):
+        return [(sender + 1 + message % (peers - 1)) % peers]
+    return receivers
+
+
+def gossip_pattern(peers, fanout):
+    """Every message goes to a random fan-out of other peers.
+    """
+    def receivers(sender, message):
+        chosen = random.sample(xrange(peers - 1), min(fanout, peers - 1))
+        return [(sender + 1 + index) % peers for index in chosen]
+    return receivers
+
+
+def skewed_pattern(peers, fanout, exponent=1.2):
+    """The receivers follow a Zipf distribution over the peers,
+        so a few hot peers receive most of the messages.
+    """
+    cumulative = []
+    total = 0.0
+    for rank in range(1, peers + 1):
+        total = total + 1.0 / rank ** exponent
+        cumulative.append(total)
+
+    def receivers(sender, message):
+        chosen = []
+        for _ in range(fanout):
+            receiver = bisect.bisect_left(cumulative, random.random() * total)
+            if receiver != sender:
+                chosen.append(min(receiver, peers - 1))
+        return chosen or [(sender + 1) % peers]
+    return receivers
+
+PATTERNS = {"flood": flood_pattern,
+            "gossip": gossip_pattern,
+            "skewed": skewed_pattern}
+
+
+class MetricsPoller:
+
+    """Object to read the self-metrics of a VisualServer.
+    """
+
+    def __init__(self, port):
+        """Initialize fields.
+        """
+        self.url = "http://127.0.0.1:%d/metrics.json" % port
+
+    def read(self):
+        """Read the current metrics, or None if unreachable.
+        """
+        try:
+            return json.loads(urllib2.urlopen(self.url, timeout=5.0).read())
+        except (IOError, ValueError):
+            return None
+
+    def wait_for(self, condition, timeout=60.0, interval=0.005):
+        """Poll until condition(metrics) holds.
+            Returns (float/time, dict/metrics), or (None, metrics) on timeout.
+        """
+        deadline = time.time() + timeout
+        metrics = None
+        while time.time() < deadline:
+            metrics = self.read()
+            if metrics and condition(metrics):
+                return time.time(), metrics
+            time.sleep(interval)
+        return None, metrics
+
+
+class LoadGenerator:
+
+    """Object managing the simulated peer connections.
+    """
+
+    def __init__(self, address, peers, pattern, fanout, batch):
+        """Connect a socket per simulated peer, plus a probe peer.
+        """
+        self.ids = ["127.0.0.1:%d" % (20000 + i) for i in range(peers)]
+            # Simulated peer id per index
+        self.probe_id = "127.0.0.1:%d" % (20000 + peers)
+            # Peer id of the probe connection
+        self.receivers = PATTERNS[pattern](peers, fanout)
+        self.batch = batch              # Messages per sendall per peer
+        self.sockets = []
+        for _ in range(peers):
+            self.sockets.append(socket.create_connection(address))
+        self.probe = socket.create_connection(address)
+        self.sent = 0                   # COM events sent
+        self.running = False
+
+    def connect(self):
+        """Join all peers to the load community.
+        """
+        for pid, sock in zip(self.ids, self.sockets):
+            sock.sendall(VD_EVT_CONNECT(pid, COMMUNITY) + ";")
+        self.probe.sendall(VD_EVT_CONNECT(self.probe_id, COMMUNITY) + ";")
+
+    def run(self, duration, rate):
+        """Send communication events for some duration, at most at
+            some rate (events/s, 0 for as fast as possible).
+        """
+        self.running = True
+        start = time.time()
+        message = 0
+        while self.running and time.time() - start < duration:
+            for sender, sock in enumerate(self.sockets):
+                events = []
+                for i in range(self.batch):
+                    for receiver in self.receivers(sender, message + i):
+                        events.append(VD_EVT_COMMUNICATION(
+                            self.ids[sender], self.ids[receiver], COMMUNITY))
+                sock.sendall(";".join(events) + ";")
+                self.sent = self.sent + len(events)
+            message = message + self.batch
+            if rate > 0:
+                ahead = self.sent / float(rate) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.running = False
+
+    def send_probe(self, number):
+        """Send a probe event, the only target events in the load.
+        """
+        self.probe.sendall(VD_CUSTOM_TARGET(self.probe_id, "probe", number, number) + ";")
+
+    def end(self):
+        """Request the end of the experiment for all peers at once.
+            Returns the seconds from the first END sent until all
+            peers were released.
+        """
+        everyone = self.sockets + [self.probe]
+        start = time.time()
+        for sock, pid in zip(everyone, self.ids + [self.probe_id]):
+            sock.sendall(VD_EVT_END(pid) + ";")
+        for sock in everyone:
+            sock.settimeout(120.0)
+            try:
+                sock.recv(8)
+            except socket.error:
+                return None
+        released = time.time() - start
+        for sock in everyone:
+            sock.close()
+        return released
+
+
+def peak_rss(ospid):
+    """The peak resident set size of a process in bytes, or None.
+    """
+    try:
+        with open('/proc/%d/status' % ospid) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def git_revision():
+    """The current git revision of the repository, or None.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def drain(pipe):
+    """Read and discard the output of a process until it exits,
+        so it never blocks on a full pipe.
+    """
+    for _ in iter(pipe.readline, ''):
+        pass
+
+
+def run_benchmark(args):
+    """Run the benchmark against a (new) server.
+        Returns the results as a dictionary.
+    """
+    server = None
+    if not args.attach:
+        command = ['python', '-u', os.path.join(ROOT, 'dispersyviz', 'visualserver.py'),
+                   str(args.port), '--metrics-port', str(args.metrics_port),
+                   '--sample-interval', '0'] + args.server_args.split()
+        server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE)
+        if not server.stdout.readline():
+            raise RuntimeError("VisualServer failed to start")
+        drainer = threading.Thread(target=drain, args=(server.stdout,))
+        drainer.daemon = True
+        drainer.start()
+    poller = MetricsPoller(args.metrics_port)
+    if not poller.wait_for(lambda metrics: True, 10.0)[0]:
+        raise RuntimeError("No metrics endpoint on port %d" % args.metrics_port)
+
+    load = LoadGenerator(("127.0.0.1", args.port), args.peers, args.pattern,
+                         args.fanout, args.batch)
+    load.connect()
+    poller.wait_for(lambda metrics: metrics['events'].get('CON', 0) >= args.peers + 1)
+
+    # Sample the apply rate while the load runs
+    samples = []
+    sender = threading.Thread(target=load.run, args=(args.duration, args.rate))
+    sender.start()
+    start = time.time()
+    latencies = []
+    probes = 0
+    while sender.is_alive():
+        metrics = poller.read()
+        if metrics:
+            samples.append((time.time() - start, metrics['events'].get('COM', 0),
+                            metrics['event_queue'], metrics['rss_bytes']))
+        if time.time() - start >= (probes + 1) * args.probe_interval:
+            probes = probes + 1
+            latencies.append(measure_latency(poller, load, probes,
+                                             "--headless" not in args.server_args))
+        time.sleep(0.25)
+    sender.join()
+    sent_time = time.time() - start
+    drained, metrics = poller.wait_for(
+        lambda metrics: metrics['events'].get('COM', 0) >= load.sent, 300.0, 0.05)
+
+    rates = [(count - previous[1]) / (t - previous[0])
+             for previous, (t, count, queue, rss) in zip(samples, samples[1:])
+             if t > previous[0]]
+    applied = [latency[0] for latency in latencies if latency[0] is not None]
+    drawn = [latency[1] for latency in latencies if latency[1] is not None]
+    results = {
+        'pattern': args.pattern,
+        'peers': args.peers,
+        'fanout': args.fanout,
+        'duration': args.duration,
+        'target_rate': args.rate,
+        'server_args': args.server_args,
+        'revision': git_revision(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'events_sent': load.sent,
+        'send_rate': load.sent / sent_time,
+        'sustained_rate': (load.sent / (drained - start)) if drained else None,
+        'peak_window_rate': max(rates) if rates else None,
+        'max_event_queue': max([sample[2] for sample in samples]) if samples else None,
+        'drain_seconds': (drained - start - sent_time) if drained else None,
+        'apply_latency_median': median(applied),
+        'apply_latency_max': max(applied) if applied else None,
+        'screen_latency_median': median(drawn),
+        'screen_latency_max': max(drawn) if drawn else None,
+    }
+    peak = peak_rss(server.pid) if server else None
+    if peak is None and samples:
+        peak = max([sample[3] for sample in samples])
+    results['peak_rss_bytes'] = peak
+    results['end_release_seconds'] = load.end()
+    if server:
+        server.wait()
+    return results
+
+
+def measure_latency(poller, load, number, screen=True):
+    """Send a probe and wait for it to be applied by the model and,
+        on screen, for the next redraw after that.
+        Returns (apply latency, screen latency), None when unmeasured.
+    """
+    start = time.time()
+    load.send_probe(number)
+    applied, metrics = poller.wait_for(
+        lambda metrics: metrics['events'].get('CTM', 0) >= number, 30.0)
+    if applied is None or not screen:
+        return (applied - start if applied else None), None
+    # Redraws since the probe was applied
+    redraws = metrics['update_view_count']
+    drawn, metrics = poller.wait_for(
+        lambda metrics: metrics['update_view_count'] > redraws, 5.0)
+    return applied - start, (drawn - start) if drawn else None
+
+
+def median(values):
+    """The median of some values, or None.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def previous_result(results):
+    """The last stored result with the same parameters, or None.
+    """
+    keys = ('pattern', 'peers', 'fanout', 'duration', 'target_rate', 'server_args')
+    for path in sorted(glob.glob(os.path.join(RESULTS, "server_load-*.json")), reverse=True):
+        with open(path) as f:
+            previous = json.load(f)
+        if all([previous.get(key) == results[key] for key in keys]):
+            return previous
+    return None
+
+
+def store_result(results):
+    """Store a result in benchmarks/results.
+        Returns the file name.
+    """
+    if not os.path.isdir(RESULTS):
+        os.makedirs(RESULTS)
+    path = os.path.join(RESULTS, "server_load-%s-%s.json" % (
+        time.strftime("%Y%m%d-%H%M%S"), results['revision'] or "unknown"))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    return path
+
+
+def main():
+    """Parse the command line, run, compare and store.
+    """
+    parser = argparse.ArgumentParser(description="VisualServer load benchmark")
+    parser.add_argument("--peers", type=int, default=100,
+                        help="simulated peer connections")
+    parser.add_argument("--pattern", choices=sorted(PATTERNS.keys()), default="gossip",
+                        help="traffic pattern")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="receivers per message for gossip and skewed")
+    parser.add_argument("--batch", type=int, default=10,
+                        help="messages per peer per send")
+    parser.add_argument("--duration", type=float, default=20.0,
+                        help="seconds of load")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="events per second to send (0: as fast as possible)")
+    parser.add_argument("--probe-interval", type=float, default=2.0,
+                        help="seconds between latency probes")
+    parser.add_argument("--port", type=int, default=54990,
+                        help="VisualServer port")
+    parser.add_argument("--metrics-port", type=int, default=54991,
+                        help="VisualServer metrics port")
+    parser.add_argument("--server-args", default="",
+                        help="extra VisualServer arguments, e.g. \"--headless\" or \"--workers 4\"")
+    parser.add_argument("--attach", action="store_true",
+                        help="use an already running VisualServer instead of starting one")
+    parser.add_argument("--no-store", action="store_true",
+                        help="do not store the results")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    previous = previous_result(results)
+    for key in sorted(results.keys()):
+        line = "%-24s %s" % (key, results[key])
+        if previous and isinstance(results[key], (int, float)) and previous.get(key):
+            line = line + "  (%+.1f%% vs %s)" % (
+                100.0 * (results[key] - previous[key]) / previous[key], previous.get('revision'))
+        print line
+    if not args.no_store:
+        print "Stored in %s" % store_result(results)
+
+if __name__ == "__main__":
+    main()
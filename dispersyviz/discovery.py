@@ -0,0 +1,112 @@
+"""Discovery and validation of experiments without importing them.
+
+Experiments import Dispersy, Twisted and M2Crypto, so importing them
+into the GUI process to inspect them is slow and leaves all of that
+loaded. Instead, experiments are validated by parsing their source
+(inspect_experiment) and, if needed, importing them in a short-lived
+child process (check_import). Both results are cached by the
+modification time of the experiment file.
+"""
+
+import os
+import ast
+import glob
+import subprocess
+
+MAIN_ARGUMENTS = 5
+    # (peerid, total peers, starting messages, total messages, server port)
+
+_inspected = {}
+    # Static inspection results per file {str/path:(float/mtime,ExperimentInfo)}
+_imported = {}
+    # Import check results per file {str/path:(float/mtime,str/error)}
+
+
+class ExperimentInfo:
+
+    """Static information about an experiment file.
+    """
+
+    def __init__(self, name, path, error=None):
+        """Initialize fields.
+        """
+        self.name = name    # Module name
+        self.path = path    # Source file
+        self.error = error  # Reason the experiment cannot run, None if valid
+
+
+def _main_error(tree, name):
+    """Check the main function of a parsed experiment.
+        Returns an error message, or None if it accepts our arguments.
+    """
+    main = None
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == "main":
+            main = node
+    if main is None:
+        return "Could not find a main() function in %s.py." % (name)
+    required = len(main.args.args) - len(main.args.defaults)
+    if not (required <= MAIN_ARGUMENTS <= len(main.args.args)
+            or (main.args.vararg and required <= MAIN_ARGUMENTS)):
+        return ("The main() function of %s.py needs to accept %d arguments (peerid, total peers, "
+                "starting messages, total messages, visual dispersy server port)." % (name, MAIN_ARGUMENTS))
+    return None
+
+
+def inspect_experiment(path):
+    """Validate an experiment file by parsing its source.
+        Returns an ExperimentInfo.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return ExperimentInfo(name, path, "%s.py does not exist." % (name))
+    cached = _inspected.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        info = ExperimentInfo(name, path, _main_error(tree, name))
+    except SyntaxError as e:
+        info = ExperimentInfo(name, path, "Syntax error in %s.py on line %s:\n\n%s" %
+                              (name, e.lineno, e.text or e.msg))
+    except IOError as e:
+        info = ExperimentInfo(name, path, "Could not read %s.py: %s" % (name, e))
+    _inspected[path] = (mtime, info)
+    return info
+
+
+def discover_experiments(folder):
+    """Inspect all experiments in a folder, sorted by name.
+        Returns [ExperimentInfo]
+    """
+    return [inspect_experiment(path)
+            for path in sorted(glob.glob(os.path.join(folder, "*.py")))]
+
+
+def check_import(info):
+    """Import an experiment in a child process.
+        Returns None if the import succeeded, or the error output.
+    """
+    try:
+        mtime = os.path.getmtime(info.path)
+    except OSError:
+        return "%s.py does not exist." % (info.name)
+    cached = _imported.get(info.path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    folder = os.path.dirname(os.path.abspath(info.path))
+    child = subprocess.Popen(
+        ['python', '-c', "import sys;sys.path.insert(0, sys.argv[1]);__import__(sys.argv[2])",
+         folder, info.name],
+        cwd=os.path.dirname(folder),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = child.communicate()[0]
+    error = None
+    if child.returncode:
+        error = "Import of %s.py failed.\n\n%s" % (info.name, output.strip())
+    _imported[info.path] = (mtime, error)
+    return error
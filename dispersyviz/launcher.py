@@ -0,0 +1,230 @@
+"""Fork-server launcher for experiment peers.
+
+Instead of starting a fresh interpreter per peer, which has to
+import Dispersy, Twisted and M2Crypto all over again, the launcher
+imports the experiment module once and forks the peer processes.
+Every fork gets its own reactor waker, random state and (through
+the experiment's main) its own ports.
+
+By default the peers are distributed over one process per core, each
+hosting multiple peers on a single reactor and a single VisualServer
+connection, which saves a Python heap and reactor per peer.
+
+Usage:
+    python dispersyviz/launcher.py [--processes N] EXPERIMENT PEERS MESSAGES TOTALMESSAGES SERVERPORT
+
+Where MESSAGES is a python expression in peerid, evaluated per peer.
+With --profile (or DISPERSYVIZ_PROFILE, see profiling) every peer
+process dumps a profile on exit.
+"""
+
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import argparse
+import threading
+import traceback
+import multiprocessing
+
+import profiling
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXPERIMENTS = os.path.join(ROOT, "experiments")
+
+
+def _set_parent_death_signal():
+    """Make sure this (forked) process dies with the launcher,
+        even if the launcher gets killed without warning (Linux).
+    """
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").prctl(1, signal.SIGKILL)  # PR_SET_PDEATHSIG
+    except (OSError, AttributeError):
+        pass
+
+
+def _reinit_after_fork():
+    """Give a forked peer its own process state.
+        The reactor waker is a pipe created at import time, which
+        would otherwise be shared by all forked peers.
+    """
+    from twisted.internet import reactor
+    waker = reactor.waker
+    if waker:
+        reactor.removeReader(waker)
+        reactor._internalReaders.discard(waker)
+        waker.connectionLost(None)
+        reactor.waker = None
+        reactor.installWaker()
+    random.seed()
+    if "M2Crypto" in sys.modules:
+        from M2Crypto import Rand
+        Rand.rand_seed(os.urandom(64))
+
+
+def import_experiment(name):
+    """Import an experiment module (and with it, all of its
+        dependencies) by name.
+    """
+    for path in (EXPERIMENTS, ROOT):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # A poll reactor has no kernel state to share between forks
+    from twisted.internet import pollreactor
+    pollreactor.install()
+    return __import__(name)
+
+
+def host_peers(main, peers, numpeers, totalmessages, serverport):
+    """Run the main of an experiment for multiple peers on the
+        reactor of this process.
+        The peers are [(int/peerid, int/nummessages)].
+        While hosting, reactor.run() only returns control to the next
+        main, and reactor.stop() only stops the reactor once every
+        hosted peer called it.
+    """
+    from twisted.internet import reactor
+    run, stop = reactor.run, reactor.stop
+    lock = threading.Lock()
+    remaining = [len(peers)]
+
+    def hosted_stop():
+        with lock:
+            remaining[0] = remaining[0] - 1
+            if remaining[0] == 0:
+                reactor.callFromThread(stop)
+
+    def terminate(signum, frame):
+        reactor.callFromThread(stop)
+
+    reactor.run = lambda *args, **kwargs: None
+    reactor.stop = hosted_stop
+    # Every peer keeps some threads busy (Dispersy, exit observers)
+    reactor.suggestThreadPoolSize(max(10, 4 * len(peers)))
+    for peerid, nummessages in peers:
+        main(peerid, numpeers, nummessages, totalmessages, serverport)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    run(installSignalHandlers=False)
+
+
+def run_peers(main, peers, numpeers, totalmessages, serverport):
+    """Run the main of an experiment for one or more peers, in a
+        forked process.
+        Never returns.
+    """
+    code = 0
+    try:
+        _set_parent_death_signal()
+        _reinit_after_fork()
+        if len(peers) == 1:
+            profiling.start("peer", str(peers[0][0]))
+        else:
+            profiling.start("peer", "%d-%d" % (peers[0][0], peers[-1][0]))
+        if len(peers) == 1:
+            peerid, nummessages = peers[0]
+            main(peerid, numpeers, nummessages, totalmessages, serverport)
+        else:
+            host_peers(main, peers, numpeers, totalmessages, serverport)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except:
+        traceback.print_exc()
+        code = 1
+    profiling.stop()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def spawn_peers(module, numpeers, messages, totalmessages, serverport,
+                processes=None, hosts=None):
+    """Fork processes for the peer ids [1~numpeers], running the main
+        of an (imported) experiment module.
+        The peers are distributed over contiguous ranges, one per
+        process (default: one process per core).
+        With hosts, the processes bind their peers to these
+        addresses in turn (through DISPERSYVIZ_PEER_HOST).
+        Returns the list of child process ids.
+    """
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, numpeers)
+    peers = [(peerid, eval(messages, {}, {'peerid': peerid}))
+             for peerid in range(1, numpeers + 1)]
+    children = []
+    for i in range(processes):
+        hosted = peers[i * numpeers / processes:(i + 1) * numpeers / processes]
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            if hosts:
+                os.environ["DISPERSYVIZ_PEER_HOST"] = hosts[i % len(hosts)]
+            run_peers(module.main, hosted, numpeers, totalmessages,
+                      serverport)
+        children.append(pid)
+    return children
+
+
+def wait_for_children(children):
+    """Wait for all children to exit, forwarding SIGTERM and SIGINT.
+    """
+    def forward(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    remaining = set(children)
+    while remaining:
+        try:
+            pid, status = os.waitpid(-1, 0)
+            remaining.discard(pid)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                break
+            if e.errno != errno.EINTR:
+                raise
+
+
+def main():
+    """Parse the command line, import once and fork the peers.
+    """
+    parser = argparse.ArgumentParser(description="Visual Dispersy peer launcher")
+    parser.add_argument("experiment", help="module name in the experiments folder")
+    parser.add_argument("peers", type=int, help="amount of peers to launch")
+    parser.add_argument("messages", help="messages per peer, a python expression in peerid")
+    parser.add_argument("totalmessages", type=int, help="total amount of messages")
+    parser.add_argument("serverport", type=int, help="port of the VisualServer")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="processes to distribute the peers over (default: one per core)")
+    parser.add_argument("--profile", choices=["cprofile", "sample"], default=None,
+                        help="profile every peer process (sets DISPERSYVIZ_PROFILE)")
+    parser.add_argument("--server-host", default=None,
+                        help="host of the VisualServer (sets DISPERSYVIZ_SERVER_HOST, default: localhost)")
+    parser.add_argument("--peer-hosts", nargs="+", default=None,
+                        help="addresses to bind the peer processes to in turn, e.g. 127.0.0.2 127.0.0.3")
+    args = parser.parse_args()
+    if args.profile:
+        os.environ["DISPERSYVIZ_PROFILE"] = args.profile
+    if args.server_host:
+        os.environ["DISPERSYVIZ_SERVER_HOST"] = args.server_host
+
+    start = time.time()
+    module = import_experiment(args.experiment)
+    imported = time.time()
+    children = spawn_peers(module, args.peers, args.messages,
+                           args.totalmessages, args.serverport,
+                           args.processes, args.peer_hosts)
+    print "Launched %d peers in %d processes in %.3f seconds (import %.3f seconds)" % (
+        args.peers, len(children), time.time() - start, imported - start)
+    sys.stdout.flush()
+    wait_for_children(children)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""Opt-in profiling of peers and the VisualServer.
+
+Set DISPERSYVIZ_PROFILE to "cprofile" (deterministic) or "sample"
+(a thread sampling the stacks of all threads) to profile every
+process started by the launcher and the VisualServer. Each process
+dumps a pstats compatible profile on exit, to DISPERSYVIZ_PROFILE_DIR
+(default: the profiles folder in the repository), named
+ROLE-LABEL-OSPID.prof.
+
+All threads are profiled, also the ones started after profiling was
+started (the model thread, client threads, reactor thread pool).
+
+The dumps can be merged into one report, or one per role:
+    python dispersyviz/profiling.py merge [--by-role] [PATH ...]
+which also breaks the time down into categories (crypto, SQLite,
+conversion, our hooks, ...).
+"""
+
+import os
+import sys
+import time
+import glob
+import marshal
+import pstats
+import cProfile
+import argparse
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = [("crypto", ("M2Crypto", "crypto", "Crypto", "hashlib", "_sha", "_md5")),
+              ("sqlite", ("sqlite", "database.py", "dispersydatabase")),
+              ("conversion", ("conversion.py", "payload.py", "struct")),
+              ("visualdispersy", ("dispersyviz",)),
+              ("twisted", ("twisted",)),
+              ("dispersy", ("dispersy",))]
+    # Categories of the time breakdown, the first matching part of the
+    # file or function name wins
+
+_session = None
+    # Running profiling session of this process, if any
+
+
+class DeterministicProfile:
+
+    """cProfile profiler per thread.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.lock = threading.Lock()
+        self.profilers = []     # Profiler per profiled thread
+
+    def _add(self):
+        """Start profiling the current thread.
+        """
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+
+    def _thread_started(self, frame, event, arg):
+        """Profile function of new threads, replaces itself with a
+            profiler for the thread.
+        """
+        sys.setprofile(None)
+        self._add()
+
+    def start(self):
+        """Profile the current thread and all new threads.
+        """
+        threading.setprofile(self._thread_started)
+        self._add()
+
+    def stop(self, path):
+        """Dump the profile of all threads to a file.
+        """
+        threading.setprofile(None)
+        with self.lock:
+            profilers = list(self.profilers)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+
+
+class SamplingProfile:
+
+    """Thread sampling the stacks of all other threads.
+        Every sample adds the time since the previous sample to the
+        functions on the stacks, as pstats compatible statistics.
+    """
+
+    def __init__(self, interval=0.005):
+        """Initialize fields.
+        """
+        self.interval = interval
+        self.own = {}
+            # Time on top of a stack per function {(file,line,name):float}
+        self.total = {}
+            # Time anywhere in a stack per function {(file,line,name):float}
+        self.calls = {}
+            # Samples per function {(file,line,name):int}
+        self.callers = {}
+            # Time per caller per function {(file,line,name):{(file,line,name):float}}
+        self.alive = True
+        self.thread = None
+
+    def start(self):
+        """Start sampling.
+        """
+        self.thread = threading.Thread(target=self.run, name="SamplingProfile")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Sample until stopped.
+        """
+        ident = threading.current_thread().ident
+        last = time.time()
+        while self.alive:
+            time.sleep(self.interval)
+            now = time.time()
+            for thread, frame in sys._current_frames().items():
+                if thread != ident:
+                    self._record(frame, now - last)
+            last = now
+
+    def _record(self, frame, elapsed):
+        """Add the time of a sample to all functions on a stack.
+        """
+        seen = set()
+        callee = None
+        while frame:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if callee is None:
+                self.own[key] = self.own.get(key, 0.0) + elapsed
+            if key not in seen:
+                seen.add(key)
+                self.total[key] = self.total.get(key, 0.0) + elapsed
+                self.calls[key] = self.calls.get(key, 0) + 1
+            if callee is not None:
+                callers = self.callers.setdefault(callee, {})
+                callers[key] = callers.get(key, 0.0) + elapsed
+            callee = key
+            frame = frame.f_back
+
+    def stop(self, path):
+        """Stop sampling and dump the statistics to a file.
+        """
+        self.alive = False
+        self.thread.join(1.0)
+        stats = {}
+        for key, total in self.total.items():
+            calls = self.calls[key]
+            callers = dict([(caller, (1, 1, spent, spent)) for caller, spent
+                            in self.callers.get(key, {}).items()])
+            stats[key] = (calls, calls, self.own.get(key, 0.0), total, callers)
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+
+
+def profile_dir():
+    """The folder to dump profiles to.
+    """
+    return os.environ.get("DISPERSYVIZ_PROFILE_DIR", os.path.join(ROOT, "profiles"))
+
+
+def start(role, label=""):
+    """Start profiling this process, if enabled by DISPERSYVIZ_PROFILE.
+        Returns whether profiling started.
+    """
+    global _session
+    backend = os.environ.get("DISPERSYVIZ_PROFILE")
+    if not backend or _session:
+        return False
+    if backend == "sample":
+        profile = SamplingProfile()
+    else:
+        profile = DeterministicProfile()
+    name = "-".join([part for part in (role, label, str(os.getpid())) if part])
+    _session = (profile, os.path.join(profile_dir(), name + ".prof"))
+    profile.start()
+    return True
+
+
+def stop():
+    """Stop profiling this process and dump the profile, if running.
+    """
+    global _session
+    if not _session:
+        return
+    profile, path = _session
+    _session = None
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass    # Created by another process in the meantime
+    profile.stop(path)
+
+
+def categorize(stats):
+    """Break the (own) time of a profile down into categories.
+        Returns {str/category:float/seconds}
+    """
+    breakdown = {}
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        # Builtins have no file, but their name tells their module
+        where = filename + " " + name
+        category = "builtins" if filename == "~" else "other"
+        for candidate, parts in CATEGORIES:
+            if [part for part in parts if part in where]:
+                category = candidate
+                break
+        breakdown[category] = breakdown.get(category, 0.0) + tt
+    return breakdown
+
+
+def merge(paths, by_role=False):
+    """Merge profile dumps, into one or one per role.
+        Returns {str/role:(pstats.Stats, int/processes)}
+    """
+    merged = {}
+    for path in paths:
+        role = os.path.basename(path).split("-")[0] if by_role else "all"
+        if role in merged:
+            stats, processes = merged[role]
+            stats.add(path)
+            merged[role] = (stats, processes + 1)
+        else:
+            merged[role] = (pstats.Stats(path), 1)
+    return merged
+
+
+def main():
+    """Merge profile dumps and print the reports.
+    """
+    parser = argparse.ArgumentParser(description="Merge Visual Dispersy profiles")
+    parser.add_argument("command", choices=["merge"])
+    parser.add_argument("paths", nargs="*",
+                        help="profile files or folders (default: the profile folder)")
+    parser.add_argument("--by-role", action="store_true",
+                        help="one report per role (peer, server) instead of one in total")
+    parser.add_argument("--sort", default="cumulative",
+                        help="pstats sort key (default: cumulative)")
+    parser.add_argument("--limit", type=int, default=40,
+                        help="functions per report")
+    parser.add_argument("--output", default=None,
+                        help="also dump the merged profiles as OUTPUT-ROLE.prof")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths or [profile_dir()]:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, "*.prof"))))
+        elif os.path.isfile(path):
+            paths.append(path)
+    if not paths:
+        parser.error("no profiles found")
+    for role, (stats, processes) in sorted(merge(paths, args.by_role).items()):
+        print "=== %s: %d processes ===" % (role, processes)
+        breakdown = categorize(stats)
+        total = sum(breakdown.values()) or 1.0
+        for category, seconds in sorted(breakdown.items(), key=lambda item: -item[1]):
+            print "%-16s %10.3fs %5.1f%%" % (category, seconds, 100.0 * seconds / total)
+        stats.sort_stats(args.sort).print_stats(args.limit)
+        if args.output:
+            stats.dump_stats("%s-%s.prof" % (args.output, role))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Level-of-detail clustering of large community graphs.
+
+Once a community has more vertices than a threshold, its peers
+are collapsed into super-nodes and the edges between them are
+aggregated, so the cost of drawing a frame depends on the amount
+of groups instead of the amount of peers. A single group can be
+expanded (drilled down into) to show its peers individually.
+"""
+
+import math
+import threading
+import multiprocessing
+from graph_tool.all import *
+
+
+def _address(pid):
+    """The (host, port) of a "host:port" node identifier, for sorting.
+    """
+    host, _, port = str(pid).rpartition(':')
+    try:
+        return (host, int(port))
+    except ValueError:
+        return (host, 0)
+
+
+def group_by_ports(model, name, indices, maxgroups):
+    """Split the peers, sorted by host and port, into at most
+        maxgroups contiguous port ranges.
+        Returns {str/node_id:str/group_name}
+    """
+    pids = sorted(indices.values(), key=_address)
+    size = max(1, int(math.ceil(len(pids) / float(max(1, maxgroups)))))
+    groups = {}
+    for start in range(0, len(pids), size):
+        chunk = pids[start:start + size]
+        label = "ports %s-%s" % (chunk[0], chunk[-1])
+        for pid in chunk:
+            groups[pid] = label
+    return groups
+
+
+def group_by_completion(model, name, indices, maxgroups):
+    """Group the peers by the completion of their targets.
+        Returns {str/node_id:str/group_name}
+    """
+    groups = {}
+    for pid in indices.values():
+        if pid not in model.vprogress:
+            groups[pid] = "no progress"
+        else:
+            pct = model.vprogress[pid]
+            if pct >= 1.0:
+                groups[pid] = "100%"
+            else:
+                low = int(max(0.0, pct) * 4) * 25
+                groups[pid] = "%d-%d%%" % (low, low + 24)
+    return groups
+
+
+def block_worker(jobs, results):
+    """Main loop of the block inference process.
+        Jobs are (str/community_name, int/vertices, [(int/from,int/to)])
+        tuples, or None to exit.
+        Results are (str/community_name, {int/vertex:int/block}) tuples.
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        name, numvertices, edges = job
+        graph = Graph()
+        graph.add_vertex(numvertices)
+        graph.add_edge_list(edges)
+        pmap = minimize_blockmodel_dl(graph).get_blocks()
+        results.put((name, dict([(int(v), int(pmap[v])) for v in graph.vertices()])))
+
+
+class BlockGrouping:
+
+    """Group the peers by graph-tool's stochastic block model
+        inference on the edges seen so far.
+        The blocks are inferred in a separate process, and only
+        again once the graph changed significantly, as this is
+        expensive. Until the first blocks of a community are
+        known, its peers are grouped by ports.
+        Construct it before starting any threads, as it forks the
+        inference process.
+    """
+
+    def __init__(self, threshold=0.1):
+        """Initialize fields.
+        """
+        self.threshold = threshold
+        self.blocks = {}
+            # Last inferred blocks per community name
+            # {str/community_name:{int/vertex:int/block}}
+        self.inferred = {}
+            # (vertices, edges) of the last requested inference per community name
+        self.pending = set()
+            # Community names with an inference in progress
+        self.jobs = multiprocessing.Queue()     # Job queue of the inference process
+        self.results = multiprocessing.Queue()  # Result queue of the inference process
+        self.receiving = False  # Results are handed to the model thread
+        process = multiprocessing.Process(target=block_worker,
+                                          args=(self.jobs, self.results),
+                                          name="BlockWorker")
+        process.daemon = True
+        process.start()
+
+    def _start(self, model):
+        """Start a thread handing the results of the inference
+            process to the model thread.
+        """
+        self.receiving = True
+        thread = threading.Thread(target=self._receive, args=(model,),
+                                  name="BlockResults")
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self, model):
+        """Post the inferred blocks to the model thread.
+        """
+        while True:
+            name, blocks = self.results.get()
+            model.call_in_model(self._update, model, name, blocks)
+
+    def _update(self, model, name, blocks):
+        """Use newly inferred blocks. Model thread only.
+        """
+        self.blocks[name] = blocks
+        self.pending.discard(name)
+        model.mark_dirty(name)
+
+    def __call__(self, model, name, indices, maxgroups):
+        """Returns {str/node_id:str/group_name}
+        """
+        if not self.receiving:
+            self._start(model)
+        numvertices = model.graphs[name].num_vertices()
+        numedges = len(model.edgecounts[name])
+        lastvertices, lastedges = self.inferred.get(name, (0, 0))
+        if name not in self.pending and (
+                numvertices != lastvertices
+                or abs(numedges - lastedges) > self.threshold * lastedges):
+            self.inferred[name] = (numvertices, numedges)
+            self.pending.add(name)
+            self.jobs.put((name, numvertices, model.edgecounts[name].keys()))
+        blocks = self.blocks.get(name)
+        if blocks is None:
+            return group_by_ports(model, name, indices, maxgroups)
+        return dict([(pid, "block %d" % blocks.get(index, -1))
+                     for index, pid in indices.iteritems()])
+
+
+class Clusterer:
+
+    """Object to collapse large community graphs into groups.
+        Only used by the model thread.
+    """
+
+    def __init__(self, threshold=100, grouping="ports", maxgroups=16):
+        """Initialize fields.
+            The grouping is one of "ports", "completion" or "blocks".
+        """
+        self.threshold = threshold  # Vertices before collapsing
+        self.maxgroups = maxgroups  # Maximum amount of port ranges
+        if grouping == "blocks":
+            self.grouping = BlockGrouping()
+        else:
+            self.grouping = {"ports": group_by_ports,
+                             "completion": group_by_completion}[grouping]
+        self.expanded = {}
+            # Expanded group per community name {str/community_name:str/group_name}
+
+    def applies(self, graph):
+        """Check if a graph is large enough to collapse.
+        """
+        return self.threshold > 0 and graph.num_vertices() > self.threshold
+
+    def expand(self, name, group):
+        """Show the peers of a group individually, or collapse
+            all groups again for None.
+        """
+        if group is None:
+            self.expanded.pop(name, None)
+        else:
+            self.expanded[name] = group
+
+    def collapse(self, model, name, snapshot):
+        """Add the collapsed graph of a community, with the edges
+            since the last snapshot, to a snapshot.
+        """
+        indices = dict([(int(vertices[name]), pid) for pid, vertices
+                        in model.vertices.items() if name in vertices])
+        groups = self.grouping(model, name, indices, self.maxgroups)
+        expanded = self.expanded.get(name)
+
+        graph = Graph()
+        labels = graph.new_vp("string")
+        colors = graph.new_vp("vector<float>")
+        sizes = graph.new_vp("double")
+        members = {}
+            # Peers per super-node {str/group_name:[str/node_id]}
+        vertex_of = {}
+            # Vertex in the collapsed graph per node identifier
+        names = []
+            # Group name per vertex, None for individual peers
+        for pid in sorted(groups.keys(), key=_address):
+            members.setdefault(groups[pid], []).append(pid)
+        for group in sorted(members.keys()):
+            if group == expanded:
+                for pid in members[group]:
+                    v = graph.add_vertex()
+                    vertex_of[pid] = v
+                    names.append(None)
+                    labels[v] = model.vlabels[name][model.vertices[pid][name]]
+                    colors[v] = model.vcolors[name][model.vertices[pid][name]]
+                    sizes[v] = 10
+                continue
+            v = graph.add_vertex()
+            names.append(group)
+            for pid in members[group]:
+                vertex_of[pid] = v
+            progress = [model.vprogress[pid] for pid in members[group]
+                        if pid in model.vprogress]
+            labels[v] = "%s (%d peers)" % (group, len(members[group]))
+            if progress:
+                pct = sum(progress) / len(progress)
+                colors[v] = [(1 - pct) * 0.640625, pct * 0.640625, 0, 0.9]
+            else:
+                colors[v] = [0.5, 0.5, 0.5, 0.9]
+            sizes[v] = 10 + 4 * math.sqrt(len(members[group]))
+
+        # Aggregate the edges between groups
+        counts = {}
+        for fv, tv in model.edgequeue[name]:
+            if fv not in indices or tv not in indices:
+                continue
+            edge = (int(vertex_of[indices[fv]]), int(vertex_of[indices[tv]]))
+            if edge[0] != edge[1]:
+                counts[edge] = counts.get(edge, 0) + 1
+        widths = graph.new_ep("double")
+        for (fv, tv), count in counts.iteritems():
+            e = graph.add_edge(fv, tv)
+            widths[e] = 1 + math.log(count)
+
+        snapshot.graphs[name] = graph
+        snapshot.vlabels[name] = labels
+        snapshot.vcolors[name] = colors
+        snapshot.vsizes[name] = sizes
+        snapshot.epenwidths[name] = widths
+        snapshot.groups[name] = names
@@ -4,12 +4,162 @@ through the visualreporter class.
 
 """
 
+import os
+import time
+import itertools
+
+from twisted.internet import reactor, defer
 from dispersy.dispersy import Dispersy
 from dispersy.community import Community
 from dispersy.endpoint import StandaloneEndpoint
 from dispersy.exception import CommunityNotFoundException
 from dispersy.crypto import ECCrypto
+from . import visualreporter
 from .visualreporter import *
+from .visualendpoint import LoopbackEndpoint, udp_sendto, peer_id
+
+
+def hook_endpoint(dispersy, endpoint):
+    """Install the VisualDispersy hooks on an endpoint, reporting
+        for some (Visual)Dispersy object.
+        The hooks only use the StandaloneEndpoint internals
+        (_ip, _port, _loop, _socket, _sendqueue and
+        dispersythread_data_came_in), so they can also be installed
+        on compatible fakes, see benchmarks/endpoint_hooks.py.
+
+        Hooks into:
+            - Endpoint socket data loop: to establish local port (/peer id)
+            - Endpoint packet handler: to log data between peer ids
+    """
+    endpoint_class = endpoint.__class__
+
+    # Eavesdrop on the listen server connection accepting loop
+    pt_ep_loop = endpoint._loop
+    funcType = type(StandaloneEndpoint._loop)
+
+    def epLoopMim(eself):
+        dispersy.myid = peer_id(eself)  # The port can change at this point, update it accordingly
+        dispersy.vz_endpoint_open = True
+        dispersy.vz_report_process()
+        pt_ep_loop()
+    endpoint._loop = funcType(epLoopMim, endpoint, endpoint_class)
+
+    # Eavesdrop on the packet delegator
+    pt_ep_data_came_in = endpoint.dispersythread_data_came_in
+    funcType = type(StandaloneEndpoint.dispersythread_data_came_in)
+
+    def epPacketRcvMim(eself, packets, timestamp, cache=True):
+        fakepackets = []
+        for sock_addr, data in packets:
+            if data.startswith("dpvizidrq"):
+                # On an id request, log our id sending to the id of the
+                # requester
+                community_name = data[9:data.index(',')]
+                oid = data[data.index(',') + 1:]
+                report_event(
+                    VD_EVT_COMMUNICATION(
+                        dispersy.myid,
+                        oid,
+                        community_name))
+            else:
+                # On normal data, request the other's id so we can log
+                # communication
+                try:
+                    if data[22] != chr(248):  # dispersy-identity has no community
+                        community_name = type(
+                            dispersy.get_community(data[2:22],
+                                                   False,
+                                                   False)).__name__
+                        request = "dpvizidrq" + \
+                            community_name + "," + dispersy.myid
+                        if isinstance(eself, LoopbackEndpoint):
+                            eself.sendto(request, sock_addr)
+                        else:
+                            udp_sendto(eself, request, sock_addr)
+                except CommunityNotFoundException:
+                    pass  # We have discovered external communities, ignore these
+
+                fakepackets.append((sock_addr, data))
+        # If the incoming packets are more than VisualDispersy id requests
+        # forward them to the actual Dispersy object.
+        if len(fakepackets) > 0:
+            pt_ep_data_came_in(fakepackets, timestamp, cache)
+    endpoint.dispersythread_data_came_in = funcType(
+        epPacketRcvMim, endpoint, endpoint_class)
+
+
+class VisualStream:
+
+    """Forward messages from an iterable (e.g. a generator) in chunks
+        at a target rate, scheduled on the reactor.
+        Only one chunk of messages exists at a time, and the reactor
+        is free between chunks.
+    """
+
+    def __init__(self, messages, forward, rate=0.0, chunk=100,
+                 report=None, report_interval=5.0):
+        """Initialize fields.
+            The forward function is called with lists of messages.
+            With rate 0, chunks are forwarded as fast as possible.
+            The report function is called with this stream every
+            report_interval seconds and once done.
+        """
+        self.messages = iter(messages)      # Messages still to forward
+        self.forward = forward              # Function forwarding a chunk
+        self.rate = float(rate)             # Target messages per second
+        self.chunk = chunk                  # Messages per forward call
+        self.report = report                # Progress callback, if any
+        self.report_interval = report_interval
+        self.sent = 0                       # Messages forwarded so far
+        self.started = None                 # Time of the first chunk
+        self.finished = None                # Time of the last chunk
+        self.lastreport = 0.0               # Time of the last report
+        self.deferred = defer.Deferred()    # Fires with this stream once done
+
+    def start(self):
+        """Start streaming, from any thread.
+            Returns a Deferred firing with this stream once done.
+        """
+        reactor.callFromThread(self._step)
+        return self.deferred
+
+    def elapsed(self):
+        """Seconds since the first chunk (until the last).
+        """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def achieved_rate(self):
+        """Messages per second achieved so far.
+        """
+        elapsed = self.elapsed()
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def _step(self):
+        """Forward the next chunk and schedule the one after it.
+        """
+        now = time.time()
+        if self.started is None:
+            self.started = self.lastreport = now
+        chunk = list(itertools.islice(self.messages, self.chunk))
+        if chunk:
+            self.forward(chunk)
+            self.sent = self.sent + len(chunk)
+        now = time.time()
+        if len(chunk) < self.chunk:
+            self.finished = now
+            if self.report:
+                self.report(self)
+            self.deferred.callback(self)
+            return
+        if self.report and now - self.lastreport >= self.report_interval:
+            self.lastreport = now
+            self.report(self)
+        delay = 0.0
+        if self.rate > 0:
+            delay = max(0.0, self.started + self.sent / self.rate - now)
+        reactor.callLater(delay, self._step)
 
 
 class VisualCommunity(Community):
@@ -17,12 +167,88 @@ class VisualCommunity(Community):
     """Community object to inherit from when creating custom communities.
     """
 
+    def vz_stream(self, messages, rate=0.0, chunk=100, forward=None):
+        """Store, update and forward messages from an iterable (e.g.
+            a generator) in chunks, at a target rate (messages per
+            second, 0 for as fast as possible), without blocking the
+            reactor. The achieved versus target rate is printed
+            while streaming.
+            Returns a Deferred firing with the VisualStream once done.
+        """
+        if forward is None:
+            def forward(chunk):
+                self.dispersy.store_update_forward(chunk, True, True, True)
+
+        def report(stream):
+            print "%s] Streamed %d messages in %.1fs: %.1f msgs/s (target %s)" % (
+                self.dispersy.myid, stream.sent, stream.elapsed(),
+                stream.achieved_rate(), "%.1f msgs/s" % stream.rate if stream.rate else "none")
+        return VisualStream(messages, forward, rate, chunk, report).start()
+
+    def vz_barrier(self, name, count):
+        """Wait at the barrier of some name until count peers
+            reached it, without blocking the reactor.
+            Returns a Deferred firing on the reactor thread once
+            the barrier opened, or failing if the VisualServer can no
+            longer open it.
+        """
+        deferred = defer.Deferred()
+
+        def opened(values):
+            if values is None:
+                reactor.callFromThread(deferred.errback,
+                                       Exception("VisualServer closed before barrier %s opened" % name))
+            else:
+                reactor.callFromThread(deferred.callback, name)
+        request(VD_REQ_BARRIER(self.dispersy.myid, name, count),
+                ('BAR', name), opened)
+        return deferred
+
+    def vz_wait_for_candidates(self, count):
+        """Wait until this community has count verified
+            candidates, checked whenever an introduction request or
+            response was handled.
+            Returns a Deferred firing on the reactor thread with the
+            verified candidates.
+        """
+        deferred = defer.Deferred()
+        self._vz_candidate_waiters = getattr(self, "_vz_candidate_waiters", []) + [(count, deferred)]
+        reactor.callFromThread(self._vz_check_candidates)
+        return deferred
+
+    def _vz_check_candidates(self):
+        """Fire the candidate waiters whose count was reached.
+        """
+        waiters = getattr(self, "_vz_candidate_waiters", [])
+        if not waiters:
+            return
+        candidates = list(self.dispersy_yield_verified_candidates())
+        self._vz_candidate_waiters = [(count, deferred) for count, deferred in waiters
+                                      if count > len(candidates)]
+        for count, deferred in waiters:
+            if count <= len(candidates):
+                deferred.callback(candidates)
+
+    def on_introduction_request(self, *args, **kwargs):
+        """Overwritten to check the candidate waiters
+        """
+        result = super(VisualCommunity, self).on_introduction_request(*args, **kwargs)
+        self._vz_check_candidates()
+        return result
+
+    def on_introduction_response(self, *args, **kwargs):
+        """Overwritten to check the candidate waiters
+        """
+        result = super(VisualCommunity, self).on_introduction_response(*args, **kwargs)
+        self._vz_check_candidates()
+        return result
+
     def vz_report_target(self, target_name, current, target):
         """Report to the VisualServer that some target has changed
             value.
         """
         report_event(
-            VD_CUSTOM_TARGET(self.dispersy.lan_address[1],
+            VD_CUSTOM_TARGET(self.dispersy.myid,
                              target_name,
                              current,
                              target))
@@ -33,7 +259,7 @@ class VisualCommunity(Community):
             Note that this method BLOCKS until the server allows
             the exit.
         """
-        report_event(VD_EVT_END(self.dispersy.lan_address[1]))
+        report_event(VD_EVT_END(self.dispersy.myid))
 
 
 class VisualDispersy(Dispersy):
@@ -41,13 +267,42 @@ class VisualDispersy(Dispersy):
     """Dispersy object to initialize instead of normal Dispersy.
     """
 
-    def vz_init_server_connection(self, port):
+    def vz_init_server_connection(self, port, host=None):
         """Initialize the connection to a VisualServer.
-            This is always on localhost, so it doesn't require
-            a server ip. This would have to change to
-            support remote VisualServers.
+            The server host defaults to the DISPERSYVIZ_SERVER_HOST
+            variable (set by the launcher), or localhost.
+        """
+        if host is None:
+            host = os.environ.get("DISPERSYVIZ_SERVER_HOST", "127.0.0.1")
+        init_reporter((host, port))
+        self.vz_report_process()
+
+    def vz_master_key(self, name, generate=None):
+        """Agree on a key of some name with all peers, through the
+            VisualServer. With a generate function, offer the key
+            it returns, for in case no peer offered one before.
+            Note that this method BLOCKS until some peer offered a
+            key, so call it before the reactor runs or in a thread.
+            Returns the agreed key, or None if the VisualServer can
+            no longer reply.
+        """
+        offer = generate() if generate else ""
+        values = request_blocking(VD_REQ_KEY(self.myid, name, offer), ('KEY', name))
+        return values[0] if values else None
+
+    def vz_on_shutdown(self, callback):
+        """Call a function (from the reporter thread) when the
+            VisualServer shuts down before the experiment ended.
+        """
+        visualreporter.singleton_reporter.on_shutdown(callback)
+
+    def vz_report_process(self):
+        """Report the OS process we run in to the VisualServer.
+            Our id is only final once the endpoint is open, so
+            this waits for both the endpoint and the connection.
         """
-        init_reporter(('0.0.0.0', port))
+        if self.vz_endpoint_open and visualreporter.singleton_reporter:
+            report_event(VD_EVT_PROCESS(self.myid, os.getpid()))
 
     def __init__(
         self,
@@ -55,71 +310,14 @@ class VisualDispersy(Dispersy):
      working_directory,
      database_filename=u"dispersy.db",
      crypto=ECCrypto()):
-        """Provide hooks into the endpoint, otherwise equal to
-            the normal Dispersy() constructor.
-
-            Hooks into:
-                - Endpoint socket data loop: to establish local port (/peer id)
-                - Endpoint packet handler: to log data between peer ids
-        """
-        self.myid = endpoint._port
-
-        # Eavesdrop on the listen server connection accepting loop
-        pt_ep_loop = endpoint._loop
-        funcType = type(StandaloneEndpoint._loop)
-
-        def epLoopMim(eself):
-            self.myid = eself._port  # This can change at this point, update it accordingly
-            pt_ep_loop()
-        endpoint._loop = funcType(epLoopMim, endpoint, StandaloneEndpoint)
-
-        # Eavesdrop on the packet delegator
-        pt_ep_data_came_in = endpoint.dispersythread_data_came_in
-        funcType = type(StandaloneEndpoint.dispersythread_data_came_in)
-
-        def epPacketRcvMim(eself, packets, timestamp, cache=True):
-            fakepackets = []
-            for sock_addr, data in packets:
-                if data.startswith("dpvizidrq"):
-                    # On an id request, log our id sending to the id of the
-                    # requester
-                    community_name = data[9:data.index(',')]
-                    oid = int(data[data.index(',') + 1:])
-                    report_event(
-                        VD_EVT_COMMUNICATION(
-                            self.myid,
-                            oid,
-                            community_name))
-                else:
-                    # On normal data, request the other's id so we can log
-                    # communication
-                    try:
-                        if data[22] != chr(248):  # dispersy-identity has no community
-                            community_name = type(
-                                self.get_community(data[2:22],
-                                                   False,
-                                                   False)).__name__
-                            request = "dpvizidrq" + \
-                                community_name + "," + str(self.myid)
-                            try:
-                                eself._socket.sendto(request, sock_addr)
-                            except socket.error:
-                                with eself._sendqueue_lock:
-                                    did_have_senqueue = bool(eself._sendqueue)
-                                    eself._sendqueue.append(
-                                        (time(), candidate.sock_addr, request))
-                                if not did_have_senqueue:
-                                    eself._process_sendqueue()
-                    except CommunityNotFoundException:
-                        pass  # We have discovered external communities, ignore these
-
-                    fakepackets.append((sock_addr, data))
-            # If the incoming packets are more than VisualDispersy id requests
-            # forward them to the actual Dispersy object.
-            if len(fakepackets) > 0:
-                pt_ep_data_came_in(fakepackets, timestamp, cache)
-        endpoint.dispersythread_data_came_in = funcType(
-            epPacketRcvMim, endpoint, StandaloneEndpoint)
+        """Provide hooks into the endpoint (see hook_endpoint),
+            otherwise equal to the normal Dispersy() constructor.
+            A LoopbackEndpoint also delivers the id requests to
+            co-hosted peers in-process.
+        """
+        self.myid = peer_id(endpoint)
+        self.vz_endpoint_open = False
+        hook_endpoint(self, endpoint)
 
         # Actually init Dispersy with our modified endpoint
         super(
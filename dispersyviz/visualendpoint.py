@@ -0,0 +1,168 @@
+"""In-process loopback endpoint for co-hosted peers.
+
+When multiple peers are hosted in the same process (see launcher),
+packets between them do not need to go through the UDP stack: the
+LoopbackEndpoint hands the packet strings directly to the receiving
+endpoint's packet handler on the reactor thread. Packets for peers
+elsewhere still go over UDP, so it is a drop-in replacement for
+the StandaloneEndpoint.
+
+Peers are identified by "host:port" strings (see peer_id), so peers
+on different hosts, or bound to different loopback addresses, never
+collide.
+"""
+
+import os
+import socket
+import threading
+from time import time
+
+from twisted.internet import reactor
+from twisted.python.threadable import isInIOThread
+from dispersy.endpoint import StandaloneEndpoint
+
+LOCAL_HOSTS = set(["127.0.0.1", "0.0.0.0", "localhost"])
+
+_loopback_endpoints = {}
+    # Open loopback endpoints in this process
+    # {(str/bound ip,int/port):LoopbackEndpoint}
+
+
+def peer_port_base(default=10000):
+    """The first port to try for peer endpoints.
+        Runs in parallel (see dispersyviz_batch) each get their own
+        port range through the DISPERSYVIZ_PEER_PORT variable.
+    """
+    return int(os.environ.get("DISPERSYVIZ_PEER_PORT", default))
+
+
+def peer_host(default="0.0.0.0"):
+    """The address to bind peer endpoints to.
+        The launcher can give every process its own (loopback)
+        address through the DISPERSYVIZ_PEER_HOST variable.
+    """
+    return os.environ.get("DISPERSYVIZ_PEER_HOST", default)
+
+
+def peer_id(endpoint):
+    """The identifier of the peer of an endpoint, "host:port".
+        The host is the bound address, or the host name for
+        endpoints bound to all addresses.
+    """
+    host = getattr(endpoint, "_ip", "0.0.0.0")
+    if host in ("0.0.0.0", ""):
+        host = socket.gethostname()
+    return "%s:%d" % (host, endpoint._port)
+
+
+def lookup_loopback(sock_addr):
+    """Get the co-hosted endpoint for some socket address, or None
+        if it lives in another process.
+    """
+    endpoint = _loopback_endpoints.get((sock_addr[0], sock_addr[1]))
+    if endpoint is not None:
+        return endpoint
+    endpoint = _loopback_endpoints.get(("0.0.0.0", sock_addr[1]))
+    if endpoint is None:
+        return None
+    if sock_addr[0] in LOCAL_HOSTS or sock_addr[0] == endpoint._loopback_host():
+        return endpoint
+    return None
+
+
+def udp_sendto(endpoint, data, sock_addr):
+    """Send data over the UDP socket of an endpoint, queueing it
+        if the socket is not ready.
+    """
+    try:
+        endpoint._socket.sendto(data, sock_addr)
+    except socket.error:
+        with endpoint._sendqueue_lock:
+            did_have_senqueue = bool(endpoint._sendqueue)
+            endpoint._sendqueue.append((time(), sock_addr, data))
+        if not did_have_senqueue:
+            endpoint._process_sendqueue()
+
+
+class LoopbackEndpoint(StandaloneEndpoint):
+
+    """Endpoint delivering packets to co-hosted peers in-process,
+        and over UDP to all other peers.
+    """
+
+    def __init__(self, port, ip="0.0.0.0"):
+        """Initialize the endpoint, equal to the StandaloneEndpoint
+            constructor.
+        """
+        super(LoopbackEndpoint, self).__init__(port, ip)
+        self._loopback_lock = threading.Lock()
+        self._loopback_queue = []
+            # Packets waiting for delivery [(LoopbackEndpoint/target,str/data)]
+        self.loopback_packets = 0   # Packets delivered in-process
+        self.udp_packets = 0        # Packets sent over UDP
+
+    def _loopback_host(self):
+        """The host other peers see our packets coming from.
+        """
+        if self._ip != "0.0.0.0":
+            return self._ip
+        if self._dispersy:
+            return self._dispersy.lan_address[0]
+        return "127.0.0.1"
+
+    def open(self, dispersy):
+        """Open the socket and register for in-process delivery.
+        """
+        result = super(LoopbackEndpoint, self).open(dispersy)
+        _loopback_endpoints[(self._ip, self._port)] = self
+        return result
+
+    def close(self, timeout=10.0):
+        """Unregister and close the socket.
+        """
+        if _loopback_endpoints.get((self._ip, self._port)) is self:
+            del _loopback_endpoints[(self._ip, self._port)]
+        return super(LoopbackEndpoint, self).close(timeout)
+
+    def send_packet(self, candidate, packet, prefix=None):
+        """Send a packet to a candidate, in-process if possible.
+        """
+        data = prefix + packet if prefix else packet
+        # Keep the statistics of the endpoint we replace
+        self._total_up += len(data)
+        self._total_send += 1
+        self.sendto(data, candidate.sock_addr)
+        return True
+
+    def sendto(self, data, sock_addr):
+        """Send raw data to a socket address, in-process if possible.
+        """
+        target = lookup_loopback(sock_addr)
+        if target is None:
+            self.udp_packets = self.udp_packets + 1
+            udp_sendto(self, data, sock_addr)
+            return
+        with self._loopback_lock:
+            schedule = not self._loopback_queue
+            self._loopback_queue.append((target, data))
+        if schedule:
+            if isInIOThread():
+                reactor.callLater(0, self._deliver)
+            else:
+                reactor.callFromThread(self._deliver)
+
+    def _deliver(self):
+        """Hand all queued packets to their targets, one batch per
+            target, on the reactor thread.
+        """
+        with self._loopback_lock:
+            queue, self._loopback_queue = self._loopback_queue, []
+        batches = {}
+        for target, data in queue:
+            batches.setdefault(target, []).append(data)
+        source = (self._loopback_host(), self._port)
+        timestamp = time()
+        for target, packets in batches.iteritems():
+            self.loopback_packets = self.loopback_packets + len(packets)
+            target.dispersythread_data_came_in(
+                [(source, data) for data in packets], timestamp)
@@ -0,0 +1,353 @@
+"""Recording and offline rendering of VisualServer runs.
+
+A VisualServer started with --record FILE writes a timeline of the
+deltas of its model (see visualweb) to FILE: one line per flush with
+the seconds since the recording started and the JSON delta, starting
+with the full state. This module replays such a timeline and renders
+one community as a sequence of PNG frames with the offscreen (cairo)
+graph_draw, optionally piped into ffmpeg for a video.
+
+Frames are rendered by a process pool, in ranges of consecutive
+frames. Every worker parses the timeline once and replays it
+incrementally, so a range only costs its own deltas and frames, and
+frames in which nothing changed are copied instead of drawn. Like
+the graph windows, a frame shows the edges which carried any
+communication since the previous frame.
+
+Usage:
+    python dispersyviz/visualexport.py run.timeline --output frames --fps 10 --video run.mp4
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+from graph_tool.all import *
+
+from visualweb import model_deltas
+from visuallayout import ring_layout
+
+FRAME = "frame-%06d.png"
+    # File name of a frame in the output directory
+DEFAULT_COLOR = [0.640625, 0, 0, 0.9]
+    # Fill color of nodes without any progress
+DEFAULT_OUTLINE = [0.3, 0.3, 0.3, 1.0]
+    # Outline color of nodes without any process samples
+
+
+class TimelineRecorder:
+
+    """Write the deltas of a VisualModel to a timeline file.
+    """
+
+    def __init__(self, model, filename):
+        """Initialize fields.
+        """
+        self.model = model          # VisualModel to record
+        self.filename = filename    # File name to write the timeline to
+        self.deltas = None          # DeltaStream we are a sink of
+        self.file = None            # Timeline file, while recording
+        self.started = None         # Time the recording started
+        self.closed = threading.Event()
+            # Set once the timeline file is complete
+
+    def start(self):
+        """Start recording, with the current state of the model.
+        """
+        self.deltas = model_deltas(self.model)
+        self.model.call_in_model(self._open)
+
+    def stop(self):
+        """Stop recording, after the changes queued so far.
+        """
+        self.model.call_in_model(self._close)
+
+    def wait(self, timeout=5.0):
+        """Block until the timeline file is complete, after stopping.
+        """
+        self.closed.wait(timeout)
+
+    def _open(self):
+        """Open the timeline file and become a sink. Model thread only.
+        """
+        self.file = open(self.filename, 'w')
+        self.started = time.time()
+        self.write(self.deltas.full(self.model))
+        self.deltas.sinks.append(self.write)
+
+    def _close(self):
+        """Write the last changes and close the timeline file.
+            Model thread only.
+        """
+        if self.file:
+            self.deltas.flush(self.model)
+            self.deltas.sinks.remove(self.write)
+            self.file.close()
+            self.file = None
+        self.closed.set()
+
+    def write(self, data):
+        """Append a delta to the timeline. Model thread only.
+        """
+        self.file.write("%.3f\t%s\n" % (time.time() - self.started, data))
+
+
+def load_timeline(filename):
+    """Parse a timeline file into [(float/seconds,dict/delta)].
+        A truncated last line, of a server which did not exit
+        cleanly, is left out.
+    """
+    timeline = []
+    with open(filename) as f:
+        for line in f:
+            seconds, _, data = line.partition("\t")
+            try:
+                timeline.append((float(seconds), json.loads(data)))
+            except ValueError:
+                break
+    return timeline
+
+
+def first_community(timeline):
+    """The name of the first community in a timeline, or None.
+    """
+    for _, delta in timeline:
+        for name in delta.get('communities', ()):
+            return name
+    return None
+
+
+class FrameRenderer:
+
+    """Replay of a timeline for a single community, drawing frames
+        along the way. Lives in a worker process.
+    """
+
+    def __init__(self, timeline, community, size=(800, 800), labels=True):
+        """Initialize fields.
+        """
+        self.timeline = timeline    # Timeline to replay [(float/seconds,dict/delta)]
+        self.community = community  # Name of the community to draw
+        self.size = size            # Frame size in pixels (width, height)
+        self.labels = labels        # Draw the node labels
+        self.reset()
+
+    def reset(self):
+        """Start replaying from the beginning.
+        """
+        self.position = 0           # Index of the next delta to apply
+        self.time = None            # Time replayed up to, None before the start
+        self.graph = Graph()
+        self.pos = None             # Ring layout, if still valid
+        self.vlabels = self.graph.new_vp("string")
+        self.vcolors = self.graph.new_vp("vector<float>")
+        self.voutlines = self.graph.new_vp("vector<float>")
+        self.outlined = False       # Any node has an outline color
+        self.vertices = {}
+            # Vertex per node identifier {str/node_id:int/vertex}
+        self.counts = {}
+            # Total communications per edge {(int/from,int/to):int/count}
+        self.nodelabels = {}
+            # Label per node identifier {str/node_id:str/label}
+        self.nodecolors = {}
+            # Fill color per node identifier {str/node_id:[float]}
+        self.nodeoutlines = {}
+            # Outline color per node identifier {str/node_id:[float]}
+
+    def advance(self, until):
+        """Apply all deltas up to some time.
+            Returns the edges which carried communications on the
+            way {(int/from,int/to)}, and if any delta was applied.
+        """
+        flashes = set()
+        applied = False
+        while (self.position < len(self.timeline)
+               and self.timeline[self.position][0] <= until):
+            self.apply(self.timeline[self.position][1], flashes)
+            self.position = self.position + 1
+            applied = True
+        self.time = until
+        return flashes, applied
+
+    def apply(self, delta, flashes):
+        """Apply a single delta, adding the edges which carried
+            communications to flashes.
+        """
+        styled = set()
+        for name, vertex, pid in delta.get('nodes', ()):
+            if name != self.community:
+                continue
+            while self.graph.num_vertices() <= vertex:
+                self.pos = None
+                v = self.graph.add_vertex()
+                self.vcolors[v] = DEFAULT_COLOR
+                self.voutlines[v] = DEFAULT_OUTLINE
+            self.vertices[pid] = vertex
+            styled.add(pid)
+        for name, fv, tv, count in delta.get('edges', ()):
+            if name == self.community and count > self.counts.get((fv, tv), 0):
+                self.counts[(fv, tv)] = count
+                flashes.add((fv, tv))
+        for key, values in (('labels', self.nodelabels), ('colors', self.nodecolors),
+                            ('outlines', self.nodeoutlines)):
+            changes = delta.get(key, {})
+            values.update(changes)
+            styled.update(changes)
+        if delta.get('outlines'):
+            self.outlined = True
+        for pid in styled:
+            if pid in self.vertices:
+                v = self.graph.vertex(self.vertices[pid])
+                self.vlabels[v] = self.nodelabels.get(pid, pid)
+                self.vcolors[v] = self.nodecolors.get(pid, DEFAULT_COLOR)
+                self.voutlines[v] = self.nodeoutlines.get(pid, DEFAULT_OUTLINE)
+
+    def render(self, filename, flashes):
+        """Draw the current state, with some edges, to a PNG file.
+        """
+        graph = self.graph
+        graph.clear_edges()
+        graph.add_edge_list(sorted(flashes))
+        if self.pos is None:
+            self.pos = ring_layout(graph)
+        vprops = {'fill_color': self.vcolors, 'size': 10}
+        if self.labels:
+            vprops['text'] = self.vlabels
+            vprops['text_position'] = 0
+        if self.outlined:
+            vprops['color'] = self.voutlines
+            vprops['pen_width'] = 2.5
+        graph_draw(graph, pos=self.pos, vprops=vprops, bg_color=[1, 1, 1, 1],
+                   output_size=self.size, output=filename, fmt="png")
+
+
+_renderer = None
+    # FrameRenderer of a worker process
+
+
+def _init_worker(filename, community, size, labels):
+    """Load the timeline once per worker process.
+    """
+    global _renderer
+    _renderer = FrameRenderer(load_timeline(filename), community, size, labels)
+
+
+def render_range(job):
+    """Render the frames [first, last) of the timeline of this
+        worker process into a directory. Frame n shows the state at
+        n / fps seconds.
+        Returns (int/first, int/last, int/frames drawn).
+    """
+    first, last, fps, directory = job
+    renderer = _renderer
+    before = (first - 1) / float(fps)
+    if renderer.time is not None and renderer.time > before:
+        renderer.reset()
+    if first > 0:
+        # Skip to the end of the previous frame
+        renderer.advance(before)
+    drawn = 0
+    previous = None
+    flashed = False
+    for frame in range(first, last):
+        flashes, applied = renderer.advance(frame / float(fps))
+        filename = os.path.join(directory, FRAME % frame)
+        if previous and not applied and not flashed:
+            shutil.copyfile(previous, filename)
+        else:
+            renderer.render(filename, flashes)
+            drawn = drawn + 1
+        previous = filename
+        flashed = bool(flashes)
+    return first, last, drawn
+
+
+def export(filename, directory, fps=10, community=None, size=(800, 800),
+           labels=True, workers=None, chunk=50, video=None):
+    """Render a timeline as PNG frames into a directory, and into
+        a video with ffmpeg if given a video file name.
+        Returns (int/frames, int/frames drawn, float/seconds taken).
+    """
+    timeline = load_timeline(filename)
+    if not timeline:
+        raise ValueError("empty timeline: %s" % filename)
+    community = community or first_community(timeline)
+    if community is None:
+        raise ValueError("no communities in timeline: %s" % filename)
+    frames = int(timeline[-1][0] * fps) + 1
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    start = time.time()
+    encoder = None
+    if video:
+        encoder = subprocess.Popen(
+            [find_executable("ffmpeg"), '-y', '-loglevel', 'error',
+             '-f', 'image2pipe', '-framerate', str(fps), '-c:v', 'png', '-i', '-',
+             '-pix_fmt', 'yuv420p', video],
+            stdin=subprocess.PIPE)
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(), _init_worker,
+                                (filename, community, size, labels))
+    jobs = [(first, min(frames, first + chunk), fps, directory)
+            for first in range(0, frames, chunk)]
+    drawn = 0
+    try:
+        # Ranges come back in order, so they can be encoded right away
+        for first, last, count in pool.imap(render_range, jobs):
+            drawn = drawn + count
+            if encoder:
+                for frame in range(first, last):
+                    with open(os.path.join(directory, FRAME % frame), 'rb') as f:
+                        encoder.stdin.write(f.read())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if encoder:
+            encoder.stdin.close()
+            encoder.wait()
+    return frames, drawn, time.time() - start
+
+
+def main():
+    """Render a timeline from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Render a recorded Visual Dispersy run")
+    parser.add_argument("timeline", help="timeline file written by visualserver.py --record")
+    parser.add_argument("--output", default="frames",
+                        help="directory to write the PNG frames to")
+    parser.add_argument("--fps", type=int, default=10,
+                        help="frames per second of the run")
+    parser.add_argument("--community", default=None,
+                        help="community to draw (default: the first one)")
+    parser.add_argument("--size", default="800x800",
+                        help="frame size in pixels, WIDTHxHEIGHT")
+    parser.add_argument("--no-labels", action="store_true",
+                        help="do not draw the node labels, which is faster")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of render processes (default: one per CPU)")
+    parser.add_argument("--chunk", type=int, default=50,
+                        help="frames per rendering job")
+    parser.add_argument("--video", default=None,
+                        help="also encode the frames into this video file with ffmpeg")
+    args = parser.parse_args()
+    try:
+        size = tuple([int(value) for value in args.size.split("x")])
+    except ValueError:
+        size = ()
+    if len(size) != 2:
+        parser.error("invalid --size: %s" % args.size)
+    if args.video and not find_executable("ffmpeg"):
+        parser.error("--video needs ffmpeg on the PATH")
+    frames, drawn, seconds = export(args.timeline, args.output, args.fps, args.community,
+                                    size, not args.no_labels, args.workers, args.chunk,
+                                    args.video)
+    print "Rendered %d frames (%d drawn) in %.1fs, %.1fx the recorded time" % (
+        frames, drawn, seconds, frames / float(args.fps) / max(seconds, 1e-6))
+
+if __name__ == "__main__":
+    main()
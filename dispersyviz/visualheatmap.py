@@ -0,0 +1,76 @@
+"""Adjacency-matrix heatmap view of a community.
+
+Instead of drawing every node and edge, the communication counts
+between all peers are shown as a single peer x peer image, so the
+cost of a frame does not depend on the amount of edges.
+"""
+
+import numpy
+import cairo
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+
+
+def heatmap_pixels(matrix):
+    """Convert a count matrix to ARGB32 pixels on a logarithmic
+        scale [none ~ most]:[black -> red -> yellow].
+    """
+    counts = numpy.log1p(matrix.astype(numpy.float64))
+    top = counts.max()
+    if top > 0:
+        counts = counts / top
+    red = numpy.minimum(counts * 2.0, 1.0)
+    green = numpy.clip(counts * 2.0 - 1.0, 0.0, 1.0)
+    pixels = (numpy.uint32(0xff000000)
+              | ((red * 255).astype(numpy.uint32) << 16)
+              | ((green * 255).astype(numpy.uint32) << 8))
+    return numpy.ascontiguousarray(pixels, dtype=numpy.uint32)
+
+
+class HeatmapWindow(Gtk.Window):
+
+    """Window showing the communication matrix of a community.
+        Rows are senders, columns are receivers, both in order
+        of vertex index.
+    """
+
+    def __init__(self, size=(600, 600)):
+        """Initialize the drawing area.
+        """
+        Gtk.Window.__init__(self)
+        self.set_default_size(*size)
+        self.surface = None     # Image of the current matrix
+        self.pixels = None      # Pixel buffer backing the surface
+        self.area = Gtk.DrawingArea()
+        self.area.connect("draw", self.on_draw)
+        self.add(self.area)
+
+    def set_matrix(self, matrix):
+        """Replace the shown matrix and schedule a redraw.
+        """
+        if matrix.shape[0] == 0:
+            return
+        self.pixels = heatmap_pixels(matrix)
+        height, width = self.pixels.shape
+        # ARGB32 rows are whole pixels, so never padded
+        stride = cairo.ImageSurface.format_stride_for_width(
+            cairo.FORMAT_ARGB32, width)
+        self.surface = cairo.ImageSurface.create_for_data(
+            self.pixels, cairo.FORMAT_ARGB32, width, height, stride)
+        self.area.queue_draw()
+
+    def on_draw(self, widget, cr):
+        """Blit the matrix image, scaled to the window.
+        """
+        cr.set_source_rgb(0, 0, 0)
+        cr.paint()
+        if not self.surface:
+            return
+        allocation = widget.get_allocation()
+        cr.scale(float(allocation.width) / self.surface.get_width(),
+                 float(allocation.height) / self.surface.get_height())
+        cr.set_source_surface(self.surface, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_NEAREST)
+        cr.paint()
@@ -0,0 +1,151 @@
+"""Force-directed layouts, computed in a separate process.
+
+The renderer hands the edge set of a community to a LayoutWorker
+whenever it changed significantly, and keeps drawing with the
+previous positions until the worker is done. Each new layout is
+warm-started from the previous positions, so nodes only move as
+much as the structure of the overlay changes.
+"""
+
+import math
+import Queue
+import random
+import multiprocessing
+from graph_tool.all import *
+
+
+def ring_layout(graph, radius=10.0):
+    """Layout the nodes evenly over a left half of
+        a circle and a right half, with a separation
+        between the two halves.
+    """
+    totalvs = graph.num_vertices()
+    pmap = graph.new_vertex_property("vector<float>")
+    if totalvs == 0:
+        return pmap
+    if totalvs == 1:
+        for v in graph.vertices():
+            pmap[v] = [1.0, 1.0]
+    else:
+        num = 0
+        for v in graph.vertices():
+            rads = 2.0 * math.pi / totalvs * num
+            num = num + 1
+            x = radius * math.cos(rads)
+            y = radius * math.sin(rads)
+            pmap[v] = [x + 0.3 * (radius if x > 0 else -radius), y]
+    return pmap
+
+
+def sfdp_worker(jobs, results):
+    """Main loop of the layout process.
+        Jobs are (str/community_name, int/vertices, [(int/from,int/to)],
+        [(float/x,float/y)]/previous_positions) tuples, or None to exit.
+        Results are (str/community_name, [(float/x,float/y)]) tuples.
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        name, numvertices, edges, previous = job
+        graph = Graph()
+        graph.add_vertex(numvertices)
+        graph.add_edge_list(edges)
+        pos = None
+        if previous:
+            # Warm start, new vertices start around the center
+            pos = graph.new_vertex_property("vector<double>")
+            cx = sum([p[0] for p in previous]) / len(previous)
+            cy = sum([p[1] for p in previous]) / len(previous)
+            for v in graph.vertices():
+                if int(v) < len(previous):
+                    pos[v] = previous[int(v)]
+                else:
+                    pos[v] = [cx + random.uniform(-1.0, 1.0),
+                              cy + random.uniform(-1.0, 1.0)]
+        pos = sfdp_layout(graph, pos=pos)
+        results.put((name, [tuple(pos[v]) for v in graph.vertices()]))
+
+
+class LayoutWorker:
+
+    """Object to manage the layout process for a Visualizer.
+        All methods are called from the Gtk thread and never block:
+        there is at most one job per community in progress.
+    """
+
+    def __init__(self, threshold=0.1):
+        """Start the layout process.
+            A community is laid out again once its amount of
+            vertices changed, or its amount of distinct edges
+            changed by more than the threshold fraction.
+        """
+        self.threshold = threshold
+        self.positions = {}
+            # Last computed positions per community name
+            # {str/community_name:[(float/x,float/y)]}
+        self.laidout = {}
+            # (vertices, edges) of the last requested layout per community name
+        self.pending = set()
+            # Community names with a layout in progress
+        self.fresh = set()
+            # Community names with a finished layout which was not drawn yet
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=sfdp_worker,
+                                               args=(self.jobs, self.results),
+                                               name="LayoutWorker")
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        """Tell the layout process to exit.
+        """
+        self.jobs.put(None)
+
+    def poll(self):
+        """Collect finished layouts.
+            Returns the names of communities with fresh positions.
+        """
+        try:
+            while True:
+                name, positions = self.results.get_nowait()
+                self.positions[name] = positions
+                self.pending.discard(name)
+                self.fresh.add(name)
+        except Queue.Empty:
+            pass
+        return self.fresh
+
+    def update(self, name, numvertices, edges):
+        """Request a new layout if the graph changed significantly.
+            The edges are the distinct edges of the community.
+        """
+        if name in self.pending or numvertices == 0:
+            return
+        lastvertices, lastedges = self.laidout.get(name, (0, 0))
+        if (numvertices == lastvertices
+                and abs(len(edges) - lastedges) <= self.threshold * lastedges):
+            return
+        self.laidout[name] = (numvertices, len(edges))
+        self.pending.add(name)
+        self.jobs.put((name, numvertices, edges, self.positions.get(name)))
+
+    def layout(self, name, graph, fallback):
+        """Get a position property map for a graph.
+            Vertices without a computed position yet are placed
+            by the fallback layout, until the worker catches up.
+        """
+        self.fresh.discard(name)
+        positions = self.positions.get(name)
+        if not positions:
+            return fallback(graph)
+        pmap = graph.new_vertex_property("vector<float>")
+        cx = sum([p[0] for p in positions]) / len(positions)
+        cy = sum([p[1] for p in positions]) / len(positions)
+        for v in graph.vertices():
+            if int(v) < len(positions):
+                pmap[v] = positions[int(v)]
+            else:
+                pmap[v] = [cx, cy]
+        return pmap
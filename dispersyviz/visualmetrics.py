@@ -0,0 +1,244 @@
+"""Self-metrics of a VisualServer.
+
+Every counter has a single writer (the model thread, a client
+thread or the Gtk thread), so none of them need a lock, and reports
+are gathered on the reading thread, without waiting for the model
+thread. The graph sizes are read from the ones the model thread
+publishes. The MetricsEndpoint serves them on a local HTTP port:
+ - /metrics: Prometheus text format
+ - /metrics.json: JSON
+"""
+
+import json
+import time
+import resource
+import threading
+import BaseHTTPServer
+
+
+class ConnectionMetrics:
+
+    """Counters of a single client connection.
+        Only written by the thread reading this connection.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.bytes = 0          # Bytes received
+        self.queue_wait = 0.0   # Seconds spent queueing events for the model
+
+
+class ServerMetrics:
+
+    """Object to collect the counters of a VisualServer and
+        derive the reported metrics from them.
+    """
+
+    def __init__(self, model):
+        """Initialize fields.
+        """
+        self.model = model
+            # VisualModel to read queue depths and graph sizes from
+        self.events = {'CON': 0, 'COM': 0, 'CTM': 0, 'END': 0}
+            # Events per event type, only written by the model thread
+        self.connections = {}
+            # Counters per client address {str/address:ConnectionMetrics}
+        self.update_view_time = 0.0     # Seconds spent in redraws
+        self.update_view_count = 0      # Amount of redraws
+        self.last_update_view = 0.0     # Seconds spent in the last redraw
+        self.started = time.time()      # Server start time
+        self.sample = (self.started, {}, {})
+            # Counters at the start of the rate window (time, events, bytes)
+        self.rates = ({}, {})
+            # Rates over the last full window (events/s, bytes/s)
+        self.rateslock = threading.Lock()
+            # Guards the rate window, reports are gathered by the
+            # HTTP thread and the model thread (for the results)
+
+    def connection(self, address):
+        """Get the counters for a new client connection.
+            The address is either a (host, port) tuple or a string.
+        """
+        if isinstance(address, tuple):
+            address = "%s:%d" % address[:2]
+        counters = ConnectionMetrics()
+        self.connections[address] = counters
+        return counters
+
+    def count_event(self, event_type, count=1):
+        """Count events of some type. Model thread only.
+        """
+        self.events[event_type] = self.events.get(event_type, 0) + count
+
+    def count_update_view(self, seconds):
+        """Count a redraw taking some amount of seconds. Gtk thread only.
+        """
+        self.update_view_time = self.update_view_time + seconds
+        self.update_view_count = self.update_view_count + 1
+        self.last_update_view = seconds
+
+    def _rss(self):
+        """The resident set size of this process in bytes.
+        """
+        try:
+            with open('/proc/self/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except IOError:
+            pass
+        # Peak instead of current, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _update_rates(self):
+        """Derive the rates over a window of at least a second.
+            Returns (events/s, bytes/s).
+        """
+        with self.rateslock:
+            now = time.time()
+            events = dict(self.events)
+            received = dict([(address, counters.bytes) for address, counters
+                             in self.connections.items()])
+            then, oldevents, oldreceived = self.sample
+            if now - then >= 1.0:
+                elapsed = now - then
+                self.rates = (
+                    dict([(event_type, (count - oldevents.get(event_type, 0)) / elapsed)
+                          for event_type, count in events.iteritems()]),
+                    dict([(address, (count - oldreceived.get(address, 0)) / elapsed)
+                          for address, count in received.iteritems()]))
+                self.sample = (now, events, received)
+            return self.rates
+
+    def report(self):
+        """Gather all metrics in a dictionary. Thread safe.
+        """
+        model = self.model
+        # Before anything else, so it is not taken after a backlog
+        queued = model.events.qsize()
+        rates = self._update_rates()
+        communities = model.sizes
+        connections = {}
+        for address, counters in self.connections.items():
+            connections[address] = {
+                'bytes': counters.bytes,
+                'bytes_per_second': rates[1].get(address, 0.0),
+                'queue_wait_seconds': counters.queue_wait,
+            }
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'events': dict(self.events),
+            'events_per_second': dict(rates[0]),
+            'connections': connections,
+            'event_queue': queued,
+            'model_apply_seconds': model.applytime,
+            'update_view_seconds': self.update_view_time,
+            'update_view_count': self.update_view_count,
+            'update_view_last_seconds': self.last_update_view,
+            'queue_wait_seconds': sum([c['queue_wait_seconds']
+                                       for c in connections.values()]),
+            'communities': communities,
+            'rss_bytes': self._rss(),
+        }
+
+    def prometheus(self, report):
+        """Format a report in the Prometheus text format.
+        """
+        lines = []
+
+        def metric(name, kind, helptext, samples):
+            lines.append("# HELP visualserver_%s %s" % (name, helptext))
+            lines.append("# TYPE visualserver_%s %s" % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    labels = "{" + ",".join(['%s="%s"' % (key, str(val).replace('"', '\\"'))
+                                             for key, val in labels]) + "}"
+                lines.append("visualserver_%s%s %r" % (name, labels or "", float(value)))
+
+        metric("events_total", "counter", "Events received per type.",
+               [((("type", t),), v) for t, v in report['events'].iteritems()])
+        metric("events_per_second", "gauge", "Events received per second per type.",
+               [((("type", t),), v) for t, v in report['events_per_second'].iteritems()])
+        metric("connection_bytes_total", "counter", "Bytes received per connection.",
+               [((("connection", a),), c['bytes']) for a, c in report['connections'].iteritems()])
+        metric("connection_bytes_per_second", "gauge", "Bytes received per second per connection.",
+               [((("connection", a),), c['bytes_per_second']) for a, c in report['connections'].iteritems()])
+        metric("queue_wait_seconds_total", "counter", "Time client threads waited to queue events.",
+               [((), report['queue_wait_seconds'])])
+        metric("event_queue_depth", "gauge", "Event batches waiting for the model thread.",
+               [((), report['event_queue'])])
+        metric("model_apply_seconds_total", "counter", "Time the model thread spent applying events.",
+               [((), report['model_apply_seconds'])])
+        metric("update_view_seconds_total", "counter", "Time spent redrawing.",
+               [((), report['update_view_seconds'])])
+        metric("update_view_total", "counter", "Amount of redraws.",
+               [((), report['update_view_count'])])
+        metric("update_view_last_seconds", "gauge", "Time spent in the last redraw.",
+               [((), report['update_view_last_seconds'])])
+        metric("edgequeue_depth", "gauge", "Edges waiting to be drawn per community.",
+               [((("community", n),), c['edgequeue']) for n, c in report['communities'].iteritems()])
+        metric("graph_vertices", "gauge", "Vertices per community graph.",
+               [((("community", n),), c['vertices']) for n, c in report['communities'].iteritems()])
+        metric("graph_edges", "gauge", "Distinct edges per community graph.",
+               [((("community", n),), c['edges']) for n, c in report['communities'].iteritems()])
+        metric("rss_bytes", "gauge", "Resident set size of the server process.",
+               [((), report['rss_bytes'])])
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve the metrics of the ServerMetrics of our server.
+    """
+
+    def do_GET(self):
+        """Answer /metrics and /metrics.json requests.
+        """
+        metrics = self.server.metrics
+        if self.path not in ('/metrics', '/metrics.json'):
+            self.send_error(404)
+            return
+        report = metrics.report()
+        if self.path == '/metrics':
+            body = metrics.prometheus(report)
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            body = json.dumps(report, indent=2, sort_keys=True)
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Do not log every scrape.
+        """
+        pass
+
+
+class MetricsEndpoint:
+
+    """Local HTTP endpoint for the metrics of a VisualServer.
+    """
+
+    def __init__(self, metrics, port):
+        """Bind the HTTP server to localhost on some port.
+        """
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', port),
+                                               MetricsRequestHandler)
+        self.httpd.metrics = metrics
+
+    def start(self):
+        """Serve in a thread.
+        """
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  name="MetricsEndpoint")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop serving.
+        """
+        self.httpd.shutdown()
@@ -0,0 +1,481 @@
+"""Graph model of an experiment, owned by a single thread.
+
+Client threads never touch the graphs: they only push decoded
+events onto the model queue (post_events). The model thread
+applies them in order and publishes consistent snapshots of the
+changed graphs for the renderer (request_snapshot/take_snapshot).
+"""
+
+import threading
+import Queue
+import time
+import math
+import numpy
+from graph_tool.all import *
+
+
+class Snapshot:
+
+    """Consistent copy of the changed community graphs.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.graphs = {}
+            # Graph copy per community name, including the edges
+            # since the last snapshot {str/community_name:Graph}
+        self.vlabels = {}
+            # Vertex labels per community name {str/community_name:PropertyMap}
+        self.vcolors = {}
+            # Vertex colors per community name {str/community_name:PropertyMap}
+        self.voutlines = {}
+            # Vertex outline colors per community name, once processes
+            # are sampled {str/community_name:PropertyMap}
+        self.matrices = {}
+            # Communication count matrix per community name, in the
+            # heatmap view {str/community_name:numpy.ndarray}
+        self.vsizes = {}
+            # Vertex sizes per collapsed community name {str/community_name:PropertyMap}
+        self.epenwidths = {}
+            # Edge widths per collapsed community name {str/community_name:PropertyMap}
+        self.groups = {}
+            # Group name per vertex (None for single peers) per collapsed
+            # community name {str/community_name:[str/group_name]}
+        self.throughput = {}
+            # Events per second, oldest first, per community name
+            # {str/community_name:[float]}
+        self.edges = {}
+            # Distinct edges per community name, for the layout
+            # {str/community_name:[(int/from,int/to)]}
+        self.time = time.time()     # Time of creation
+
+
+class VisualModel:
+
+    """Object to manage the graph data of all communities.
+
+        All methods, except for post_events, call_in_model,
+        request_snapshot and take_snapshot, should only be
+        called from the model thread.
+    """
+
+    def __init__(self, view="graph", clusterer=None, series=None):
+        """Initialize fields.
+            The view is either "graph", for snapshots of the graphs,
+            "heatmap", for snapshots of the count matrices, or None
+            for a headless model, which buffers no edges to draw.
+            Graphs are collapsed by the clusterer once they grow
+            large enough, if there is one.
+            With a SeriesStore, event rates are kept and shown.
+        """
+        self.view = view            # Kind of snapshots to publish
+        self.clusterer = clusterer  # Clusterer for large graphs, if any
+        self.series = series        # SeriesStore for event rates, if any
+        self.deltas = None          # DeltaStream of a web renderer, if any
+        self.graphs = {}
+            # Graph per community name {str/community_name:Graph}
+        self.vertices = {}
+            # Vertex per community name for a node identifier
+            # {str/node_id:{str/community_name:Vertex}}
+        self.vlabels = {}
+            # Vertex labels per community name (formatted vtargets)
+            # {str/community_name:PropertyMap}
+        self.vcolors = {}
+            # Vertex colors per community name {str/community_name:PropertyMap}
+        self.vtargets = {}
+            # Vertex targets per node identifier
+            # {str/node_id:{str/target_name:str/value}}
+        self.vprogress = {}
+            # Vertex completion per node identifier {str/node_id:float/pct}
+        self.vload = {}
+            # CPU fraction of the process per node identifier {str/node_id:float}
+        self.vstraggling = set()
+            # Node identifiers which stopped progressing
+        self.voutlines = {}
+            # Vertex outline colors per community name {str/community_name:PropertyMap}
+        self.edgequeue = {}
+            # Edge buffer per community name
+            # {str/community_name:[(int/from,int/to)]}
+        self.edgecounts = {}
+            # Total communications per edge per community name
+            # {str/community_name:{(int/from,int/to):int/count}}
+        self.matrices = {}
+            # Communication count matrix per community name, only in
+            # the heatmap view {str/community_name:numpy.ndarray}
+        self.dirty = set()
+            # Community names which changed since their last snapshot
+        self.dirtynodes = set()
+            # Node identifiers whose targets or completion changed
+        self.dirtycharts = set()
+            # Community names whose throughput chart moved on
+        self.stalenodes = {}
+            # Node identifiers whose label and color still need to be
+            # regenerated per community name {str/community_name:set}
+        self.events = Queue.Queue()
+            # Batches of events [(callable, args)] for the model thread
+        self.snapshots = Queue.Queue()
+            # Published snapshots for the renderer
+        self.wanted = None
+            # Community names to leave out of the requested snapshot,
+            # None if no snapshot was requested
+        self.applytime = 0.0
+            # Seconds the model thread spent applying events
+        self.sizes = {}
+            # Sizes per community name, published for other threads
+            # {str/community_name:{'vertices':int,'edges':int,'edgequeue':int}}
+        self.sizestime = 0.0    # Time the sizes were last published
+        self.sizesinterval = 0.5    # Seconds between publishing the sizes
+        self.alive = True   # Model thread is running
+
+    def start(self):
+        """Start the model thread.
+        """
+        thread = threading.Thread(target=self.run, name="VisualModel")
+        thread.daemon = True
+        thread.start()
+        if self.series:
+            thread = threading.Thread(target=self._tick_series, name="SeriesTicker")
+            thread.daemon = True
+            thread.start()
+
+    def _tick_series(self):
+        """Have the model thread advance the sparklines every second.
+        """
+        while self.alive:
+            time.sleep(1.0)
+            self.call_in_model(self.advance_sparklines)
+
+    def advance_sparklines(self):
+        """Refresh the labels of the nodes whose sparklines changed,
+            and the throughput charts, which also move on without
+            events.
+        """
+        for name, pid in self.series.tick():
+            self.dirtynodes.add(pid)
+        self.dirtycharts.update(self.series.tick_throughput())
+
+    def stop(self):
+        """Stop the model thread after the queued events.
+        """
+        self.events.put(None)
+
+    def post_events(self, events):
+        """Queue a batch of events [(callable, args)] to be
+            applied by the model thread. Thread safe.
+        """
+        self.events.put(events)
+
+    def call_in_model(self, function, *args):
+        """Queue a single call for the model thread. Thread safe.
+        """
+        self.events.put([(function, args)])
+
+    def run(self):
+        """Apply queued events until stopped.
+        """
+        while self.alive:
+            try:
+                events = self.events.get(timeout=self.sizesinterval)
+            except Queue.Empty:
+                events = []
+            if events is None:
+                break
+            start = time.time()
+            for function, args in events:
+                try:
+                    function(*args)
+                except Exception as e:
+                    # Input was thusly maimed, we cannot recover,
+                    # but the other clients still need this thread
+                    print "Model event %s failed: %r" % (
+                        getattr(function, '__name__', function), e)
+            if self.wanted is not None and self.is_dirty():
+                try:
+                    self.publish_snapshot()
+                except Exception as e:
+                    print "Model snapshot failed: %r" % e
+            if time.time() - self.sizestime >= self.sizesinterval:
+                self.publish_sizes()
+            self.applytime = self.applytime + time.time() - start
+        self.alive = False
+
+    def publish_sizes(self):
+        """Publish the sizes of all community graphs, replacing
+            the previous ones at once.
+        """
+        self.sizes = dict([(name, {'vertices': graph.num_vertices(),
+                                   'edges': len(self.edgecounts.get(name, {})),
+                                   'edgequeue': len(self.edgequeue.get(name, []))})
+                           for name, graph in self.graphs.iteritems()])
+        self.sizestime = time.time()
+
+    def request_snapshot(self, hidden=()):
+        """Ask the model thread to publish a snapshot of the
+            changed graphs, as soon as there are any. Thread safe.
+        """
+        self.call_in_model(self._set_wanted, set(hidden))
+
+    def take_snapshot(self):
+        """Get the most recently published snapshot, or None.
+            Thread safe.
+        """
+        snapshot = None
+        try:
+            while True:
+                snapshot = self.snapshots.get_nowait()
+        except Queue.Empty:
+            pass
+        return snapshot
+
+    def _set_wanted(self, hidden):
+        """Register a snapshot request.
+        """
+        self.wanted = hidden
+
+    def is_dirty(self):
+        """Check if any community changed since its last snapshot.
+        """
+        if self.dirty or self.dirtynodes or self.dirtycharts:
+            return True
+        for name in self.edgequeue:
+            if self.edgequeue[name]:
+                return True
+        return False
+
+    def publish_snapshot(self):
+        """Copy all changed graphs of visible windows and hand
+            them to the renderer.
+        """
+        hidden = self.wanted
+        self.wanted = None
+        self.refresh_nodes(hidden)
+        snapshot = Snapshot()
+        dirty = self.dirty
+        self.dirty = set()
+        charts = self.dirtycharts
+        self.dirtycharts = set()
+        for name in self.graphs:
+            if self.series and name not in hidden and (
+                    (name in dirty) or (name in charts) or self.edgequeue[name]):
+                snapshot.throughput[name] = self.series.throughput(name)
+            if name in hidden:
+                # Redrawn when the window is restored
+                self.edgequeue[name] = []
+            elif self.view == "heatmap" and name in dirty:
+                size = self.graphs[name].num_vertices()
+                snapshot.matrices[name] = self.matrices[name][:size, :size].copy()
+            elif self.clusterer and self.clusterer.applies(self.graphs[name]) and (
+                    (name in dirty) or self.edgequeue[name]):
+                self.clusterer.collapse(self, name, snapshot)
+                if self.edgequeue[name]:
+                    self.edgequeue[name] = []
+                    # Redraw once more to clear these edges again
+                    self.dirty.add(name)
+            elif (name in dirty) or self.edgequeue[name]:
+                graph = self.graphs[name].copy()
+                snapshot.edges[name] = self.edgecounts[name].keys()
+                snapshot.vlabels[name] = graph.own_property(
+                    self.vlabels[name].copy())
+                snapshot.vcolors[name] = graph.own_property(
+                    self.vcolors[name].copy())
+                if self.vload:
+                    snapshot.voutlines[name] = graph.own_property(
+                        self.voutlines[name].copy())
+                if self.edgequeue[name]:
+                    graph.add_edge_list(self.edgequeue[name])
+                    if self.series:
+                        # Edge width follows the current rate
+                        widths = graph.new_ep("double")
+                        for e in graph.edges():
+                            widths[e] = 1 + math.log1p(self.series.edge_rate(
+                                name, int(e.source()), int(e.target())))
+                        snapshot.epenwidths[name] = widths
+                    self.edgequeue[name] = []
+                    # Redraw once more to clear these edges again
+                    self.dirty.add(name)
+                snapshot.graphs[name] = graph
+        self.snapshots.put(snapshot)
+
+    def expand_group(self, name, group):
+        """Drill down into a group of a collapsed community, or
+            collapse it again for None.
+        """
+        if self.clusterer:
+            self.clusterer.expand(name, group)
+            self.mark_dirty(name)
+
+    def mark_dirty(self, name):
+        """Force a community to be part of the next snapshot.
+        """
+        if name in self.graphs:
+            self.dirty.add(name)
+
+    def assert_community(self, name):
+        """Make sure we own a graph and vertex property maps for some community name.
+        """
+        if name not in self.graphs:
+            self.edgequeue[name] = []
+            self.edgecounts[name] = {}
+            self.graphs[name] = Graph()
+            self.vlabels[name] = self.graphs[name].new_vp("string")
+            self.vcolors[name] = self.graphs[name].new_vp("vector<float>")
+            self.voutlines[name] = self.graphs[name].new_vp("vector<float>")
+            self.stalenodes[name] = set()
+            if self.deltas:
+                self.deltas.community(name)
+            if self.view == "heatmap":
+                self.matrices[name] = numpy.zeros((16, 16), dtype=numpy.uint32)
+            self.dirty.add(name)
+
+    def assert_node(self, pid):
+        """Make sure a node exists in the graphs.
+        """
+        # Check if in all graphs
+        if not str(pid) in self.vertices:
+            self.vertices[str(pid)] = {}
+            self.set_target_value(str(pid), "id", str(pid))
+        for name in self.graphs:
+            if not name in self.vertices[str(pid)]:
+                self.vertices[str(pid)][name] = self.graphs[name].add_vertex()
+                self.stalenodes[name].add(str(pid))
+                if self.deltas:
+                    self.deltas.node(name, str(pid), int(self.vertices[str(pid)][name]))
+                self.dirty.add(name)
+
+    def format_node_label(self, pid):
+        """Take the current targets and generate a node label.
+        """
+        return ", ".join([target_name + ": " + value for target_name, value
+                          in self.vtargets[str(pid)].iteritems()])
+
+    def format_node_color(self, pid):
+        """Take the current completion and generate a node
+            color [0.0 ~ 1.0]:[red -> green], or amber for
+            stragglers.
+        """
+        if str(pid) in self.vstraggling:
+            return [0.9, 0.6, 0, 0.9]
+        pct = self.vprogress.get(str(pid), 0.0)
+        return [(1 - pct) * 0.640625, pct * 0.640625, 0, 0.9]
+
+    def format_node_outline(self, pid):
+        """Take the current CPU use of the process of a node and
+            generate an outline color [idle ~ busy]:[gray -> magenta].
+        """
+        load = min(1.0, self.vload[str(pid)])
+        return [0.3 + 0.6 * load, 0.3 * (1 - load), 0.3 + 0.6 * load, 1.0]
+
+    def set_node_text(self, community, pid, text):
+        """Set the node label for a certain community.
+        """
+        self.vlabels[community][self.vertices[str(pid)][community]] = text
+        self.dirty.add(community)
+
+    def set_node_color(self, community, pid, color):
+        """Set the node color for a certain community.
+        """
+        self.vcolors[community][self.vertices[str(pid)][community]] = color
+        self.dirty.add(community)
+
+    def set_process_sample(self, pid, cpu, rss, threads):
+        """Show a resource sample of the process of some node.
+        """
+        self.set_target_value(str(pid), "cpu", "%d%%" % (cpu * 100))
+        self.set_target_value(str(pid), "rss", "%.1fMB" % (rss / 1048576.0))
+        self.set_target_value(str(pid), "threads", str(threads))
+        self.vload[str(pid)] = cpu
+
+    def set_straggler(self, pid, stalled):
+        """Flag a node which made no progress for some seconds,
+            or unflag it with None.
+        """
+        if stalled is None:
+            self.vstraggling.discard(str(pid))
+            self.vtargets.get(str(pid), {}).pop("stalled", None)
+            self.dirtynodes.add(str(pid))
+            if self.deltas:
+                self.deltas.node_changed(str(pid))
+        else:
+            self.vstraggling.add(str(pid))
+            self.set_target_value(str(pid), "stalled", "%ds" % stalled)
+
+    def set_target_value(self, pid, target, value):
+        """Set a certain target value for some node.
+        """
+        if not str(pid) in self.vtargets:
+            self.vtargets[str(pid)] = {}
+        self.vtargets[str(pid)][target] = value
+        self.dirtynodes.add(str(pid))
+        if self.deltas:
+            self.deltas.node_changed(str(pid))
+
+    def draw_communication(self, fromid, toid, community, count=1):
+        """Queue drawing an edge in a certain community, for
+            some amount of communications over it.
+        """
+        fv = int(self.vertices[str(fromid)][community])
+        tv = int(self.vertices[str(toid)][community])
+        if self.view == "heatmap":
+            # The matrix holds these edges
+            self.dirty.add(community)
+        elif self.view:
+            self.edgequeue[community].append((fv, tv))
+        edge = (fv, tv)
+        self.edgecounts[community][edge] = self.edgecounts[
+            community].get(edge, 0) + int(count)
+        if self.deltas:
+            self.deltas.edge(community, fv, tv)
+        if self.series:
+            self.series.count(community, str(fromid), str(toid), fv, tv, int(count))
+            self.dirtynodes.add(str(fromid))
+            self.dirtynodes.add(str(toid))
+        if self.view == "heatmap":
+            matrix = self.matrices[community]
+            if max(fv, tv) >= matrix.shape[0]:
+                # Grow by doubling, so resizes stay rare
+                size = 2 * (max(fv, tv) + 1)
+                grown = numpy.zeros((size, size), dtype=numpy.uint32)
+                grown[:matrix.shape[0], :matrix.shape[1]] = matrix
+                matrix = self.matrices[community] = grown
+            matrix[fv, tv] += int(count)
+
+    def draw_node_finish(self, pid, pct=1.0):
+        """Color a node for a certain percentage [0.0 ~ 1.0]:[red -> green].
+            The color is only applied on the next snapshot.
+        """
+        self.vprogress[str(pid)] = pct
+        self.dirtynodes.add(str(pid))
+        if self.deltas:
+            self.deltas.node_changed(str(pid))
+
+    def refresh_nodes(self, hidden=()):
+        """Regenerate the labels and colors of all changed nodes,
+            for the communities which are not hidden.
+            Labels are formatted at most once per node per call.
+        """
+        changed = self.dirtynodes
+        self.dirtynodes = set()
+        labels = {}
+        for name in self.graphs:
+            stale = self.stalenodes[name]
+            stale.update(changed)
+            if (name in hidden) or (not stale):
+                continue
+            for pid in stale:
+                if pid not in self.vertices or name not in self.vertices[pid]:
+                    continue
+                if pid not in labels:
+                    labels[pid] = self.format_node_label(pid)
+                label = labels[pid]
+                if self.series:
+                    sparklines = self.series.node_sparklines(name, pid)
+                    if sparklines:
+                        label = label + "\n" + sparklines
+                self.set_node_text(name, pid, label)
+                if pid in self.vprogress or pid in self.vstraggling:
+                    self.set_node_color(name, pid, self.format_node_color(pid))
+                if pid in self.vload:
+                    self.voutlines[name][self.vertices[pid][name]] = \
+                        self.format_node_outline(pid)
+            stale.clear()
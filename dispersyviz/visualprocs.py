@@ -0,0 +1,137 @@
+"""Resource sampling of the peer processes of an experiment.
+
+Peers report the OS process they run in (PID events). A sampler
+thread reads the CPU time, resident set size and thread count of
+these processes from /proc at a fixed interval and hands the
+samples to the model thread, which shows them in the node labels
+and outlines and keeps their peaks for the results of the run.
+Peers hosted in the same process share its samples.
+"""
+
+import os
+import time
+import threading
+
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+
+def read_process(ospid):
+    """Read the resources of a process from /proc.
+        Returns (float/cpu_seconds, int/rss_bytes, int/threads), or
+        None if the process does not exist (anymore).
+    """
+    try:
+        with open('/proc/%d/stat' % ospid) as stat:
+            # The fields after the command name, starting at the state
+            fields = stat.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss = 0
+        with open('/proc/%d/status' % ospid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+        threads = len(os.listdir('/proc/%d/task' % ospid))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return cpu, rss, threads
+
+
+class ProcessStats:
+
+    """Summary of the samples of a single process.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.samples = 0        # Amount of samples
+        self.cpu_total = 0.0    # Sum of the sampled CPU fractions
+        self.cpu_max = 0.0      # Highest sampled CPU fraction
+        self.rss_first = None   # First sampled RSS (bytes)
+        self.rss_last = 0       # Last sampled RSS (bytes)
+        self.rss_max = 0        # Highest sampled RSS (bytes)
+        self.threads_max = 0    # Highest sampled thread count
+
+    def add(self, cpu, rss, threads):
+        """Add a sample.
+        """
+        self.samples = self.samples + 1
+        self.cpu_total = self.cpu_total + cpu
+        self.cpu_max = max(self.cpu_max, cpu)
+        if self.rss_first is None:
+            self.rss_first = rss
+        self.rss_last = rss
+        self.rss_max = max(self.rss_max, rss)
+        self.threads_max = max(self.threads_max, threads)
+
+    def report(self):
+        """Gather the summary in a dictionary.
+        """
+        return {
+            'samples': self.samples,
+            'cpu_mean': self.cpu_total / self.samples if self.samples else 0.0,
+            'cpu_max': self.cpu_max,
+            'rss_max_bytes': self.rss_max,
+            'rss_growth_bytes': self.rss_last - (self.rss_first or 0),
+            'threads_max': self.threads_max,
+        }
+
+
+class ProcessSampler:
+
+    """Thread sampling the processes of the peers of a VisualServer.
+        Reads the reported processes of the server and posts the
+        samples to its apply_process_samples on the model thread.
+    """
+
+    def __init__(self, server, interval=1.0):
+        """Initialize fields.
+        """
+        self.server = server        # VisualServer with the peer processes
+        self.interval = interval    # Seconds between samples
+        self.last = {}
+            # Previous CPU time per process {int/ospid:(float/time,float/cpu_seconds)}
+        self.alive = True
+
+    def start(self):
+        """Start sampling in a thread.
+        """
+        thread = threading.Thread(target=self.run, name="ProcessSampler")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop sampling.
+        """
+        self.alive = False
+
+    def run(self):
+        """Sample until stopped.
+        """
+        while self.alive:
+            time.sleep(self.interval)
+            samples = self.sample()
+            if samples and self.alive:
+                self.server.model.call_in_model(
+                    self.server.apply_process_samples, samples)
+
+    def sample(self):
+        """Sample all reported processes once.
+            Returns {int/ospid:(float/cpu_fraction,int/rss_bytes,int/threads)}
+        """
+        samples = {}
+        for ospid in set(dict(self.server.processes).values()):
+            now = time.time()
+            resources = read_process(ospid)
+            if resources is None:
+                self.last.pop(ospid, None)
+                continue
+            cpu_seconds, rss, threads = resources
+            then, last_seconds = self.last.get(ospid, (None, None))
+            self.last[ospid] = (now, cpu_seconds)
+            if then is None or now <= then:
+                continue
+            samples[ospid] = ((cpu_seconds - last_seconds) / (now - then),
+                              rss, threads)
+        return samples
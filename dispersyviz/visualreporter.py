@@ -7,9 +7,23 @@ The following events are available:
  - VD_EVT_COMMUNICATION: when two nodes interact
  - VD_CUSTOM_TARGET: when an arbitrary goal is updated
  - VD_EVT_END: when this client wants to exit
+ - VD_EVT_PROCESS: which OS process a client runs in
+ - VD_REQ_KEY: to agree on a (master) key with all clients
+ - VD_REQ_BARRIER: when reaching a barrier all clients wait at
+Servers can decode received data with split_events.
+A process hosting multiple peers shares a single reporter, which
+multiplexes their events over one connection.
+
+Servers reply over the same connection, with events framed the same
+way (TYPE + name[,value];):
+ - END: the experiment ended, all clients may exit
+ - KEY: the agreed key of some name
+ - BAR: all clients reached the barrier of some name
+ - STP: the server shuts down, before the experiment ended
 """
 
 import socket
+import threading
 
 
 def VD_EVT_CONNECT(myid, community_name):
@@ -38,15 +52,53 @@ def VD_EVT_END(myid):
     """
     return "END" + str(myid)
 
+
+def VD_EVT_PROCESS(myid, ospid):
+    """Signal which OS process some id runs in, for
+        resource sampling
+    """
+    return "PID" + str(myid) + "," + str(ospid)
+
+
+def VD_REQ_KEY(myid, name, offer=""):
+    """Request the key of some name, offering a key to use if
+        no client offered one before. Replied to with KEY.
+    """
+    return "KEY" + str(myid) + "," + name + "," + offer
+
+
+def VD_REQ_BARRIER(myid, name, count):
+    """Signal some id reached the barrier of some name, which
+        opens once count ids reached it. Replied to with BAR.
+    """
+    return "BAR" + str(myid) + "," + name + "," + str(count)
+
+
+def split_events(data):
+    """Split received data into complete events and the
+        incomplete remainder.
+        Returns ([(str/event_type, [str/field])], str/remainder)
+    """
+    lpos = data.rfind(';')
+    if lpos < 0:
+        return [], data
+    events = []
+    for gdata in data[:lpos].split(';'):
+        if gdata:
+            events.append((gdata[:3], gdata[3:].split(',')))
+    return events, data[lpos + 1:]
+
 singleton_reporter = None
 
 
 def init_reporter(sock_addr):
-    """Define the signal sink socket address
+    """Define the signal sink socket address.
+        Every call registers a (hosted) peer with the reporter.
     """
     global singleton_reporter
     if not singleton_reporter:
         singleton_reporter = VisualReporter(sock_addr)
+    singleton_reporter.add_peer()
 
 
 def report_event(event):
@@ -56,10 +108,39 @@ def report_event(event):
     singleton_reporter.report_event(event)
 
 
+def request(event, reply, callback):
+    """Report a signal the server replies to, and call back with
+        the values of the reply, from the reporter thread.
+        The reply is (str/event_type, str/name).
+        If the server can no longer reply, call back with None.
+    """
+    global singleton_reporter
+    singleton_reporter.expect(reply, callback)
+    singleton_reporter.report_event(event)
+
+
+def request_blocking(event, reply):
+    """Report a signal the server replies to and block until it
+        replied.
+        Returns the values of the reply, or None if the server can
+        no longer reply.
+    """
+    done = threading.Event()
+    values = []
+
+    def received(reply_values):
+        values.append(reply_values)
+        done.set()
+    request(event, reply, received)
+    done.wait()
+    return values[0]
+
+
 class VisualReporter:
 
     """Class to wrap a (sending) socket for communication
         with a VisualServer.
+        Safe to use from multiple threads and for multiple peers.
     """
 
     def __init__(self, sock_addr):
@@ -67,21 +148,113 @@ class VisualReporter:
         """
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect(sock_addr)
+        self._sendlock = threading.Lock()
+        self._endlock = threading.Lock()
+        self._replylock = threading.Lock()
         self.open = True
+        self.peers = 0          # Hosted peers which did not end yet
+        self.released = False   # Whether the server confirmed the end
+        self.replies = {}
+            # Values per received reply {(str/event_type,str/name):[str/value]}
+        self.expected = {}
+            # Callbacks per awaited reply {(str/event_type,str/name):[function]}
+        self.shutdown_callbacks = []
+            # Functions to call when the server shuts down
+        self.receiving = True   # Whether replies can still arrive
+        self.receiver = threading.Thread(target=self._receive,
+                                         name="VisualReporter")
+        self.receiver.daemon = True
+        self.receiver.start()
+
+    def add_peer(self):
+        """Register a peer reporting over this connection.
+        """
+        with self._endlock:
+            self.peers = self.peers + 1
+
+    def expect(self, reply, callback):
+        """Call back with the values of a reply (str/event_type,
+            str/name) once received, or with None if the server can
+            no longer reply.
+        """
+        with self._replylock:
+            if reply not in self.replies and self.receiving:
+                self.expected.setdefault(reply, []).append(callback)
+                return
+            values = self.replies.get(reply)
+        callback(values)
+
+    def on_shutdown(self, callback):
+        """Call a function when the server shuts down before the
+            experiment ended.
+        """
+        self.shutdown_callbacks.append(callback)
+
+    def _receive(self):
+        """Receive the replies of the server, until it closes.
+        """
+        buffered = ''
+        while True:
+            try:
+                data = self._socket.recv(4096)
+            except socket.error:
+                data = None
+            if not data:
+                break
+            events, buffered = split_events(buffered + data)
+            for event_type, content in events:
+                if event_type == 'STP':
+                    for callback in list(self.shutdown_callbacks):
+                        callback()
+                    continue
+                reply = (event_type, content[0])
+                with self._replylock:
+                    self.replies[reply] = content[1:]
+                    callbacks = self.expected.pop(reply, [])
+                for callback in callbacks:
+                    callback(content[1:])
+        # No more replies will come
+        with self._replylock:
+            self.receiving = False
+            expected = self.expected
+            self.expected = {}
+        for callbacks in expected.values():
+            for callback in callbacks:
+                callback(None)
 
     def report_event(self, event):
         """Send a string over the socket connection.
             If the string contains an END event, busy wait
             for the server to send the end confirmation.
-            After confirmation, close the socket and return.
+            After confirmation of the last hosted peer, close
+            the socket and return.
         """
-        if self.open:
-            try:
+        if not self.open:
+            return
+        try:
+            with self._sendlock:
                 self._socket.sendall(event + ";")
-                if event.startswith('END'):
-                    self.open = False
-                    self._socket.recv(8)
-                    self._socket.close()
-            except socket.error:
+            if event.startswith('END'):
+                self._wait_for_end()
+        except socket.error:
+            self.open = False
+            print "[WARNING] Trying to report to unreachable VisualServer"
+
+    def _wait_for_end(self):
+        """Block until the server confirms the end of the experiment.
+            The confirmation is for all peers at once.
+        """
+        done = threading.Event()
+        self.expect(('END', ''), lambda values: done.set())
+        done.wait()
+        with self._endlock:
+            self.released = True
+            self.peers = self.peers - 1
+            if self.peers <= 0:
                 self.open = False
-                print "[WARNING] Trying to report to unreachable VisualServer"
+                try:
+                    # Also wakes up the receiving thread
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                self._socket.close()
@@ -0,0 +1,228 @@
+"""Fixed-size time series of event rates.
+
+Every node (incoming and outgoing), edge and community gets a
+ring buffer of events per second, backed by an array, so the
+memory use stays constant over an experiment of any length.
+"""
+
+import array
+import time
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+
+SPARKS = [u"\u2581", u"\u2582", u"\u2583", u"\u2584",
+          u"\u2585", u"\u2586", u"\u2587", u"\u2588"]
+
+
+def sparkline(values):
+    """Format values as a (UTF-8 encoded) sparkline string.
+    """
+    top = max(values) if values else 0
+    if top <= 0:
+        return (SPARKS[0] * len(values)).encode("utf-8")
+    return u"".join([SPARKS[int(value * (len(SPARKS) - 1) / top)]
+                     for value in values]).encode("utf-8")
+
+
+class RingSeries:
+
+    """Events per second over the last size seconds.
+    """
+
+    def __init__(self, size):
+        """Initialize an empty buffer.
+        """
+        self.counts = array.array('d', [0.0]) * size
+            # Events per second, indexed by absolute second modulo size
+        self.last = 0   # Absolute second of the newest slot
+
+    def _advance(self, second):
+        """Clear the slots of the seconds between the newest slot
+            and some new second.
+        """
+        if second <= self.last:
+            return
+        size = len(self.counts)
+        for s in xrange(max(self.last + 1, second - size + 1), second + 1):
+            self.counts[s % size] = 0.0
+        self.last = second
+
+    def add(self, second, count=1):
+        """Count events in some (absolute) second.
+        """
+        self._advance(second)
+        self.counts[second % len(self.counts)] += count
+
+    def history(self, second):
+        """The events per second of the full seconds before some
+            second, oldest first.
+        """
+        self._advance(second)
+        size = len(self.counts)
+        return [self.counts[s % size] for s in xrange(second - size + 1, second)]
+
+    def active(self, second, span=None):
+        """Check if there were any events in the buffered seconds,
+            or in the last span seconds up to some second.
+        """
+        self._advance(second)
+        if span is None:
+            return any(self.counts)
+        size = len(self.counts)
+        return any([self.counts[s % size]
+                    for s in xrange(second - min(span, size) + 1, second + 1)])
+
+
+class SeriesStore:
+
+    """Object to keep the rate series of a VisualModel.
+        Only used by the model thread.
+    """
+
+    def __init__(self, size=60, sparkwidth=12):
+        """Initialize fields.
+        """
+        self.size = size                # Seconds per series
+        self.sparkwidth = sparkwidth    # Seconds per sparkline
+        self.received = {}
+            # Incoming events per node per community {(str/community_name,str/node_id):RingSeries}
+        self.sent = {}
+            # Outgoing events per node per community {(str/community_name,str/node_id):RingSeries}
+        self.edges = {}
+            # Events per edge per community {(str/community_name,int/from,int/to):RingSeries}
+        self.communities = {}
+            # Events per community {str/community_name:RingSeries}
+        self.shown = set()
+            # Nodes with a sparkline {(str/community_name,str/node_id)}
+        self.charted = set()
+            # Communities with events in their throughput chart {str/community_name}
+
+    def _series(self, table, key):
+        """Get or create the series for some key.
+        """
+        series = table.get(key)
+        if series is None:
+            series = table[key] = RingSeries(self.size)
+        return series
+
+    def count(self, community, fromid, toid, fv, tv, count=1):
+        """Count communication over an edge in a community.
+        """
+        second = int(time.time())
+        self._series(self.sent, (community, fromid)).add(second, count)
+        self._series(self.received, (community, toid)).add(second, count)
+        self._series(self.edges, (community, fv, tv)).add(second, count)
+        self._series(self.communities, community).add(second, count)
+
+    def node_sparklines(self, community, pid):
+        """Format the in and out rates of a node, or None without
+            recent traffic.
+        """
+        second = int(time.time())
+        incoming = self.received.get((community, pid))
+        outgoing = self.sent.get((community, pid))
+        if not ((incoming and incoming.active(second))
+                or (outgoing and outgoing.active(second))):
+            return None
+        empty = [0.0] * (self.size - 1)
+        incoming = incoming.history(second) if incoming else empty
+        outgoing = outgoing.history(second) if outgoing else empty
+        return "in %s %d/s\nout %s %d/s" % (
+            sparkline(incoming[-self.sparkwidth:]), incoming[-1],
+            sparkline(outgoing[-self.sparkwidth:]), outgoing[-1])
+
+    def tick(self):
+        """The nodes whose sparklines changed since the last tick,
+            one second ago {(str/community_name,str/node_id)}: the
+            ones with events in the sparkline window, and the ones
+            whose sparkline disappears.
+        """
+        second = int(time.time())
+        changed = set()
+        shown = set()
+        for table in (self.received, self.sent):
+            for key, series in table.iteritems():
+                if series.active(second, self.sparkwidth + 1):
+                    changed.add(key)
+                if series.active(second):
+                    shown.add(key)
+        changed.update(self.shown - shown)
+        self.shown = shown
+        return changed
+
+    def tick_throughput(self):
+        """The communities whose throughput charts changed since the
+            last tick, one second ago {str/community_name}: the ones
+            with events in the chart, and the ones whose last events
+            just left it.
+        """
+        second = int(time.time())
+        charted = set([community for community, series in self.communities.iteritems()
+                       if series.active(second)])
+        changed = charted | self.charted
+        self.charted = charted
+        return changed
+
+    def edge_rate(self, community, fv, tv):
+        """The events per second over an edge in the last full second.
+        """
+        series = self.edges.get((community, fv, tv))
+        if series is None:
+            return 0.0
+        return series.history(int(time.time()))[-1]
+
+    def throughput(self, community):
+        """The events per second of a community, oldest first.
+        """
+        series = self.communities.get(community)
+        if series is None:
+            return [0.0] * (self.size - 1)
+        return series.history(int(time.time()))
+
+
+class ThroughputWindow(Gtk.Window):
+
+    """Window charting the events per second of a community.
+    """
+
+    def __init__(self, size=(400, 150)):
+        """Initialize the drawing area.
+        """
+        Gtk.Window.__init__(self)
+        self.set_default_size(*size)
+        self.values = []    # Events per second, oldest first
+        self.area = Gtk.DrawingArea()
+        self.area.connect("draw", self.on_draw)
+        self.add(self.area)
+
+    def set_values(self, values):
+        """Replace the charted values and schedule a redraw.
+        """
+        self.values = values
+        self.area.queue_draw()
+
+    def on_draw(self, widget, cr):
+        """Draw the values as a line chart, scaled to the maximum.
+        """
+        allocation = widget.get_allocation()
+        width, height = allocation.width, allocation.height
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+        if len(self.values) < 2:
+            return
+        top = max(max(self.values), 1.0)
+        step = float(width) / (len(self.values) - 1)
+        cr.set_source_rgb(0.640625, 0, 0)
+        cr.set_line_width(1.5)
+        for i, value in enumerate(self.values):
+            x, y = i * step, height - 15 - (height - 30) * value / top
+            if i == 0:
+                cr.move_to(x, y)
+            else:
+                cr.line_to(x, y)
+        cr.stroke()
+        cr.set_source_rgb(0, 0, 0)
+        cr.move_to(5, 12)
+        cr.show_text("%d events/s (max %d)" % (self.values[-1], top))
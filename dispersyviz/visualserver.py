@@ -4,15 +4,29 @@ and displaying graphs.
 
 import socket
 import threading
-import string
+import argparse
+import json
 import time
-import math
 import sys
 from graph_tool.all import *
 
+from visualmodel import VisualModel
+from visualreporter import split_events
+from visualshards import ShardedIngest
+from visualmetrics import ServerMetrics, MetricsEndpoint
+from visuallayout import LayoutWorker, ring_layout
+from visualheatmap import HeatmapWindow
+from visualclusters import Clusterer
+from visualseries import SeriesStore, ThroughputWindow
+from visualprocs import ProcessSampler, ProcessStats
+from visualwatchdog import ProgressWatchdog
+from visualweb import WebRenderer
+from visualexport import TimelineRecorder
+import profiling
+
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, Gdk, GObject
 
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
@@ -21,57 +35,40 @@ from twisted.internet.error import ReactorNotRunning
 class Visualizer:
 
     """Object to manage graph windows and their contents.
+        The contents are read from the snapshots published by a
+        VisualModel, the graphs themselves are never touched.
     """
 
     def _ring_layout(self, graph, radius=10.0):
-        """Layout the nodes evenly over a left half of
-            a circle and a right half, with a separation
-            between the two halves.
-        """
-        totalvs = graph.num_vertices()
-        pmap = graph.new_vertex_property("vector<float>")
-        if totalvs == 0:
-            return pmap
-        if totalvs == 1:
-            for v in graph.vertices():
-                pmap[v] = [1.0, 1.0]
-        else:
-            num = 0
-            for v in graph.vertices():
-                rads = 2.0 * math.pi / totalvs * num
-                num = num + 1
-                x = radius * math.cos(rads)
-                y = radius * math.sin(rads)
-                pmap[v] = [x + 0.3 * (radius if x > 0 else -radius), y]
-        return pmap
-
-    def __init__(self, closecallback):
+        """Layout the nodes over a split circle (see ring_layout).
+        """
+        return ring_layout(graph, radius)
+
+    def __init__(self, model, closecallback, layout="ring"):
         """Initialize fields.
+            The layout is either "ring" or "sfdp" (force-directed).
+            The view (graph or heatmap) follows the model.
         """
-        self.graphs = {}
-            # Graph per community name {str/community_name:Graph}
-        self.vertices = {}
-            # Vertex per community name for a node identifier
-            # {str/node_id:{str/community_name:Vertex}}
-        self.vlabels = {}
-            # Vertex labels per community name (formatted vtargets)
-            # {str/community_name:PropertyMap}
-        self.vcolors = {}
-            # Vertex colors per community name {str/community_name:PropertyMap}
-        self.vtargets = {}
-            # Vertex targets per node identifier
-            # {str/node_id:{str/target_name:str/value}}
+        self.model = model
+            # VisualModel publishing the graph snapshots
+        self.layouter = LayoutWorker() if layout == "sfdp" else None
+            # Force-directed layout process, if any
         self.windows = {}
-            # Window object per community name {str/community_name:GraphWindow}
-        self.edgequeue = {}
-            # Edge buffer per community name
+            # Window object per community name
+            # {str/community_name:GraphWindow/HeatmapWindow}
+        self.hidden = set()
+            # Community names of iconified windows
+        self.groups = {}
+            # Group name per vertex of the shown collapsed communities
+            # {str/community_name:[str/group_name]}
+        self.charts = {}
+            # Throughput chart per community name {str/community_name:ThroughputWindow}
+        self.edges = {}
+            # Distinct edges of the last snapshot per community name
             # {str/community_name:[(int/from,int/to)]}
-        self.glock = threading.RLock()
-                                     # Reentrant lock for modifying graph data
-        self.elocks = {}
-            # List of reentrant locks for modifying edges in different graphs
         self.closecallback = closecallback  # Callback for when we want to close
         self.alive = True                   # Experiment is running
+        self.model.request_snapshot()
 
     def __killall(self, widget, event, data=None):
         """Callback for when the user force exits.
@@ -79,105 +76,100 @@ class Visualizer:
         self.alive = False
         for window in self.windows:
             self.windows[window].destroy()
+        if self.layouter:
+            self.layouter.stop()
         self.closecallback()
         Gtk.main_quit()
         reactor.callFromThread(reactor.stop)
         print "GUI Elements destroyed"
 
-    def assert_community(self, name):
-        """Make sure we own a graph, window, and vertex property maps for some community name.
-        """
-        if name not in self.graphs:
-            self.glock.acquire()
-            self.elocks[name] = threading.RLock()
-            self.edgequeue[name] = []
-            self.graphs[name] = Graph()
-            self.vlabels[name] = self.graphs[name].new_vp("string")
-            self.vcolors[name] = self.graphs[name].new_vp("vector<float>")
-            self.glock.release()
-
-    def assert_node(self, pid):
-        """Make sure a node exists in the graphs.
-        """
-        # Check if in all graphs
-        if not str(pid) in self.vertices:
-            self.vertices[str(pid)] = {}
-            self.set_target_value(str(pid), "id", str(pid))
-        self.glock.acquire()
-        for name in self.graphs:
-            if not name in self.vertices[str(pid)]:
-                self.vertices[str(pid)][name] = self.graphs[name].add_vertex()
-                self.format_node_label(str(pid), name)
-        self.glock.release()
-
-    def format_node_label(self, pid, community=None):
-        """Take the current targets and generate a node label.
-            Possibly for all communities.
-        """
-        label = ""
-        for target_name, value in self.vtargets[str(pid)].iteritems():
-            label = label + target_name + ": " + value + ", "
-        label = label[:-2]
-        if community:
-            self.set_node_text(community, str(pid), label)
+    def __window_state(self, widget, event):
+        """Callback for when a window gets iconified or restored.
+        """
+        name = widget.get_title()
+        if event.new_window_state & Gdk.WindowState.ICONIFIED:
+            self.hidden.add(name)
         else:
-            [self.format_node_label(pid, comm) for comm in self.graphs]
+            self.hidden.discard(name)
+            self.model.call_in_model(self.model.mark_dirty, name)
 
-    def set_node_text(self, community, pid, text):
-        """Set the node label for a certain community.
+    def __drill_down(self, widget, event, name):
+        """Callback for clicks on a collapsed community:
+            expand the clicked group, or collapse the shown peers.
         """
-        self.vlabels[community][self.vertices[str(pid)][community]] = text
-
-    def set_node_color(self, community, pid, color):
-        """Set the node color for a certain community.
+        groups = self.groups.get(name)
+        if not groups or widget.g.num_vertices() == 0:
+            return False
+        x, y = widget.pos_from_device((event.x, event.y))
+        nearest = min(widget.g.vertices(),
+                      key=lambda v: (widget.pos[v][0] - x) ** 2 + (widget.pos[v][1] - y) ** 2)
+        self.model.call_in_model(self.model.expand_group, name,
+                                 groups[int(nearest)])
+        return True
+
+    def _show_window(self, name, window):
+        """Register and show a new window for some community.
         """
-        self.vcolors[community][self.vertices[str(pid)][community]] = color
-
-    def set_target_value(self, pid, target, value):
-        """Set a certain target value for some node.
+        window.connect("delete_event", self.__killall)
+        window.connect("window-state-event", self.__window_state)
+        window.set_title(name)
+        window.show_all()
+        self.windows[name] = window
+
+    def _layout(self, name, graph):
+        """Get the vertex positions of a community graph.
         """
-        self.glock.acquire()
-        if not str(pid) in self.vtargets:
-            self.vtargets[str(pid)] = {}
-        self.vtargets[str(pid)][target] = value
-        self.glock.release()
-
-    def draw_communication(self, fromid, toid, community):
-        """Queue drawing an edge in a certain community.
-        """
-        self.elocks[community].acquire()
-        fv = int(self.vertices[str(fromid)][community])
-        tv = int(self.vertices[str(toid)][community])
-        self.edgequeue[community].append((fv, tv))
-        self.elocks[community].release()
-
-    def draw_node_finish(self, pid, pct=1.0):
-        """Color a node for a certain percentage [0.0 ~ 1.0]:[red -> green].
+        if (not self.layouter) or (name in self.groups):
+            return self._ring_layout(graph)
+        self.layouter.update(name, graph.num_vertices(), self.edges.get(name, []))
+        return self.layouter.layout(name, graph, self._ring_layout)
+
+    def needs_redraw(self):
+        """Check if the model published a snapshot, or a new
+            layout was computed, since the last redraw.
         """
-        self.glock.acquire()
-        for name in self.graphs:
-            self.set_node_color(
-                name,
-                str(pid),
-                [(1 - pct) * 0.640625,
-                 pct * 0.640625,
-                 0,
-                 0.9])
-        self.glock.release()
+        if self.layouter and self.layouter.poll():
+            return True
+        return not self.model.snapshots.empty()
 
     def update_view(self):
         """Redraw callback.
+            Only the windows of communities which changed since
+            their last redraw are regenerated.
         """
         # Are we open for business or
         # still initializing?
         if not Gtk.main_level():
-            return
-        # Deep copy all current graphs
-        gvs = {}
-        self.glock.acquire()
-        for name in self.graphs:
-            gvs[name] = self.graphs[name].copy()
-        self.glock.release()
+            return self.alive
+        snapshot = self.model.take_snapshot()
+        # Ask for the next frame right away, the model publishes
+        # it as soon as anything changes
+        self.model.request_snapshot(self.hidden)
+        if self.layouter:
+            # Move the nodes of unchanged graphs to their new layout
+            for name in list(self.layouter.poll()):
+                if name in self.windows and not (snapshot and name in snapshot.graphs):
+                    gw = self.windows[name].graph
+                    gw.pos = self._layout(name, gw.g)
+                    gw.fit_to_window()
+                    gw.regenerate_surface()
+                    gw.queue_draw()
+        if not snapshot:
+            return self.alive
+        for name in snapshot.throughput:
+            if not name in self.charts:
+                chart = ThroughputWindow()
+                chart.set_title(name + " throughput")
+                # Closing a chart only hides it
+                chart.connect("delete_event", lambda widget, event: widget.hide_on_delete())
+                chart.show_all()
+                self.charts[name] = chart
+            self.charts[name].set_values(snapshot.throughput[name])
+        for name in snapshot.matrices:
+            if not name in self.windows:
+                self._show_window(name, HeatmapWindow())
+            self.windows[name].set_matrix(snapshot.matrices[name])
+        gvs = snapshot.graphs
         # Make sure a window for each graph exists
         for name in gvs:
             if not name in self.windows:
@@ -198,80 +190,246 @@ class Visualizer:
                     window.graph.key_press_event)
                 window.graph.handler_block_by_func(
                     window.graph.key_release_event)
-                window.connect("delete_event", self.__killall)
-                window.set_title(name)
-                window.show_all()
-                self.windows[name] = window
+                window.graph.connect("button-press-event",
+                                     self.__drill_down, name)
+                self._show_window(name, window)
             gw = self.windows[name].graph
 
+            if name in snapshot.edges:
+                self.edges[name] = snapshot.edges[name]
+            if name in snapshot.groups:
+                self.groups[name] = snapshot.groups[name]
+            else:
+                self.groups.pop(name, None)
+
             # Regen GraphWidget contents
             gw.g = gvs[name]
-            gw.pos = self._ring_layout(gvs[name])
-            gw.vprops["text"] = gvs[name].new_vp("string")
-            gw.vprops["fill_color"] = gw.g.own_property(self.vcolors[name])
+            gw.pos = self._layout(name, gvs[name])
+            gw.vprops["text"] = snapshot.vlabels[name]
+            gw.vprops["fill_color"] = snapshot.vcolors[name]
             gw.vprops["text_position"] = 0
-            gw.vprops["size"] = 10
+            gw.vprops["size"] = snapshot.vsizes.get(name, 10)
+            if name in snapshot.voutlines:
+                gw.vprops["color"] = snapshot.voutlines[name]
+                gw.vprops["pen_width"] = 2.5
+            else:
+                gw.vprops.pop("color", None)
+                gw.vprops.pop("pen_width", None)
+            if name in snapshot.epenwidths:
+                gw.eprops["pen_width"] = snapshot.epenwidths[name]
+            else:
+                gw.eprops.pop("pen_width", None)
             gw.selected = gvs[name].new_vertex_property("bool", False)
             gw.highlight = gvs[name].new_vertex_property("bool", False)
             gw.sel_edge_filt = gvs[name].new_edge_property("bool", False)
             gw.fit_to_window()
-            gw.vprops["text"] = gw.g.own_property(self.vlabels[name])
-
-            # Insert edges
-            self.elocks[name].acquire()
-            gvs[name].add_edge_list(self.edgequeue[name])
-            self.edgequeue[name] = []
-            self.elocks[name].release()
             gw.regenerate_surface()
             gw.queue_draw()
         return self.alive
 
 
+class RedrawScheduler:
+
+    """Object to drive the redraws of a Visualizer.
+
+        Instead of redrawing at a fixed rate, the time between
+        frames adapts to the time spent rendering: at most a
+        fraction (budget) of the time is spent in redraws, so
+        the client threads are never starved. When nothing
+        changed, the interval backs off to the maximum.
+    """
+
+    def __init__(self, visualizer, min_interval=100,
+                 max_interval=2000, budget=0.25, metrics=None):
+        """Initialize the scheduling bounds (in milliseconds).
+        """
+        self.visualizer = visualizer        # Visualizer to redraw
+        self.metrics = metrics              # ServerMetrics to report to, if any
+        self.min_interval = min_interval    # Fastest frame interval (ms)
+        self.max_interval = max_interval    # Slowest frame interval (ms)
+        self.budget = budget                # Fraction of time for rendering
+        self.interval = min_interval        # Current frame interval (ms)
+        self.render_time = 0.0
+            # Moving average of the time spent per redraw (ms)
+
+    def start(self):
+        """Schedule the first redraw.
+        """
+        GObject.timeout_add(self.interval, self.tick)
+
+    def tick(self):
+        """Timeout callback: redraw if needed and schedule the
+            next redraw.
+        """
+        if not self.visualizer.alive:
+            return False
+        if self.visualizer.needs_redraw():
+            start = time.time()
+            if not self.visualizer.update_view():
+                return False
+            elapsed = (time.time() - start) * 1000.0
+            if self.metrics:
+                self.metrics.count_update_view(elapsed / 1000.0)
+            self.render_time = 0.5 * self.render_time + 0.5 * elapsed
+            self.interval = int(self.render_time / self.budget)
+        else:
+            # Nothing changed, back off
+            self.interval = self.interval * 2
+        self.interval = max(self.min_interval,
+                            min(self.max_interval, self.interval))
+        GObject.timeout_add(self.interval, self.tick)
+        # Always a one-shot timeout, the next one is already scheduled
+        return False
+
+
 class VisualServer:
 
     """Object to handle client communication and forward it
-        to the graph window handler (Visualizer).
+        to the graph model (VisualModel), which is shown by the
+        graph window handler (Visualizer).
+
+        Client threads only decode events and queue them for the
+        model thread, which runs all of the handle_* methods.
+        A headless server has no Visualizer, it only collects
+        the results of the experiment.
     """
 
-    def __init__(self):
-        """Initialize all of our fields
+    def __init__(self, layout="ring", view="graph", clusterer=None, series=None,
+                 headless=False, results=None, sample_interval=1.0,
+                 straggler_after=30.0, timeout=0.0):
+        """Initialize all of our fields.
+            With a results file name, write the results of the
+            experiment to it (JSON) when it ends.
+            The peer processes are sampled every sample_interval
+            seconds, or never for 0.
+            Peers without progress for straggler_after seconds are
+            flagged, and after timeout seconds the experiment ends
+            with partial results (0 for never).
         """
         self.endlist = []
             # List of ids which want to end
+        self.endwaiting = []
+            # List of connections waiting for the experiment to end
+        self.ended = False                          # Whether the waiting clients were released
+        self.timedout = False                       # Whether the experiment timed out
+        self.keys = {}
+            # Agreed key per name {str/name:str/key}
+        self.keywaiting = {}
+            # Connections waiting for a key per name {str/name:[connection]}
+        self.barriers = {}
+            # Ids which reached a barrier per name {str/name:set(str/id)}
+        self.barrierwaiting = {}
+            # Connections waiting at a barrier per name {str/name:[connection]}
+        self.opened = set()
+            # Names of the barriers which opened
+        self.connections = []
+            # Connections of our own client threads
         self.allids = []
             # List of ids we have encountered
+        self.finished = set()
+            # Ids which reached all of their targets
+        self.completion = {}
+            # Completion per target per id {str/id:{str/target:float/pct}}
+        self.firstevent = None                      # Time of the first event
+        self.converged = None                       # Time all ids reached their target
+        self.results = results                      # File name to write the results to
+        self.processes = {}
+            # OS process per id {str/id:int/ospid}
+        self.processstats = {}
+            # Resource summary per OS process {int/ospid:ProcessStats}
+        self.sampler = None                         # Sampler of the peer processes, if any
+        if sample_interval > 0:
+            self.sampler = ProcessSampler(self, sample_interval)
+        self.watchdog = ProgressWatchdog(self, straggler_after, timeout)
+            # Tracker of the progress of the peers
         self.isopen = False                         # Experiment is done or forced exited
-        self.visualizer = Visualizer(self.close)    # Visualizer object
-
-    def open(self, port):
-        """Open our server socket on a certain port
+        self.shards = None                          # Ingest worker processes, if any
+        self.model = VisualModel(None if headless else view,
+                                 clusterer, series)   # Graph model object
+        self.metrics = ServerMetrics(self.model)    # Self-metrics object
+        self.metrics_endpoint = None                # HTTP endpoint for metrics, if any
+        self.web = None                             # Browser-based renderer, if any
+        self.recorder = None                        # Timeline recorder, if any
+        self.visualizer = None                      # Visualizer object, if not headless
+        if not headless:
+            self.visualizer = Visualizer(self.model, self.close, layout)
+        self.handlers = {'CON': self.handle_connect,
+                         'COM': self.handle_communication,
+                         'CTM': self.handle_custom_target,
+                         'END': self.handle_end,
+                         'PID': self.handle_process,
+                         'KEY': self.handle_key,
+                         'BAR': self.handle_barrier}
+            # Handler per event type {str/event_type:function}
+        self.replying = set([self.handle_end, self.handle_key, self.handle_barrier])
+            # Handlers which reply, they get the client connection
+
+    def open(self, port, workers=0, metrics_port=None, host='0.0.0.0'):
+        """Open our server socket on a certain port and address
+            (default: all addresses, so remote peers can report).
+            With workers > 0, the clients are accepted and parsed
+            by that many ingest worker processes instead.
+            With a metrics_port, serve our self-metrics on it.
         """
         self.isopen = True
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.settimeout(5.0)
-        self._socket.bind(('0.0.0.0', port))
-        self._socket.listen(4)
-        reactor.callInThread(self.run)
+        self._socket.bind((host, port))
+        self._socket.listen(128 if workers > 0 else 4)
+        if workers > 0:
+            # Fork before any of our own threads exist
+            self.shards = ShardedIngest(self, workers)
+            self.shards.start(self._socket)
+        self.model.start()
+        if metrics_port:
+            self.metrics_endpoint = MetricsEndpoint(self.metrics, metrics_port)
+            self.metrics_endpoint.start()
+        if self.sampler:
+            self.sampler.start()
+        self.watchdog.start()
+        if not self.shards:
+            reactor.callInThread(self.run)
+
+    def open_web(self, port, host='127.0.0.1'):
+        """Serve our graphs to browsers on a certain port and address
+            (default: localhost only).
+        """
+        self.web = WebRenderer(self.model, port, host)
+        self.web.start()
+
+    def record(self, filename):
+        """Record the timeline of our model to a file, for
+            rendering it afterwards (see visualexport).
+        """
+        self.recorder = TimelineRecorder(self.model, filename)
+        self.recorder.start()
 
     def run(self):
         """Accept clients as quickly as possible and handle
             their further communication in a thread.
+            These threads live as long as their client, so they
+            do not come out of the (bounded) reactor thread pool.
         """
         while self.isopen:
             try:
                 conn, addr = self._socket.accept()
                 conn.settimeout(5.0)    # Stay responsive for clean exits
-                reactor.callInThread(self.client, conn, addr)
+                thread = threading.Thread(target=self.client,
+                                          args=(conn, addr))
+                thread.daemon = True
+                thread.start()
             except socket.error:    # Timeout, check if alive and keep going
                 pass
 
     def client(self, connection, address):
         """Handle a single client.
-            Delegate input to the proper handler functions.
+            Decode its input and queue it for the proper handler
+            functions, one batch per received chunk.
         """
-        ended = False
         buffered = ''
-        while self.isopen and (not ended):
+        counters = self.metrics.connection(address)
+        self.connections.append(connection)
+        while self.isopen:
             data = None
             try:
                 data = connection.recv(4096)
@@ -279,95 +437,280 @@ class VisualServer:
                 continue
             if not data:
                 break
-            data = buffered + data
-            if not data.endswith(';'):
-                lpos = data.rfind(';')
-                if lpos < 0:
-                    buffered = data
-                    return
-                buffered = data[lpos+1:]
-                data = data[:lpos+1]
-            for gdata in string.split(data, ';'):
-                if not gdata:
-                    break
-                content = string.split(gdata[3:], ',')
-                try:
-                    if gdata.startswith('CON'):
-                        self.handle_connect(*content)
-                    elif gdata.startswith('COM'):
-                        self.handle_communication(*content)
-                    elif gdata.startswith('CTM'):
-                        self.handle_custom_target(*content)
-                    elif gdata.startswith('END'):
-                        self.handle_end(*content)
-                        connection.sendall('OK')
-                        Gtk.main_quit()
-                        reactor.callFromThread(reactor.stop)
-                        self.close()
-                        ended = True
-                        break
-                except TypeError:
-                    # Input was thusly maimed, we cannot recover
+            counters.bytes = counters.bytes + len(data)
+            decoded, buffered = split_events(buffered + data)
+            events = []
+            for event_type, content in decoded:
+                handler = self.handlers.get(event_type)
+                if not handler:
                     continue
+                if handler in self.replying:
+                    content.append(connection)
+                events.append((handler, content))
+            if events:
+                start = time.time()
+                self.model.post_events(events)
+                counters.queue_wait = counters.queue_wait + time.time() - start
+        self.connections.remove(connection)
         connection.close()
 
     def close(self):
         """Close our socket.
+            If the experiment did not end, tell the clients we shut
+            down first.
         """
+        if not self.ended:
+            for connection in list(self.connections):
+                self.reply(connection, 'STP;')
         self.isopen = False
         self._socket.close()
+        if self.shards:
+            self.shards.stop(None if self.ended else 'STP;')
+        if self.metrics_endpoint:
+            self.metrics_endpoint.stop()
+        if self.web:
+            self.web.stop()
+        if self.sampler:
+            self.sampler.stop()
+        self.watchdog.stop()
+        if self.recorder:
+            self.recorder.stop()
+        self.model.stop()
 
     def assert_id(self, pid):
         """Make sure an identifier is registered.
         """
-        self.visualizer.assert_node(str(pid))
+        self.model.assert_node(str(pid))
+        if self.firstevent is None:
+            self.firstevent = time.time()
         if str(pid) not in self.allids:
             self.allids.append(str(pid))
+            self.watchdog.seen(str(pid))
 
     def handle_connect(self, pid, community_name):
         """Add this identifier to the graph of a certain community.
         """
+        self.metrics.count_event('CON')
         if community_name == "ABCMeta":
             return
-        self.visualizer.assert_community(community_name)
+        self.model.assert_community(community_name)
         self.assert_id(pid)
 
-    def handle_communication(self, fromid, toid, community_name):
+    def handle_communication(self, fromid, toid, community_name, count=1):
         """Draw communication between two identifiers.
+            The count is the number of aggregated communications.
         """
+        self.metrics.count_event('COM', count)
         if community_name == "ABCMeta":
             return
         self.assert_id(fromid)
         self.assert_id(toid)
-        self.visualizer.draw_communication(fromid, toid, community_name)
+        self.model.draw_communication(fromid, toid, community_name, count)
 
     def handle_custom_target(self, pid, dict_entry, received, target):
         """Set some value of a custom target.
+            An identifier is as complete as its least complete
+            target.
         """
+        self.metrics.count_event('CTM')
+        if float(target) <= 0:
+            # No completion to speak of, and no division by zero
+            return
         self.assert_id(pid)
-        self.visualizer.set_target_value(
+        self.model.set_target_value(
             str(pid),
             dict_entry,
             str(received) + "/" + str(target))
-        self.visualizer.format_node_label(str(pid))
-        self.visualizer.draw_node_finish(
-            str(pid),
-            float(received) / float(target))
+        completion = self.completion.setdefault(str(pid), {})
+        completion[dict_entry] = float(received) / float(target)
+        pct = min(completion.values())
+        self.model.draw_node_finish(str(pid), pct)
+        self.watchdog.progress(str(pid), dict_entry, float(received))
+        if pct >= 1.0:
+            self.finished.add(str(pid))
+            if self.converged is None and len(self.finished) == len(self.allids):
+                self.converged = time.time()
+        else:
+            self.finished.discard(str(pid))
+
+    def handle_process(self, pid, ospid):
+        """Register the OS process some identifier runs in.
+        """
+        self.metrics.count_event('PID')
+        self.assert_id(pid)
+        self.processes[str(pid)] = int(ospid)
 
-    def handle_end(self, pid):
-        """Signal some identifier wants to exit and wait for the experiment to end.
+    def apply_process_samples(self, samples):
+        """Show the resource samples of the peer processes
+            {int/ospid:(float/cpu_fraction,int/rss_bytes,int/threads)}
+            on their nodes and add them to the summaries.
         """
+        for ospid, sample in samples.iteritems():
+            if ospid not in self.processstats:
+                self.processstats[ospid] = ProcessStats()
+            self.processstats[ospid].add(*sample)
+        for pid, ospid in self.processes.iteritems():
+            if ospid in samples:
+                self.model.set_process_sample(pid, *samples[ospid])
+
+    def reply(self, connection, data):
+        """Send data to a client, if it is still connected.
+        """
+        try:
+            connection.sendall(data)
+        except socket.error:
+            pass
+
+    def handle_key(self, pid, name, offer, connection):
+        """Reply with the key of some name. The first offered key
+            is agreed on, until then the requests wait for it.
+        """
+        self.metrics.count_event('KEY')
+        # Not registered, the id of a peer is only final once its
+        # endpoint is open, and keys are agreed on before that
+        if offer and name not in self.keys:
+            self.keys[name] = offer
+        waiting = self.keywaiting.setdefault(name, [])
+        waiting.append(connection)
+        if name in self.keys:
+            for client in waiting:
+                self.reply(client, 'KEY' + name + ',' + self.keys[name] + ';')
+            del self.keywaiting[name]
+
+    def handle_barrier(self, pid, name, count, connection):
+        """Signal some identifier reached a barrier. Once count
+            identifiers reached it, release all of the waiting
+            clients, and any that reach it later.
+        """
+        self.metrics.count_event('BAR')
+        self.assert_id(pid)
+        if name in self.opened:
+            self.reply(connection, 'BAR' + name + ';')
+            return
+        self.barriers.setdefault(name, set()).add(str(pid))
+        self.barrierwaiting.setdefault(name, []).append(connection)
+        if len(self.barriers[name]) >= int(count):
+            for waiting in self.barrierwaiting.pop(name):
+                self.reply(waiting, 'BAR' + name + ';')
+            self.opened.add(name)
+
+    def handle_end(self, pid, connection):
+        """Signal some identifier wants to exit.
+            Once all identifiers want to exit, release all of the
+            waiting clients and end the experiment.
+        """
+        self.metrics.count_event('END')
         self.endlist.append(str(pid))
-        while set(self.endlist) != set(self.allids):
-            time.sleep(4.0)
+        self.endwaiting.append(connection)
+        if set(self.endlist) == set(self.allids):
+            self.ended = True
+            self.end_experiment()
+
+    def time_out(self):
+        """End the experiment before all identifiers want to exit.
+            The waiting clients are released, all others are told
+            we shut down.
+        """
+        self.timedout = True
+        self.end_experiment()
+
+    def end_experiment(self):
+        """Release all of the waiting clients, write the results
+            and exit.
+        """
+        for waiting in self.endwaiting:
+            self.reply(waiting, 'END;')
+        self.endwaiting = []
+        if self.results:
+            self.write_results(self.results)
+        if self.visualizer:
+            Gtk.main_quit()
+        reactor.callFromThread(reactor.stop)
+        self.close()
+
+    def write_results(self, filename):
+        """Write the results of the experiment to a JSON file.
+            Times are in seconds since the first event.
+        """
+        now = time.time()
+        start = self.firstevent or now
+        report = self.metrics.report()
+        results = {
+            'peers': len(self.allids),
+            'wall_seconds': now - start,
+            'convergence_seconds': (self.converged - start
+                                    if self.converged else None),
+            'events': report['events'],
+            'communities': report['communities'],
+            'model_apply_seconds': report['model_apply_seconds'],
+            'rss_bytes': report['rss_bytes'],
+            'processes': {},
+            'timed_out': self.timedout,
+        }
+        results.update(self.watchdog.report())
+        for ospid, stats in self.processstats.iteritems():
+            summary = stats.report()
+            summary['peers'] = sorted([pid for pid, peerospid in self.processes.iteritems()
+                                       if peerospid == ospid])
+            results['processes'][str(ospid)] = summary
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
 
 if __name__ == "__main__":
-    server = VisualServer()
-    if len(sys.argv) > 1:
-        server.open(int(sys.argv[1]))
-    else:
-        server.open(54917)
+    parser = argparse.ArgumentParser(description="Visual Dispersy server")
+    parser.add_argument("port", type=int, nargs="?", default=54917,
+                        help="port to accept reporting peers on")
+    parser.add_argument("--bind", default="0.0.0.0",
+                        help="address to accept reporting peers on (default: all addresses)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of ingest worker processes (default: ingest in this process)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve self-metrics on this localhost port (/metrics, /metrics.json)")
+    parser.add_argument("--web", type=int, default=None,
+                        help="serve the graphs to browsers on this port")
+    parser.add_argument("--web-bind", default="127.0.0.1",
+                        help="address to serve the graphs to browsers on (default: localhost)")
+    parser.add_argument("--record", default=None,
+                        help="record the timeline of the run to this file, for visualexport.py")
+    parser.add_argument("--layout", choices=["ring", "sfdp"], default="ring",
+                        help="node layout, sfdp is computed in a background process")
+    parser.add_argument("--view", choices=["graph", "heatmap"], default="graph",
+                        help="draw communities as node-link graphs or as traffic heatmaps")
+    parser.add_argument("--cluster-threshold", type=int, default=100,
+                        help="collapse communities with more peers than this into groups (0: never)")
+    parser.add_argument("--cluster-by", choices=["ports", "completion", "blocks"], default="ports",
+                        help="how to group the peers of collapsed communities")
+    parser.add_argument("--rates", action="store_true",
+                        help="show event rate sparklines, rate-scaled edges and throughput charts")
+    parser.add_argument("--headless", action="store_true",
+                        help="do not show any windows, only collect results")
+    parser.add_argument("--results", default=None,
+                        help="write the results of the experiment to this JSON file")
+    parser.add_argument("--sample-interval", type=float, default=1.0,
+                        help="seconds between CPU, RSS and thread samples of the peer processes (0: never)")
+    parser.add_argument("--straggler-after", type=float, default=30.0,
+                        help="seconds without progress before a peer is flagged as straggler (0: never)")
+    parser.add_argument("--timeout", type=float, default=0.0,
+                        help="seconds after the first event to end the experiment with partial results (0: never)")
+    args = parser.parse_args()
+    # Profile all threads, if enabled by DISPERSYVIZ_PROFILE
+    profiling.start("server")
+    server = VisualServer(args.layout, args.view,
+                          Clusterer(args.cluster_threshold, args.cluster_by),
+                          SeriesStore() if args.rates else None,
+                          args.headless, args.results, args.sample_interval,
+                          args.straggler_after, args.timeout)
+    server.open(args.port, args.workers, args.metrics_port, args.bind)
+    if args.web:
+        server.open_web(args.web, args.web_bind)
+    if args.record:
+        server.record(args.record)
     print "ONLINE"
-    GObject.timeout_add(500, server.visualizer.update_view)
-    reactor.callLater(0.0, Gtk.main)
+    if server.visualizer:
+        RedrawScheduler(server.visualizer, metrics=server.metrics).start()
+        reactor.callLater(0.0, Gtk.main)
     reactor.run()
+    if server.recorder:
+        # The model thread writes the end of the timeline
+        server.recorder.wait()
+    profiling.stop()
@@ -0,0 +1,297 @@
+"""Ingest worker processes for a VisualServer.
+
+Each worker accepts a share of the peer connections on the
+(inherited) listening socket, parses their events and aggregates
+them into compact deltas: joined communities, edge counts, the
+latest target values and processes, and requests the server replies
+to (end, key and barrier requests). These deltas are sent
+over a pipe to the server process, which only has to apply them.
+"""
+
+import errno
+import select
+import socket
+import time
+import threading
+import multiprocessing
+
+from visualreporter import split_events
+
+REPLYING = {'END': 1, 'KEY': 3, 'BAR': 3}
+    # Fields per event type the server replies to
+
+
+class ShardDelta:
+
+    """Events of a single worker, aggregated over a flush interval.
+    """
+
+    def __init__(self):
+        """Initialize fields.
+        """
+        self.connects = []
+            # Joined communities in order of arrival [(str/id,str/community)]
+        self.seen = set()
+            # Lookup set for connects
+        self.edges = {}
+            # Communications per edge {(str/from,str/to,str/community):int}
+        self.targets = {}
+            # Latest target values {(str/id,str/target):(str/received,str/target)}
+        self.requests = []
+            # Requests to reply to, in order of arrival
+            # [(str/event_type,[str/field],int/token)]
+        self.processes = {}
+            # Latest OS process per id {str/id:str/ospid}
+        self.received = {}
+            # Bytes received per client address {str/address:int}
+
+    def __len__(self):
+        """The amount of aggregated entries.
+        """
+        return (len(self.connects) + len(self.edges) + len(self.targets)
+                + len(self.requests) + len(self.processes) + len(self.received))
+
+    def add(self, event_type, content, token):
+        """Aggregate a single decoded event of the client with some token.
+        """
+        if event_type == 'CON' and len(content) == 2:
+            key = (content[0], content[1])
+            if key not in self.seen:
+                self.seen.add(key)
+                self.connects.append(key)
+        elif event_type == 'COM' and len(content) == 3:
+            key = (content[0], content[1], content[2])
+            self.edges[key] = self.edges.get(key, 0) + 1
+        elif event_type == 'CTM' and len(content) == 4:
+            self.targets[(content[0], content[1])] = (content[2], content[3])
+        elif event_type in REPLYING and len(content) == REPLYING[event_type]:
+            self.requests.append((event_type, content, token))
+        elif event_type == 'PID' and len(content) == 2:
+            self.processes[content[0]] = content[1]
+
+    def pack(self):
+        """Compact picklable representation for the pipe.
+        """
+        return (self.connects, self.edges, self.targets, self.requests,
+                self.processes, self.received)
+
+
+def ingest_worker(listener, pipe, flush_interval):
+    """Main loop of a worker process.
+        Poll the listening socket, our clients and the pipe to the
+        server process, flushing a delta every flush_interval.
+
+        The server process can send:
+            - ('SEND', token, data): send data to a client
+            - ('SEND', None, data): send data to all clients
+            - None: exit
+    """
+    listener.setblocking(0)
+    poller = select.poll()
+    poller.register(listener.fileno(), select.POLLIN)
+    poller.register(pipe.fileno(), select.POLLIN)
+    clients = {}
+        # Client per file descriptor
+        # {int/fd:[socket,int/token,str/buffered,str/address,str/outgoing]}
+    tokens = {}
+        # File descriptor per client token {int/token:int/fd}
+    nexttoken = 0
+
+    def drop(fd):
+        """Forget a disconnected client.
+        """
+        client = clients.pop(fd)
+        poller.unregister(fd)
+        del tokens[client[1]]
+        client[0].close()
+
+    def send(fd):
+        """Send as much of the outgoing data of a client as its
+            socket takes, and poll for more room if anything is left.
+        """
+        client = clients[fd]
+        try:
+            sent = client[0].send(client[4])
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                drop(fd)
+                return
+        client[4] = client[4][sent:]
+        poller.modify(fd, select.POLLIN | (select.POLLOUT if client[4] else 0))
+    delta = ShardDelta()
+    nextflush = time.time() + flush_interval
+    while True:
+        timeout = max(0.0, nextflush - time.time())
+        try:
+            ready = poller.poll(int(timeout * 1000.0))
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, flags in ready:
+            if fd == listener.fileno():
+                # All workers are woken, only one gets the client
+                try:
+                    conn, addr = listener.accept()
+                except socket.error:
+                    continue
+                conn.setblocking(0)
+                clients[conn.fileno()] = [conn, nexttoken, '',
+                                          "%s:%d" % addr[:2], '']
+                tokens[nexttoken] = conn.fileno()
+                nexttoken = nexttoken + 1
+                poller.register(conn.fileno(), select.POLLIN)
+            elif fd == pipe.fileno():
+                try:
+                    message = pipe.recv()
+                except EOFError:
+                    message = None
+                if message is None:
+                    for client in clients.values():
+                        # Deliver what is left (like a farewell) first
+                        try:
+                            client[0].settimeout(1.0)
+                            client[0].sendall(client[4])
+                        except socket.error:
+                            pass
+                        client[0].close()
+                    return
+                if message[0] == 'SEND' and message[1] is None:
+                    receivers = clients.keys()
+                elif message[0] == 'SEND' and message[1] in tokens:
+                    receivers = [tokens[message[1]]]
+                else:
+                    receivers = []
+                for receiver in receivers:
+                    clients[receiver][4] = clients[receiver][4] + message[2]
+                    send(receiver)
+            elif fd in clients:
+                if flags & select.POLLOUT:
+                    send(fd)
+                    readable = select.POLLIN | select.POLLERR | select.POLLHUP
+                    if fd not in clients or not flags & readable:
+                        continue
+                client = clients[fd]
+                try:
+                    data = client[0].recv(65536)
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        drop(fd)
+                    continue
+                if not data:
+                    drop(fd)
+                    continue
+                delta.received[client[3]] = delta.received.get(
+                    client[3], 0) + len(data)
+                events, client[2] = split_events(client[2] + data)
+                for event_type, content in events:
+                    delta.add(event_type, content, client[1])
+        if time.time() >= nextflush:
+            if len(delta):
+                pipe.send(delta.pack())
+                delta = ShardDelta()
+            nextflush = time.time() + flush_interval
+
+
+class ShardConnection:
+
+    """Stand-in for a client connection, living in a worker.
+    """
+
+    def __init__(self, pipe, token, lock):
+        """Remember the worker pipe, client token and the lock
+            guarding sends on the pipe.
+        """
+        self.pipe = pipe
+        self.token = token
+        self.lock = lock
+
+    def sendall(self, data):
+        """Have the worker send data to the client.
+        """
+        with self.lock:
+            self.pipe.send(('SEND', self.token, data))
+
+
+class ShardedIngest:
+
+    """Object to manage the ingest workers of a VisualServer
+        and forward their deltas to its handlers.
+    """
+
+    def __init__(self, server, workers, flush_interval=0.05):
+        """Initialize fields.
+        """
+        self.server = server                    # VisualServer to forward to
+        self.workers = workers                  # Amount of worker processes
+        self.flush_interval = flush_interval    # Seconds between deltas
+        self.pipes = []                         # Pipe per worker
+        self.processes = []                     # Process per worker
+        self.sendlock = threading.Lock()
+            # Guards sending on the pipes, from the model thread and
+            # the closing thread
+
+    def start(self, listener):
+        """Fork the workers, sharing a listening socket, and
+            start forwarding their deltas.
+        """
+        for i in range(self.workers):
+            ours, theirs = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=ingest_worker,
+                args=(listener, theirs, self.flush_interval),
+                name="IngestWorker-%d" % i)
+            process.daemon = True
+            process.start()
+            self.pipes.append(ours)
+            self.processes.append(process)
+        for pipe in self.pipes:
+            thread = threading.Thread(target=self.forward, args=(pipe,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, farewell=None):
+        """Tell all workers to exit, after sending some farewell
+            data to all of their clients, if any.
+        """
+        with self.sendlock:
+            for pipe in self.pipes:
+                try:
+                    if farewell:
+                        pipe.send(('SEND', None, farewell))
+                    pipe.send(None)
+                except IOError:
+                    pass
+
+    def forward(self, pipe):
+        """Convert the deltas of a worker to events for the model.
+        """
+        server = self.server
+        counters = {}
+            # Connection metrics per client address of this worker
+        while True:
+            try:
+                connects, edges, targets, requests, processes, received = pipe.recv()
+            except (EOFError, IOError):
+                break
+            for address, count in received.iteritems():
+                if address not in counters:
+                    counters[address] = server.metrics.connection(address)
+                counters[address].bytes = counters[address].bytes + count
+            events = []
+            for pid, community_name in connects:
+                events.append((server.handle_connect, (pid, community_name)))
+            for (fromid, toid, community_name), count in edges.iteritems():
+                events.append((server.handle_communication,
+                               (fromid, toid, community_name, count)))
+            for pid, ospid in processes.iteritems():
+                events.append((server.handle_process, (pid, ospid)))
+            for (pid, dict_entry), (received, target) in targets.iteritems():
+                events.append((server.handle_custom_target,
+                               (pid, dict_entry, received, target)))
+            for event_type, content, token in requests:
+                events.append((server.handlers[event_type],
+                               tuple(content) + (ShardConnection(pipe, token, self.sendlock),)))
+            server.model.post_events(events)
@@ -0,0 +1,132 @@
+"""Progress tracking of the peers of a VisualServer.
+
+The progress of every peer is taken from its custom targets (CTM):
+any increase of a received value counts as progress. Peers which
+made no progress for a while, and did not finish, are flagged as
+stragglers, counting from their first event for peers which never
+reported a target. Experiments without any targets have no
+stragglers. Optionally, the whole experiment times out, so that a
+single crashed or stuck peer cannot hang a run.
+"""
+
+import time
+import threading
+
+
+class ProgressWatchdog:
+
+    """Thread checking the progress of the peers of a VisualServer.
+        The tracking methods are called by the handlers of the
+        server, the checks are posted to its model thread, so all
+        state is only touched by the model thread.
+    """
+
+    def __init__(self, server, straggler_after=30.0, timeout=0.0, interval=1.0):
+        """Initialize fields.
+            Peers are stragglers after straggler_after seconds
+            without progress (0 for never), the experiment times out
+            timeout seconds after the first event (0 for never).
+        """
+        self.server = server                    # VisualServer with the peers
+        self.straggler_after = straggler_after  # Seconds without progress
+        self.timeout = timeout                  # Seconds before timing out
+        self.interval = interval                # Seconds between checks
+        self.values = {}
+            # Latest received value per target {(str/id,str/target):float}
+        self.progressed = {}
+            # Total increase of the received values per id {str/id:float}
+        self.first = {}
+            # Time of the first event per id {str/id:float}
+        self.last = {}
+            # Time of the last progress per id which reported a
+            # target {str/id:float}
+        self.stragglers = {}
+            # Seconds without progress per flagged id {str/id:float}
+        self.alive = True
+
+    def start(self):
+        """Start checking in a thread.
+        """
+        thread = threading.Thread(target=self.run, name="ProgressWatchdog")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop checking.
+        """
+        self.alive = False
+
+    def run(self):
+        """Check until stopped.
+        """
+        while self.alive:
+            time.sleep(self.interval)
+            if self.alive:
+                self.server.model.call_in_model(self.check)
+
+    def seen(self, pid):
+        """Start tracking a new id. Model thread only.
+        """
+        self.first[pid] = time.time()
+
+    def progress(self, pid, target, received):
+        """Track a new value of some target of an id. Model thread only.
+        """
+        key = (pid, target)
+        previous = self.values.get(key)
+        self.values[key] = received
+        if previous is not None and received <= previous:
+            return
+        self.progressed[pid] = self.progressed.get(pid, 0.0) + received - (previous or 0.0)
+        self.last[pid] = time.time()
+        if pid in self.stragglers:
+            del self.stragglers[pid]
+            self.server.model.set_straggler(pid, None)
+
+    def rate(self, pid, now=None):
+        """Progress per second of an id since its first event.
+        """
+        elapsed = (now or time.time()) - self.first.get(pid, 0.0)
+        return self.progressed.get(pid, 0.0) / elapsed if elapsed > 0 else 0.0
+
+    def check(self):
+        """Flag the ids which stopped progressing and time out the
+            experiment if it takes too long. Model thread only.
+        """
+        server = self.server
+        if not server.isopen:
+            return
+        now = time.time()
+        if self.straggler_after > 0:
+            done = server.finished | set(server.endlist)
+            for pid, first in self.first.iteritems():
+                last = self.last.get(pid)
+                if last is None:
+                    if not self.last:
+                        # No targets in this experiment, so far
+                        continue
+                    # Crashed or stuck before its first target
+                    last = first
+                if pid in done:
+                    if pid in self.stragglers:
+                        del self.stragglers[pid]
+                        server.model.set_straggler(pid, None)
+                    continue
+                if now - last >= self.straggler_after:
+                    self.stragglers[pid] = now - last
+                    server.model.set_straggler(pid, now - last)
+        if self.timeout > 0 and server.firstevent and now - server.firstevent >= self.timeout:
+            print "Experiment timed out after %.0fs, stragglers: %s" % (
+                now - server.firstevent, ", ".join(sorted(self.stragglers)) or "none")
+            server.time_out()
+
+    def report(self):
+        """Summary of the stragglers and unfinished ids.
+        """
+        now = time.time()
+        finished = self.server.finished
+        return {'stragglers': dict([(pid, {'stalled_seconds': stalled,
+                                           'progress_rate': self.rate(pid, now)})
+                                    for pid, stalled in self.stragglers.iteritems()]),
+                'unfinished': sorted([pid for pid in self.server.allids
+                                      if pid not in finished])}
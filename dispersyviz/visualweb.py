@@ -0,0 +1,296 @@
+"""Browser-based renderer for a VisualServer.
+
+Instead of (or next to) the Gtk windows, the graphs can be watched
+in any number of browsers. The model thread only records which
+nodes, edges and node properties changed (DeltaStream), and every
+interval flushes them as one compact JSON delta to all watchers
+(and sinks, like the timeline recorder of visualexport).
+The WebRenderer serves the page (web/index.html), which draws the
+graphs on a canvas, and pushes the deltas over Server-Sent Events:
+ - /: the page
+ - /events: the delta stream, starting with the full state
+
+Deltas are JSON objects with any of the keys:
+ - communities: [str/community_name]
+ - nodes: [[str/community_name,int/vertex,str/node_id]]
+ - edges: [[str/community_name,int/from,int/to,int/total count]]
+ - labels: {str/node_id:str/label}
+ - colors: {str/node_id:[float/r,float/g,float/b,float/a]}
+ - outlines: {str/node_id:[float/r,float/g,float/b,float/a]}
+"""
+
+import os
+import json
+import time
+import Queue
+import threading
+import SocketServer
+import BaseHTTPServer
+
+PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web", "index.html")
+
+
+class DeltaStream:
+
+    """Changes of a VisualModel since the last flush, and the
+        queues of the watchers to flush them to.
+        The recording and flushing methods are model thread only.
+    """
+
+    def __init__(self, backlog=256):
+        """Initialize fields.
+            Watchers with more than backlog unsent deltas are
+            dropped, their browser reconnects and gets the full
+            state again.
+        """
+        self.backlog = backlog
+        self.communities = []
+            # New community names in order of arrival
+        self.nodes = []
+            # New vertices [(str/community_name,int/vertex,str/node_id)]
+        self.edges = set()
+            # Changed edges {(str/community_name,int/from,int/to)}
+        self.changed = set()
+            # Node identifiers whose label or colors changed
+        self.watchers = []
+            # Delta queue per watcher [Queue.Queue]
+        self.sinks = []
+            # Functions called with every delta in the model thread
+        self.lock = threading.Lock()
+            # Guards watchers, which change in the HTTP threads
+        self.sent = 0   # Bytes of deltas queued for watchers
+        self.alive = True
+
+    def start(self, model, interval):
+        """Have the model thread flush the changes every interval,
+            in a thread.
+        """
+        thread = threading.Thread(target=self.run, args=(model, interval),
+                                  name="DeltaStream")
+        thread.daemon = True
+        thread.start()
+
+    def run(self, model, interval):
+        """Flush until closed.
+        """
+        while self.alive:
+            time.sleep(interval)
+            if self.alive:
+                model.call_in_model(self.flush, model)
+
+    def community(self, name):
+        """Record a new community.
+        """
+        self.communities.append(name)
+
+    def node(self, name, pid, vertex):
+        """Record a new vertex of a node in a community.
+        """
+        self.nodes.append((name, vertex, pid))
+        self.changed.add(pid)
+
+    def edge(self, name, fv, tv):
+        """Record a changed edge count.
+        """
+        self.edges.add((name, fv, tv))
+
+    def node_changed(self, pid):
+        """Record a changed label or color of a node.
+        """
+        self.changed.add(pid)
+
+    def _properties(self, model, pids, delta):
+        """Add the labels and colors of some nodes to a delta.
+        """
+        labels = {}
+        colors = {}
+        outlines = {}
+        for pid in pids:
+            if pid not in model.vtargets:
+                continue
+            labels[pid] = model.format_node_label(pid)
+            if pid in model.vprogress or pid in model.vstraggling:
+                colors[pid] = model.format_node_color(pid)
+            if pid in model.vload:
+                outlines[pid] = model.format_node_outline(pid)
+        for key, values in (('labels', labels), ('colors', colors), ('outlines', outlines)):
+            if values:
+                delta[key] = values
+
+    def flush(self, model):
+        """Send everything that changed since the last flush to all
+            watchers, as one delta.
+        """
+        delta = {}
+        if self.communities:
+            delta['communities'] = self.communities
+        if self.nodes:
+            delta['nodes'] = self.nodes
+        if self.edges:
+            delta['edges'] = [(name, fv, tv, model.edgecounts[name][(fv, tv)])
+                              for name, fv, tv in self.edges]
+        self._properties(model, self.changed, delta)
+        self.communities = []
+        self.nodes = []
+        self.edges = set()
+        self.changed = set()
+        if delta:
+            self.broadcast(json.dumps(delta, separators=(',', ':')))
+
+    def full(self, model):
+        """The full state of a model, as a single delta.
+        """
+        delta = {'communities': sorted(model.graphs.keys()),
+                 'nodes': [(name, int(vertex), pid)
+                           for pid, vertices in model.vertices.iteritems()
+                           for name, vertex in vertices.iteritems()],
+                 'edges': [(name, fv, tv, count)
+                           for name, counts in model.edgecounts.iteritems()
+                           for (fv, tv), count in counts.iteritems()]}
+        self._properties(model, model.vertices.keys(), delta)
+        return json.dumps(delta, separators=(',', ':'))
+
+    def watch(self, model, queue):
+        """Add a watcher, starting with the full state of a model.
+        """
+        queue.put(self.full(model))
+        with self.lock:
+            self.watchers.append(queue)
+
+    def unwatch(self, queue):
+        """Remove a watcher. Thread safe.
+        """
+        with self.lock:
+            if queue in self.watchers:
+                self.watchers.remove(queue)
+
+    def close(self):
+        """Stop flushing and disconnect all watchers. Thread safe.
+        """
+        self.alive = False
+        with self.lock:
+            watchers, self.watchers = self.watchers, []
+        for queue in watchers:
+            queue.put(None)
+
+    def broadcast(self, data):
+        """Queue a delta for all watchers, dropping the ones which
+            fell too far behind, and hand it to all sinks.
+        """
+        for sink in self.sinks:
+            sink(data)
+        with self.lock:
+            watchers = list(self.watchers)
+        for queue in watchers:
+            if queue.qsize() >= self.backlog:
+                self.unwatch(queue)
+                queue.put(None)
+            else:
+                queue.put(data)
+                self.sent = self.sent + len(data)
+
+
+def model_deltas(model, interval=0.1):
+    """The DeltaStream of a model, created and flushed every
+        interval on first use.
+    """
+    if not model.deltas:
+        deltas = DeltaStream()
+        deltas.start(model, interval)
+        model.deltas = deltas
+    return model.deltas
+
+
+class WebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve the page and the delta stream of our renderer.
+    """
+
+    def do_GET(self):
+        """Answer / and /events requests.
+        """
+        renderer = self.server.renderer
+        if self.path in ('/', '/index.html'):
+            with open(PAGE) as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/events':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            renderer.stream(self.wfile)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        """Do not log every request.
+        """
+        pass
+
+
+class WebServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """HTTP server with a thread per request, as every watcher
+        keeps its event stream open.
+    """
+
+    daemon_threads = True
+
+
+class WebRenderer:
+
+    """Serve the graphs of a VisualModel to browsers, flushing the
+        recorded changes every interval.
+    """
+
+    def __init__(self, model, port, host='127.0.0.1', interval=0.1):
+        """Bind the HTTP server to some address and port, and start
+            recording the changes of the model.
+        """
+        self.model = model              # VisualModel to render
+        self.deltas = model_deltas(model, interval)
+        self.httpd = WebServer((host, port), WebRequestHandler)
+        self.httpd.renderer = self
+        self.alive = True
+
+    def start(self):
+        """Serve in a thread.
+        """
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  name="WebRenderer")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop serving and disconnect all watchers.
+        """
+        self.alive = False
+        self.deltas.close()
+        self.httpd.shutdown()
+
+    def stream(self, wfile):
+        """Write the deltas for a single watcher as server-sent
+            events, until it disconnects or is dropped.
+        """
+        queue = Queue.Queue()
+        self.model.call_in_model(self.deltas.watch, self.model, queue)
+        try:
+            while self.alive:
+                try:
+                    data = queue.get(timeout=15.0)
+                except Queue.Empty:
+                    wfile.write(": keepalive\n\n")
+                    wfile.flush()
+                    continue
+                if data is None:
+                    break
+                wfile.write("data: " + data + "\n\n")
+                wfile.flush()
+        except (IOError, OSError):
+            pass    # The browser went away
+        self.deltas.unwatch(queue)
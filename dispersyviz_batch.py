@@ -0,0 +1,289 @@
+"""Command line runner for batches of experiments.
+
+Runs an experiment for every combination of a grid of peer counts and
+message count expressions (python expressions in peerid, like in the
+GUI), without any windows. Sweep points run in parallel, each on its
+own range of ports (VisualServer and Dispersy) and in its own working
+directory. The results of all runs are written to CSV and JSON.
+
+Usage:
+    python dispersyviz_batch.py EXPERIMENT --peers 10 50 100 --messages 1 "peerid % 3"
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import Queue
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+from dispersyviz.discovery import inspect_experiment
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def drain(pipe, log):
+    """Copy the output of a process to a log file until it exits,
+        so it never blocks on a full pipe.
+    """
+    for line in iter(pipe.readline, ''):
+        log.write(line)
+
+
+def total_messages(numpeers, messages):
+    """Evaluate a message count expression for all peer ids.
+        Returns the total amount of messages.
+    """
+    return sum([eval(messages, {}, {'peerid': peerid})
+                for peerid in range(1, numpeers + 1)])
+
+
+class BatchRunner:
+
+    """Object to run sweep points in parallel and collect their
+        results.
+    """
+
+    def __init__(self, experiment, parallel, port_base=20000, port_range=2000,
+                 timeout=600.0, processes=None):
+        """Initialize fields.
+            Slot i (of parallel slots) uses the ports
+            [port_base + i * port_range ~ port_base + (i + 1) * port_range).
+        """
+        self.experiment = experiment    # Experiment module name
+        self.parallel = parallel        # Amount of simultaneous runs
+        self.port_base = port_base      # First port of the first slot
+        self.port_range = port_range    # Ports per slot
+        self.timeout = timeout          # Seconds before a run times out
+        self.grace = 30.0               # Seconds more before a run is killed
+        self.straggler_after = 30.0     # Seconds without progress for stragglers
+        self.peer_hosts = None          # Addresses to bind the peer processes to, if any
+        self.processes = processes      # Processes per run for the launcher
+        self.profile = None             # Profiler backend, if profiling
+        self.profile_dir = None         # Folder for the profiles of all runs
+        self.record_dir = None          # Folder for the timelines of all runs, if recording
+        self.results = []
+            # Results per finished run [(int/point_index,dict)]
+        self.total = 0  # Amount of points in the current batch
+        self.lock = threading.Lock()
+
+    def run(self, points):
+        """Run all sweep points [(int/peers, str/messages, int/repetition)].
+            Returns the results, in the order of the points.
+        """
+        self.total = len(points)
+        jobs = Queue.Queue()
+        for index, point in enumerate(points):
+            jobs.put((index, point))
+        threads = []
+        for slot in range(min(self.parallel, len(points))):
+            thread = threading.Thread(target=self._worker, args=(slot, jobs))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1.0)
+        return [result for index, result in sorted(self.results)]
+
+    def _worker(self, slot, jobs):
+        """Run points on the ports of a slot, until there are none left.
+        """
+        while True:
+            try:
+                index, point = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            result = self.run_point(slot, *point)
+            with self.lock:
+                self.results.append((index, result))
+                print "[%d/%d] %s" % (len(self.results), self.total,
+                                      json.dumps(result, sort_keys=True))
+                sys.stdout.flush()
+
+    def run_point(self, slot, numpeers, messages, repetition):
+        """Run the experiment once, on the ports of a slot.
+            Returns a flat dictionary of results.
+        """
+        serverport = self.port_base + slot * self.port_range
+        workdir = tempfile.mkdtemp(prefix="dispersyviz-")
+        resultfile = os.path.join(workdir, "results.json")
+        result = {'experiment': self.experiment,
+                  'peers': numpeers,
+                  'messages': messages,
+                  'repetition': repetition,
+                  'total_messages': total_messages(numpeers, messages),
+                  'status': 'ok'}
+        server = launcher = log = serverlog = drainer = None
+        env = dict(os.environ)
+        if self.profile:
+            env['DISPERSYVIZ_PROFILE'] = self.profile
+            env['DISPERSYVIZ_PROFILE_DIR'] = os.path.join(
+                self.profile_dir, "%d-%s-%d" % (numpeers, re.sub(r'\W+', '_', messages), repetition))
+        start = time.time()
+        try:
+            command = ['python', '-u', os.path.join(ROOT, 'dispersyviz', 'visualserver.py'),
+                       str(serverport), '--headless', '--results', resultfile,
+                       '--timeout', str(self.timeout),
+                       '--straggler-after', str(self.straggler_after)]
+            if self.record_dir:
+                command.extend(['--record', os.path.join(self.record_dir, "%d-%s-%d.timeline" % (
+                    numpeers, re.sub(r'\W+', '_', messages), repetition))])
+            server = subprocess.Popen(command, cwd=ROOT, env=env,
+                                      stdout=subprocess.PIPE, bufsize=1)
+            if not server.stdout.readline():
+                result['status'] = 'server failed'
+                return result
+            serverlog = open(os.path.join(workdir, "server.log"), 'w')
+            drainer = threading.Thread(target=drain, args=(server.stdout, serverlog))
+            drainer.daemon = True
+            drainer.start()
+            env['DISPERSYVIZ_PEER_PORT'] = str(serverport + 1)
+            command = ['python', '-u', os.path.join(ROOT, 'dispersyviz', 'launcher.py'),
+                       self.experiment, str(numpeers), messages,
+                       str(result['total_messages']), str(serverport)]
+            if self.processes:
+                command.extend(['--processes', str(self.processes)])
+            if self.peer_hosts:
+                command.extend(['--peer-hosts'] + self.peer_hosts)
+            log = open(os.path.join(workdir, "peers.log"), 'w')
+            launcher = subprocess.Popen(command, cwd=workdir, env=env,
+                                        stdout=log, stderr=subprocess.STDOUT)
+            while server.poll() is None:
+                # The server times out by itself, with partial results
+                if time.time() - start > self.timeout + self.grace:
+                    result['status'] = 'killed'
+                    break
+                time.sleep(0.2)
+            result['runner_seconds'] = time.time() - start
+            if os.path.isfile(resultfile):
+                with open(resultfile) as f:
+                    report = json.load(f)
+                if report['timed_out']:
+                    result['status'] = 'timed out'
+                result['stragglers'] = len(report['stragglers'])
+                result['unfinished'] = len(report['unfinished'])
+                result['wall_seconds'] = report['wall_seconds']
+                result['convergence_seconds'] = report['convergence_seconds']
+                result['model_apply_seconds'] = report['model_apply_seconds']
+                result['server_rss_bytes'] = report['rss_bytes']
+                for event_type, count in report['events'].iteritems():
+                    result['events_' + event_type] = count
+                processes = report['processes'].values()
+                if processes:
+                    result['peer_cpu_max'] = max([p['cpu_max'] for p in processes])
+                    result['peer_rss_max_bytes'] = max([p['rss_max_bytes'] for p in processes])
+                    result['peer_rss_growth_bytes'] = max([p['rss_growth_bytes'] for p in processes])
+                    result['peer_threads_max'] = max([p['threads_max'] for p in processes])
+            elif result['status'] == 'ok':
+                result['status'] = 'no results'
+        finally:
+            for process in (launcher, server):
+                if process and process.poll() is None:
+                    process.terminate()
+            # Give the launcher some time to stop its peers
+            if launcher:
+                for _ in range(50):
+                    if launcher.poll() is not None:
+                        break
+                    time.sleep(0.1)
+                if launcher.poll() is None:
+                    launcher.kill()
+            if log:
+                log.close()
+            if drainer:
+                drainer.join(5.0)
+            if serverlog:
+                serverlog.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+        return result
+
+
+def write_results(results, prefix):
+    """Write results to PREFIX.csv and PREFIX.json.
+    """
+    with open(prefix + ".json", 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    columns = sorted(set([key for result in results for key in result]))
+    with open(prefix + ".csv", 'wb') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    """Parse the command line and run the sweep.
+    """
+    parser = argparse.ArgumentParser(description="Visual Dispersy batch runner")
+    parser.add_argument("experiment", help="module name in the experiments folder")
+    parser.add_argument("--peers", type=int, nargs="+", default=[3],
+                        help="peer counts to sweep over")
+    parser.add_argument("--messages", nargs="+", default=["1"],
+                        help="messages per peer to sweep over, python expressions in peerid")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per sweep point")
+    parser.add_argument("--parallel", type=int,
+                        default=max(1, multiprocessing.cpu_count() / 4),
+                        help="simultaneous runs")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="peer processes per run (default: one per core)")
+    parser.add_argument("--port-base", type=int, default=20000,
+                        help="first port to use, runs get non-overlapping ranges from here")
+    parser.add_argument("--port-range", type=int, default=2000,
+                        help="ports per parallel run (VisualServer and peers)")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="seconds before a run ends with partial results")
+    parser.add_argument("--straggler-after", type=float, default=30.0,
+                        help="seconds without progress before a peer counts as straggler")
+    parser.add_argument("--peer-hosts", nargs="+", default=None,
+                        help="addresses to bind the peer processes to in turn, e.g. 127.0.0.2 127.0.0.3")
+    parser.add_argument("--output", default="results",
+                        help="write the results to OUTPUT.csv and OUTPUT.json")
+    parser.add_argument("--profile", choices=["cprofile", "sample"], default=None,
+                        help="profile the server and peers, per run in OUTPUT-profiles")
+    parser.add_argument("--record", action="store_true",
+                        help="record the timeline of every run in OUTPUT-timelines, for visualexport.py")
+    args = parser.parse_args()
+
+    info = inspect_experiment(os.path.join(ROOT, "experiments", args.experiment + ".py"))
+    if info.error:
+        parser.error(info.error)
+    for numpeers in args.peers:
+        if numpeers < 3:
+            parser.error("experiments need at least 3 peers")
+        if numpeers >= args.port_range:
+            parser.error("--port-range is too small for %d peers" % numpeers)
+    for messages in args.messages:
+        try:
+            total_messages(1, messages)
+        except:
+            parser.error("invalid message count expression: %s" % messages)
+
+    points = [(numpeers, messages, repetition)
+              for numpeers in args.peers
+              for messages in args.messages
+              for repetition in range(args.repeat)]
+    runner = BatchRunner(args.experiment, args.parallel, args.port_base,
+                         args.port_range, args.timeout, args.processes)
+    runner.straggler_after = args.straggler_after
+    runner.peer_hosts = args.peer_hosts
+    if args.profile:
+        runner.profile = args.profile
+        runner.profile_dir = os.path.abspath(args.output + "-profiles")
+    if args.record:
+        runner.record_dir = os.path.abspath(args.output + "-timelines")
+        if not os.path.isdir(runner.record_dir):
+            os.makedirs(runner.record_dir)
+    results = runner.run(points)
+    write_results(results, args.output)
+    print "Wrote %d runs to %s.csv and %s.json" % (len(results), args.output, args.output)
+
+if __name__ == "__main__":
+    main()
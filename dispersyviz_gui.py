@@ -3,17 +3,16 @@
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject
 
 import re
 import os
-import sys
 import time
-import glob
-import inspect
-import traceback
+import threading
 import subprocess
 
+from dispersyviz.discovery import discover_experiments, inspect_experiment, check_import
+
 
 class MainWindow(Gtk.Window):
 
@@ -38,9 +37,8 @@ class MainWindow(Gtk.Window):
         self.add(grid)
 
         self.liststore = Gtk.ListStore(str)
-        for file in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiments", "*.py")):
-            name = os.path.splitext(os.path.basename(file))[0]
-            self.liststore.append((name,))
+        for info in discover_experiments(os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiments")):
+            self.liststore.append((info.name,))
 
         self.treeview = Gtk.TreeView(self.liststore)
         self.treeview.append_column(
@@ -140,8 +138,9 @@ class MainWindow(Gtk.Window):
                 return None
         return (uscript, str(totalmsg))
 
-    def _blocking_dialog(self, title, message_type, text):
-        """Generic dialog with title, type and text
+    def _blocking_dialog(self, title, message_type, text, process=None):
+        """Generic dialog with title, type and text.
+            With a process, the dialog also closes once it exits.
         """
         dialog = Gtk.MessageDialog(self,
                                    Gtk.DialogFlags.DESTROY_WITH_PARENT,
@@ -150,6 +149,13 @@ class MainWindow(Gtk.Window):
                                    text)
         dialog.set_title(title)
         self.set_sensitive(False)
+        if process:
+            def check_exit():
+                if process.poll() is None:
+                    return True
+                dialog.response(Gtk.ResponseType.CLOSE)
+                return False
+            GObject.timeout_add(500, check_exit)
         dialog.run()
         dialog.destroy()
         self.set_sensitive(True)
@@ -161,6 +167,7 @@ class MainWindow(Gtk.Window):
             Validates:
                 1. The message count is a valid python expression
                 2. The selected experiment doesn't contain static errors
+                   and imports (checked in a child process)
                 3. The selected experiment has a proper main method
                 4. The VisualServer gets launched correctly
                 5. (After exit) all of the processes are terminated
@@ -180,96 +187,20 @@ class MainWindow(Gtk.Window):
                 return
             nummessages, totalmessages = uinput
 
-            # (Try) Import the selected file
-            sys.path.insert(
-                0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiments"))
-            module = None
-            try:
-                module = __import__(name)
-            except:
-                if sys.exc_info()[2]:
-                    # TODO Remove our own statement from this traceback, user
-                    # will have no idea what __import__(name) means
-                    self._blocking_dialog(
-                        "ERROR", Gtk.MessageType.ERROR, "Import of %s.py failed.\n\n%s" %
-                        (name, traceback.format_exc(sys.exc_info()[2])))
-                else:
-                    self._blocking_dialog(
-                        "ERROR", Gtk.MessageType.ERROR, "Import of %s.py failed with error:\n\n%s: %s" %
-                        (name, sys.exc_info()[0], sys.exc_info()[1]))
-                return
-            sys.path.pop(0)
-
-            # Find a main function
-            if not "main" in [str(member) for member in dir(module)]:
-                self._blocking_dialog(
-                    "ERROR",
-                    Gtk.MessageType.ERROR,
-                    "Could not find a main() function in %s.py." % (name))
-                return
-
-            main_function = getattr(module, "main")
-
-            # Make sure the main function accepts our arguments
-            if len(inspect.getargspec(main_function)[0]) != 5:
-                self._blocking_dialog(
-                    "ERROR",
-                    Gtk.MessageType.ERROR,
-                    "The main() function of %s.py needs to accept 4 arguments (peerid, total peers, starting messages, total messages, visual dispersy server port)." % (name))
-                return
-
-            # Wait for server to open without error
-            p_vs_port = 54917
-            p_visualserver = None
-            # Retry 3 times with ports [54917->54919]
-            tries_left = 3
-            while tries_left > 0:
-                p_visualserver = subprocess.Popen(
-                    ['python',
-                     '-u',
-                     'dispersyviz/visualserver.py',
-                     str(p_vs_port)],
-                    cwd=os.path.join(
-                        os.path.dirname(os.path.abspath(__file__))),
-                    stdout=subprocess.PIPE,
-                    bufsize=1)
-                # Wait for console output or unplanned termination
-                while (not p_visualserver.stdout.readline()) and (not p_visualserver.poll()):
-                    time.sleep(0.5)
-                if p_visualserver.returncode:  # None means not terminated (running fine)
-                    p_vs_port = p_vs_port + 1
-                    tries_left = tries_left - 1
-                else:
-                    break
-            if p_visualserver.returncode:
-                self._blocking_dialog(
-                    "ERROR",
-                    Gtk.MessageType.ERROR,
-                    "Well this is embarrassing. The VisualServer object crashed before the experiment even began. Contact a programmer.")
+            # Check the selected file without importing it here, the
+            # import check runs in a thread to keep the window drawn
+            info = inspect_experiment(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiments", name + ".py"))
+            if info.error:
+                self._blocking_dialog("ERROR", Gtk.MessageType.ERROR, info.error)
                 return
 
-            # Launch processes once server has started
-            children = [subprocess.Popen(
-                        ['python', '-c', "import os,sys;sys.path.insert(0, '%s');peerid=%s;nummessages=%s;numpeers=%s;totalmessages=%s;getattr(__import__('%s'), 'main')(peerid,numpeers,nummessages,totalmessages,%s)" %
-                         (os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiments"), str(peerid), nummessages, self.numpeers, totalmessages, name, str(p_vs_port))], cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)))) for peerid in range(1, int(self.numpeers) + 1)]
-
-            self._blocking_dialog(
-                "RUNNING EXPERIMENT",
-                Gtk.MessageType.INFO,
-                "Busy conducting experiment. Close this window to terminate all running processes.")
-
-            # Clean up processes
-            if not p_visualserver.poll():
-                try:
-                    p_visualserver.kill()
-                except OSError:
-                    print "Unable to kill process %d" % (p_visualserver.pid)
-            for child in children:
-                if not child.poll():
-                    try:
-                        child.kill()
-                    except OSError:
-                        print "Unable to kill process %d" % (p_visualserver.pid)
+            def check():
+                error = check_import(info)
+                GObject.idle_add(self._launch, name, nummessages, totalmessages, error)
+            thread = threading.Thread(target=check)
+            thread.daemon = True
+            thread.start()
 
         else:
             self._blocking_dialog(
@@ -277,6 +208,79 @@ class MainWindow(Gtk.Window):
                 Gtk.MessageType.ERROR,
                 "Are you trying to be clever?\nYou didn't select any class to run, poopieface.")
 
+    def _launch(self, name, nummessages, totalmessages, error):
+        """Launch an experiment after its import check, or show
+            the error of the check. Called in the Gtk thread.
+        """
+        if error:
+            self._blocking_dialog("ERROR", Gtk.MessageType.ERROR, error)
+            return False
+
+        # Wait for server to open without error
+        p_vs_port = 54917
+        p_visualserver = None
+        # Retry 3 times with ports [54917->54919]
+        tries_left = 3
+        while tries_left > 0:
+            p_visualserver = subprocess.Popen(
+                ['python',
+                 '-u',
+                 'dispersyviz/visualserver.py',
+                 str(p_vs_port)],
+                cwd=os.path.join(
+                    os.path.dirname(os.path.abspath(__file__))),
+                stdout=subprocess.PIPE,
+                bufsize=1)
+            # Wait for console output or unplanned termination
+            while (not p_visualserver.stdout.readline()) and (not p_visualserver.poll()):
+                time.sleep(0.5)
+            if p_visualserver.returncode:  # None means not terminated (running fine)
+                p_vs_port = p_vs_port + 1
+                tries_left = tries_left - 1
+            else:
+                break
+        if p_visualserver.returncode:
+            self._blocking_dialog(
+                "ERROR",
+                Gtk.MessageType.ERROR,
+                "Well this is embarrassing. The VisualServer object crashed before the experiment even began. Contact a programmer.")
+            return False
+
+        # Launch processes once server has started, the launcher
+        # imports the experiment once and forks a process per peer
+        p_launcher = subprocess.Popen(
+            ['python',
+             '-u',
+             'dispersyviz/launcher.py',
+             name,
+             self.numpeers,
+             nummessages,
+             totalmessages,
+             str(p_vs_port)],
+            cwd=os.path.join(
+                os.path.dirname(os.path.abspath(__file__))))
+
+        self._blocking_dialog(
+            "RUNNING EXPERIMENT",
+            Gtk.MessageType.INFO,
+            "Busy conducting experiment. Close this window to terminate all running processes.",
+            p_visualserver)
+
+        # Clean up processes, the VisualServer exits by itself once
+        # the experiment ended or timed out
+        if p_visualserver.poll() is None:
+            try:
+                p_visualserver.kill()
+            except OSError:
+                print "Unable to kill process %d" % (p_visualserver.pid)
+        if p_launcher.poll() is None:
+            try:
+                # The launcher forwards this to all of its peers
+                p_launcher.terminate()
+            except OSError:
+                print "Unable to kill process %d" % (p_launcher.pid)
+        return False
+
 # Outside of a __main__ check to avoid being imported
 win = MainWindow()
 win.connect("delete-event", Gtk.main_quit)
@@ -8,7 +8,8 @@ import struct
 import sys
 import time
 import string
-import os.path
+import threading
+import os
 
 # Void all Dispersy log messages
 logging.basicConfig(level=logging.CRITICAL)
@@ -29,6 +30,13 @@ from dispersy.payload import Payload
 from dispersy.resolution import PublicResolution
 
 from dispersyviz.visualdispersy import VisualDispersy, VisualCommunity
+from dispersyviz.visualendpoint import LoopbackEndpoint, peer_port_base, peer_host
+
+
+# Messages per second each peer floods at (0: as fast as possible),
+# and messages per store_update_forward call
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", 0))
+FLOOD_CHUNK = int(os.environ.get("FLOOD_CHUNK", 100))
 
 
 class FloodCommunity(VisualCommunity):
@@ -96,15 +104,15 @@ class FloodCommunity(VisualCommunity):
         return messages
 
     def create_flood(self, count):
-        """Dump some messages into the Community overlay.
+        """Stream some messages into the Community overlay.
         """
         self.start_flood_time = time.time()
         if count <= 0:
             return
         # Retrieve the meta object we defined in initiate_meta_messages()
         meta = self.get_meta_message(u"flood")
-        # Instantiate the message
-        messages = [meta.impl(authentication=(self.my_member,),  # This client signs this message
+        # Instantiate the messages lazily, only one chunk exists at a time
+        messages = (meta.impl(authentication=(self.my_member,),  # This client signs this message
                               # distribution=(self.claim_global_time(),meta.distribution.claim_sequence_number()),
                               # # When you enable sequence numbers (see
                               # initiate_meta_messages)
@@ -115,9 +123,10 @@ class FloodCommunity(VisualCommunity):
                               # value of the Lamport clock
                               payload=("flood #%d" % (i + (self.peerid - 1) * count),))  # Some arbitrary message contents
             for i
-                    in xrange(count)]
-        # Spread this message into the network (including to ourselves)
-        self.dispersy.store_update_forward(messages, True, True, True)
+                    in xrange(count))
+        # Spread these messages into the network (including to ourselves)
+        # in chunks, at FLOOD_RATE messages per second
+        self.vz_stream(messages, FLOOD_RATE, FLOOD_CHUNK)
 
     def check_flood(self, messages):
         """Callback to verify the contents of the messages received.
@@ -145,7 +154,7 @@ class FloodCommunity(VisualCommunity):
         """Busy wait for the experiment to end
         """
         self.vz_wait_for_experiment_end()
-        self.dispersy.stop()
+        stop_peer(self.dispersy)
 
 
 class FloodPayload(Payload):
@@ -223,12 +232,19 @@ def join_flood_overlay(
     # Report to Visual Dispersy
     community.vz_report_target("messages", 0, total_message_count)
 
-    print "%d] Joined community" % (dispersy.lan_address[1])
+    print "%s] Joined community" % (dispersy.myid)
 
-    # Allow the Community members some time to find each other.
-    time.sleep(5.0)
+    # Start flooding as soon as all Community members joined.
+    # This runs on the reactor thread, which may be shared with other
+    # hosted peers, so wait for the barrier instead of blocking.
+    joined = community.vz_barrier("joined", totalpeers)
+    joined.addCallback(lambda _: start_flood(community, new_message_count))
 
-    print "%d] Flooding community" % (dispersy.lan_address[1])
+
+def start_flood(community, new_message_count):
+    """Flood the community, once all of its members joined.
+    """
+    print "%s] Flooding community" % (community.dispersy.myid)
 
     # Call our message creation function to share a certain amount
     # of messages with the Community.
@@ -249,36 +265,35 @@ def generateMasterkey():
     return fpubkey  # BASE64 ENCODED
 
 
-def establishMasterkey(peerid):
+def establishMasterkey(dispersy, peerid):
     """Get the master key for this community.
-        This is stored in the file 'generated_master_key.key'.
-        Peerid 1 is responsible for making sure this file exists.
+        The peers agree on it through the VisualServer.
+        Peerid 1 offers a freshly generated key.
     """
     if peerid == 1:
-        # Peerid 1 makes sure the key file exists
-        if not os.path.isfile('generated_master_key.key'):
-            f = open('generated_master_key.key', 'w')
-            f.write(generateMasterkey())
-            f.close()
+        masterkey = dispersy.vz_master_key("flood", generateMasterkey)
     else:
-        # All other peers simply wait for the keyfile to exist
-        # [And pray peer 1 did not crash]
-        while not os.path.isfile('generated_master_key.key'):
-            time.sleep(0.5)
+        masterkey = dispersy.vz_master_key("flood")
+    if masterkey is None:
+        raise RuntimeError("VisualServer closed before the master key was known")
+    return masterkey.decode("BASE64")
 
-    keyfile = open('generated_master_key.key', 'r')
-    masterkey = keyfile.read().decode("BASE64")
-    keyfile.close()
-    return masterkey
 
+stop_lock = threading.Lock()
+    # Serializes stopping, a peer can be released and told the
+    # VisualServer shuts down (on a timeout) at the same time
 
-def stopOnDispersy(dispersy, reactor):
-    """Exit when Dispersy closes.
+
+def stop_peer(dispersy):
+    """Stop Dispersy and exit, once.
+        Blocks while Dispersy stops, so never call this on the
+        reactor thread.
     """
-    time.sleep(20.0)
-    while dispersy.running:
-        time.sleep(10.0)
-    reactor.stop()
+    with stop_lock:
+        if not dispersy.running:
+            return
+        dispersy.stop()
+    reactor.callFromThread(reactor.stop)
 
 
 def main(
@@ -294,29 +309,29 @@ def main(
         - total_message_count: the total amount of messages we are supposed to receive (including our own)
         - vz_server_port: the server port we need to connect to for VisualDispersy
     """
-    # Get the master key
-    masterkey = establishMasterkey(peerid)
-
-    # Make an endpoint (starting at port 10000, incrementing until we can open)
-    endpoint = StandaloneEndpoint(10000)
+    # Make an endpoint (starting at port 10000, incrementing until we can open),
+    # on the address the launcher gave us, if any
+    # Packets to peers hosted in the same process skip the UDP stack
+    endpoint = LoopbackEndpoint(peer_port_base(10000), peer_host())
     # Create a VisualDispersy instance for the endpoint and store the SQLite 3
     # database in RAM
     dispersy = VisualDispersy(endpoint, u".", u":memory:")
     # Initialize the VisualDispersy server connection
     dispersy.vz_init_server_connection(vz_server_port)
-
-    # Start Dispersy in a thread (it blocks)
-    reactor.callInThread(dispersy.start, True)
-    # Add an observer to do a clean exit when Dispersy is closed
-    reactor.callInThread(stopOnDispersy, dispersy, reactor)
-    # After 20 seconds, start the experiment
-    reactor.callLater(
-        5.0,
-     join_flood_overlay,
-     dispersy,
-     masterkey,
-     peerid,
-     totalpeers,
-     new_message_count,
-     total_message_count)
+    # Get the master key
+    masterkey = establishMasterkey(dispersy, peerid)
+    # Do a clean exit when the VisualServer shuts down early
+    dispersy.vz_on_shutdown(lambda: stop_peer(dispersy))
+
+    # Start Dispersy in a thread (it blocks), start the experiment once
+    # it has started
+    started = threads.deferToThread(dispersy.start, True)
+    started.addCallback(
+        lambda _: join_flood_overlay(
+            dispersy,
+         masterkey,
+         peerid,
+         totalpeers,
+         new_message_count,
+         total_message_count))
     reactor.run()
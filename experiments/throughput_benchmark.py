@@ -0,0 +1,335 @@
+"""A benchmark community (ThroughputCommunity) measuring the
+dissemination throughput of Dispersy.
+
+Every run sweeps over all combinations of payload size, Dispersy
+batch delay and CommunityDestination node count, one phase per
+combination. In every phase each peer streams its messages, and
+once it received the messages of all peers it reports the achieved
+messages/sec and bytes/sec as custom targets. All peers then wait at
+a barrier before the next phase starts.
+
+The sweep is configured with environment variables, comma separated:
+ - BENCH_PAYLOADS: payload sizes in bytes (default: 100,1000,4000)
+ - BENCH_DELAYS: batch delays in seconds (default: 0.0,0.5)
+ - BENCH_NODE_COUNTS: initial push node counts (default: 10)
+ - BENCH_CHUNK: messages per store_update_forward call (default: 100)
+"""
+
+import logging
+import struct
+import time
+import string
+import threading
+import os
+
+# Void all Dispersy log messages
+logging.basicConfig(level=logging.CRITICAL)
+logging.getLogger().propagate = False
+
+from M2Crypto import EC, BIO
+from twisted.internet import reactor, threads
+from dispersy.authentication import MemberAuthentication
+from dispersy.conversion import DefaultConversion, BinaryConversion
+from dispersy.destination import CommunityDestination
+from dispersy.distribution import FullSyncDistribution
+from dispersy.message import Message, DropPacket, BatchConfiguration
+from dispersy.payload import Payload
+from dispersy.resolution import PublicResolution
+
+from dispersyviz.visualdispersy import VisualDispersy, VisualCommunity
+from dispersyviz.visualendpoint import LoopbackEndpoint, peer_port_base, peer_host
+
+
+def _sweep(name, default, convert):
+    """Parse a comma separated sweep from the environment.
+    """
+    return [convert(value) for value in os.environ.get(name, default).split(",") if value.strip()]
+
+PAYLOADS = _sweep("BENCH_PAYLOADS", "100,1000,4000", int)
+DELAYS = _sweep("BENCH_DELAYS", "0.0,0.5", float)
+NODE_COUNTS = _sweep("BENCH_NODE_COUNTS", "10", int)
+CHUNK = int(os.environ.get("BENCH_CHUNK", 100))
+
+CONFIGURATIONS = [(delay, node_count) for delay in DELAYS for node_count in NODE_COUNTS]
+    # Meta message configurations [(float/batch delay,int/node count)]
+PHASES = [(payload, configuration) for configuration in range(len(CONFIGURATIONS))
+          for payload in PAYLOADS]
+    # Sweep phases [(int/payload bytes,int/configuration index)]
+
+
+class ThroughputCommunity(VisualCommunity):
+
+    """A community flooding messages of varying size and meta
+        message configuration, measuring the throughput.
+    """
+
+    def __init__(self, dispersy, master_member, my_member):
+        """Callback for when Dispersy initializes this community.
+            Note that this function signature is a Dispersy requirement.
+        """
+        super(
+            ThroughputCommunity,
+            self).__init__(
+                dispersy,
+                master_member,
+         my_member)
+        self.received = {}      # Messages received per phase {int/phase:int}
+        self.message_received = 0
+        self.phase = None       # Index of the running phase
+        self.phase_start = None  # Time the running phase started
+        self.results = []
+            # Achieved throughput per phase [(int/phase,float/msgs_per_s,float/bytes_per_s)]
+
+    def initiate_conversions(self):
+        """Tell Dispersy what wire conversion handlers we have.
+        """
+        return [DefaultConversion(self), ThroughputConversion(self)]
+
+    @property
+    def dispersy_auto_download_master_member(self):
+        """Do not automatically download our (bogus) master member.
+        """
+        return False
+
+    @property
+    def dispersy_enable_fast_candidate_walker(self):
+        return True
+
+    def initiate_meta_messages(self):
+        """>EXTEND< the current meta messages with one message type
+            per (batch delay, node count) configuration.
+        """
+        messages = super(ThroughputCommunity, self).initiate_meta_messages()
+        for index, (delay, node_count) in enumerate(CONFIGURATIONS):
+            messages.append(Message(self,
+                                    u"bench-%d" % index,
+                                    MemberAuthentication(encoding="sha1"),
+                                    PublicResolution(),
+                                    FullSyncDistribution(enable_sequence_number=False,
+                                                         synchronization_direction=u"ASC",
+                                                         priority=255),
+                                    CommunityDestination(node_count=node_count),
+                                    BenchPayload(),
+                                    self.check_bench,
+                                    self.on_bench,
+                                    batch=BatchConfiguration(delay)))
+        return messages
+
+    def phase_name(self, phase):
+        """Human readable configuration of a phase.
+        """
+        payload, configuration = PHASES[phase]
+        delay, node_count = CONFIGURATIONS[configuration]
+        return "%dB %.1fs n%d" % (payload, delay, node_count)
+
+    def start_phase(self, phase):
+        """Stream our messages for a phase.
+        """
+        self.phase = phase
+        self.phase_start = time.time()
+        payload, configuration = PHASES[phase]
+        meta = self.get_meta_message(u"bench-%d" % configuration)
+        # Every payload starts with the phase, the rest is padding
+        data = struct.pack("!H", phase) + "x" * max(0, payload - 2)
+        messages = (meta.impl(authentication=(self.my_member,),
+                              distribution=(self.claim_global_time(),),
+                              payload=(data,))
+                    for _ in xrange(self.new_message_count))
+        self.vz_stream(messages, 0.0, CHUNK)
+        # Messages of this phase may have arrived before we started it
+        self.check_phase()
+
+    def check_bench(self, messages):
+        """Callback to verify the contents of the messages received.
+        """
+        for message in messages:
+            yield message
+
+    def on_bench(self, messages):
+        """Callback for when validated messages are received.
+        """
+        for message in messages:
+            phase, = struct.unpack_from("!H", message.payload.data)
+            self.received[phase] = self.received.get(phase, 0) + 1
+        self.message_received += len(messages)
+        self.vz_report_target(
+            "messages",
+            self.message_received,
+            self.total_message_count * len(PHASES))
+        self.check_phase()
+
+    def check_phase(self):
+        """Finish the running phase once all messages of all peers
+            were received.
+        """
+        if self.phase is None or self.received.get(self.phase, 0) < self.total_message_count:
+            return
+        phase, self.phase = self.phase, None
+        elapsed = max(time.time() - self.phase_start, 1e-6)
+        msgs_per_s = self.total_message_count / elapsed
+        bytes_per_s = msgs_per_s * PHASES[phase][0]
+        self.results.append((phase, msgs_per_s, bytes_per_s))
+        # Report rates as reached targets, so they do not affect
+        # our completion (and never have a zero target)
+        name = self.phase_name(phase)
+        msgs_rate = max(1, int(msgs_per_s))
+        bytes_rate = max(1, int(bytes_per_s))
+        self.vz_report_target(name + " msgs/s", msgs_rate, msgs_rate)
+        self.vz_report_target(name + " bytes/s", bytes_rate, bytes_rate)
+        print "%s] %s: %.1f msgs/s, %.1f bytes/s" % (
+            self.dispersy.myid, name, msgs_per_s, bytes_per_s)
+        if phase + 1 < len(PHASES):
+            done = self.vz_barrier("phase-%d" % phase, self.totalpeers)
+            done.addCallback(lambda _: self.start_phase(phase + 1))
+        else:
+            # Wait for the experiment to end IN A THREAD
+            reactor.callInThread(self.wait_for_end)
+
+    def wait_for_end(self):
+        """Busy wait for the experiment to end
+        """
+        self.vz_wait_for_experiment_end()
+        stop_peer(self.dispersy)
+
+
+class BenchPayload(Payload):
+
+    """The data container for ThroughputCommunity communications.
+    """
+    class Implementation(Payload.Implementation):
+
+        def __init__(self, meta, data):
+            super(BenchPayload.Implementation, self).__init__(meta)
+            self.data = data
+
+
+class ThroughputConversion(BinaryConversion):
+
+    """Convert the payload into binary data (/a string) which can be
+        sent over the internet.
+    """
+
+    def __init__(self, community):
+        """Initialize the new Conversion object
+        """
+        super(ThroughputConversion, self).__init__(community, "\x01")
+        for index in range(len(CONFIGURATIONS)):
+            self.define_meta_message(
+                chr(1 + index),
+                community.get_meta_message(u"bench-%d" % index),
+                self._encode_bench,
+                self._decode_bench)
+
+    def _encode_bench(self, message):
+        """The encode callback to convert a Message into a binary representation (string).
+        """
+        return struct.pack("!L", len(message.payload.data)), message.payload.data
+
+    def _decode_bench(self, placeholder, offset, data):
+        """Given a binary representation of our payload
+            convert it back to a message.
+        """
+        if len(data) < offset + 4:
+            raise DropPacket("Insufficient packet size")
+        data_length, = struct.unpack_from("!L", data, offset)
+        offset += 4
+
+        if len(data) < offset + data_length or data_length < 2:
+            raise DropPacket("Insufficient packet size")
+        data_payload = data[offset:offset + data_length]
+        offset += data_length
+
+        return offset, placeholder.meta.payload.implement(data_payload)
+
+
+def join_overlay(
+    dispersy,
+     masterkey,
+     peerid,
+     totalpeers,
+     new_message_count,
+     total_message_count):
+    """Join our ThroughputCommunity and start the first phase once
+        all peers joined.
+    """
+    master_member = dispersy.get_member(public_key=masterkey)
+    my_member = dispersy.get_new_member()
+    community = ThroughputCommunity.init_community(
+        dispersy, master_member, my_member)
+    # Initialize our custom community, because we can't change the constructor
+    community.new_message_count = new_message_count
+    community.total_message_count = total_message_count
+    community.peerid = peerid
+    community.totalpeers = totalpeers
+    community.vz_report_target("messages", 0, total_message_count * len(PHASES))
+
+    print "%s] Joined community, %d phases" % (dispersy.myid, len(PHASES))
+
+    joined = community.vz_barrier("joined", totalpeers)
+    joined.addCallback(lambda _: community.start_phase(0))
+
+
+def generateMasterkey():
+    """Generate an M2Crypto Elliptic Curve key.
+    """
+    membuffer = BIO.MemoryBuffer()
+    keypair = EC.gen_params(EC.NID_sect233k1)
+    keypair.gen_key()
+    keypair.save_pub_key_bio(membuffer)
+    rawpubkey = membuffer.read()
+    membuffer.reset()
+    fpubkey = rawpubkey[27:]
+    fpubkey = fpubkey[:string.find(fpubkey, '-')]
+    return fpubkey  # BASE64 ENCODED
+
+
+stop_lock = threading.Lock()
+    # Serializes stopping, a peer can be released and told the
+    # VisualServer shuts down (on a timeout) at the same time
+
+
+def stop_peer(dispersy):
+    """Stop Dispersy and exit, once.
+        Blocks while Dispersy stops, so never call this on the
+        reactor thread.
+    """
+    with stop_lock:
+        if not dispersy.running:
+            return
+        dispersy.stop()
+    reactor.callFromThread(reactor.stop)
+
+
+def main(
+    peerid,
+     totalpeers,
+     new_message_count,
+     total_message_count,
+     vz_server_port):
+    """VisualDispersy will call this function with:
+        - peerid: [1~totalpeers] our id
+        - totalpeers: the total amount of peers in our experiment
+        - new_message_count: the amount of messages we share per phase
+        - total_message_count: the total amount of messages we receive per phase (including our own)
+        - vz_server_port: the server port we need to connect to for VisualDispersy
+    """
+    endpoint = LoopbackEndpoint(peer_port_base(10000), peer_host())
+    dispersy = VisualDispersy(endpoint, u".", u":memory:")
+    dispersy.vz_init_server_connection(vz_server_port)
+    # Agree on the master key, peer 1 offers one
+    masterkey = dispersy.vz_master_key("throughput", generateMasterkey if peerid == 1 else None)
+    if masterkey is None:
+        raise RuntimeError("VisualServer closed before the master key was known")
+    masterkey = masterkey.decode("BASE64")
+    dispersy.vz_on_shutdown(lambda: stop_peer(dispersy))
+
+    started = threads.deferToThread(dispersy.start, True)
+    started.addCallback(
+        lambda _: join_overlay(
+            dispersy,
+         masterkey,
+         peerid,
+         totalpeers,
+         new_message_count,
+         total_message_count))
+    reactor.run()